@@ -1,14 +1,14 @@
 import os
 import ast
-import json
 import math
 import time
+import socket
 import asyncio
 import logging
 import argparse
 import datetime
 import operator
-import functools
+import collections
 import subprocess
 import configparser
 
@@ -19,14 +19,37 @@ from aiohttp.abc import AbstractAccessLogger
 from aiohttp_session import get_session
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
+from . import timestamps
 from .db import Database
+from .schedule import CompletionScheduler
+from .codec import JSON, MSGPACK, dumpb, dumps, loads, negotiate, encoded_response
+from .cache import (
+    Prefetcher,
+    ResponseCache,
+    CachedResponse,
+    VersionHistory,
+    PrecompressedBody,
+    strong_etag,
+    etag_matches,
+)
 from .esi import ESISession
 from .data import implant_type_id_to_learning_bonus
-from .types import Character, ItemTypes, NoSuchCharacter, CharacterNeedsUpdated
+from .types import (
+    Character,
+    ItemTypes,
+    ESIUnavailable,
+    NoSuchCharacter,
+    ABCESILimiter,
+    CharacterNeedsUpdated,
+    StoredSkillTrades,
+    SharedMemoryESILimiter,
+)
+from .market import TRADE_HUBS, OrderBook, MarketData
+from .wallet import reduce_journal, aggregate_journal
+from .snapshot import SnapshotArchive
 from .isk_for_sp import get_isk_for_sp_options
 
 logger = logging.getLogger(__name__)
-dumps = functools.partial(json.dumps, separators=(",", ":"))
 
 attribute_reducer = operator.itemgetter(
     "intelligence", "memory", "perception", "willpower", "charisma"
@@ -46,24 +69,94 @@ async def get_account_id(request):
         raise aiohttp.web.HTTPUnauthorized() from None
 
 
-def dateparse(incoming):
-    return datetime.datetime.strptime(incoming, "%Y-%m-%dT%H:%M:%SZ").astimezone(
-        datetime.UTC
-    )
-
-
 def skillqueue_reducer(item):
     if "start_date" in item:
         return [
             item["skill_id"],
             item["finished_level"],
-            int(dateparse(item["start_date"]).timestamp()),
-            int(dateparse(item["finish_date"]).timestamp()),
+            timestamps.epoch(item["start_date"]),
+            timestamps.epoch(item["finish_date"]),
         ]
     else:
         return [item["skill_id"], item["finished_level"]]
 
 
+def implant_reducer(implants):
+    "Returns the attribute bonuses and biology implant level of the implants."
+    table = implant_type_id_to_learning_bonus
+    implant_bonuses = [0, 0, 0, 0, 0]
+    for implant_type_id in implants:
+        try:
+            attribute_id, magnitude = table[implant_type_id]
+        except KeyError:
+            continue
+        # This is a slightly clever trick. we want to order attributes
+        # INT MEM PER WIL CHR, but their IDs are ordered
+        # CHR INT MEM PER WIL starting at 175. So, we subtract 176 so
+        # that charisma will be -1 and placed at the end of the array.
+        implant_bonuses[attribute_id - 176] += magnitude
+
+    biology_implant = 0
+    if ItemTypes.BY805.value in implants:
+        biology_implant = 1
+    elif ItemTypes.BY810.value in implants:
+        biology_implant = 2
+    return implant_bonuses, biology_implant
+
+
+def training_queue_head(queue) -> None | tuple[int, int, int, int, int]:
+    "The skill in training: skill id, level, starting sp, start and finish."
+    if not queue:
+        return None
+    if "start_date" not in queue[0]:
+        return None
+    current_time = time.time()
+    for queue_item in queue:
+        finish_date = timestamps.epoch(queue_item["finish_date"])
+        if current_time < finish_date:
+            break
+    else:
+        return None
+
+    return (
+        queue_item["skill_id"],
+        queue_item["finished_level"],
+        queue_item["training_start_sp"],
+        timestamps.epoch(queue_item["start_date"]),
+        finish_date,
+    )
+
+
+def index_template(path: str) -> tuple[bytes, bytes]:
+    """
+    The built index.html split where the bootstrap data goes, at the start
+    of <head>, so that rendering it is only a concatenation.
+    """
+    with open(path, "rb") as f:
+        html = f.read()
+    split = html.index(b"<head>") + len(b"<head>")
+    return html[:split], html[split:]
+
+
+def skills_version(etag):
+    "The version of the skills data, whatever representation the ETag is for."
+    return etag.strip('"').partition("+")[0]
+
+
+def skills_delta(base, current, base_version):
+    """
+    The skills payload, except that it only lists the skills which were
+    added or changed since base, and the skill queue is null if it didn't
+    change. base_version is appended so that clients can tell it apart.
+    """
+    base_skills = frozenset(base[2])
+    delta = list(current)
+    delta[1] = None if current[1] == base[1] else current[1]
+    delta[2] = [s for s in current[2] if s not in base_skills]
+    delta.append(base_version)
+    return delta
+
+
 class AccessLogger(AbstractAccessLogger):
     def log(self, request, response, time):
         if response.status >= 500:
@@ -107,6 +200,11 @@ def sessionify(f):
             return aiohttp.web.Response(status=205)
         except NoSuchCharacter:
             return aiohttp.web.Response(status=404)
+        except ESIUnavailable as exc:
+            retry_after = str(math.ceil(exc.retry_after))
+            return aiohttp.web.Response(
+                status=503, headers={"Retry-After": retry_after}
+            )
 
     return wrapper
 
@@ -116,20 +214,66 @@ class Server:
         "_esi",
         "_client_id",
         "_cached_skill_trades",
+        "_skill_trades_ready",
+        "_markets",
+        "_snapshots",
         "_callback_source",
         "db",
         "_base_url",
         "_internal_account_id",
+        "_esilimiter_backend",
+        "_skills_cache",
+        "_skills_history",
+        "_wallet_journal_expiry",
+        "_training_subscribers",
+        "_training_completions",
+        "_training_refreshes",
+        "_prefetcher",
+        "_index_template",
     )
 
     def __init__(
-        self, base_url, esi_url, client_id, client_secret_key, internal_account_id
+        self,
+        base_url,
+        esi_url,
+        client_id,
+        client_secret_key,
+        internal_account_id,
+        esilimiter_backend="local",
+        trade_hubs=tuple(TRADE_HUBS),
+        snapshot_directory=None,
     ):
         self._base_url = base_url
         self._client_id = client_id
         self._esi = ESISession(esi_url, client_id, client_secret_key)
-        self._cached_skill_trades = 0, None
+        # (expires, body, prices, {type ID: [OrderBook for each hub]})
+        self._cached_skill_trades = 0, None, None, {}
+        self._skill_trades_ready = asyncio.Event()
+        # The leader's market orders in each trade hub, kept between scans.
+        self._markets = {
+            name: MarketData(self._esi, TRADE_HUBS[name]) for name in trade_hubs
+        }
+        # Where each scan's market orders are kept, if anywhere.
+        self._snapshots = (
+            None if snapshot_directory is None else SnapshotArchive(snapshot_directory)
+        )
         self._internal_account_id = internal_account_id
+        self._esilimiter_backend = esilimiter_backend
+        self._skills_cache = ResponseCache()
+        self._skills_history = VersionHistory()
+        # When each recently synchronized character's journal needs to be
+        # synchronized again, least recently synchronized first.
+        self._wallet_journal_expiry: collections.OrderedDict[int, datetime.datetime] = (
+            collections.OrderedDict()
+        )
+        # The event queues of each account's /characters/events streams, and
+        # when each of their characters' skill in training finishes.
+        self._training_subscribers: dict[int, set[asyncio.Queue[bytes]]] = {}
+        self._training_completions = CompletionScheduler(self._on_training_completed)
+        # Refreshes started by completions, so they can be cancelled at exit.
+        self._training_refreshes: set[asyncio.Task] = set()
+        # Warms _skills_cache for the characters of accounts in use.
+        self._prefetcher = Prefetcher(self._prefetch_skills)
 
     async def esi_callback(self, request):
         session = await get_session(request)
@@ -230,76 +374,245 @@ class Server:
         await self.db.delete_character(account_id=account_id, character_id=character_id)
         return aiohttp.web.Response(status=200)
 
+    # Journal entries per /{char}/wallet page; the same as an ESI page.
+    WALLET_PAGE_SIZE = 2500
+
     @sessionify
     async def wallet(self, session, request):
-        journal = await self._esi.get_wallet_journal(session)
+        """
+        The journal, newest first. If there are older entries, the id to pass
+        as ?before= to get the next page is appended.
+        """
+        try:
+            before = int(request.query["before"])
+        except KeyError:
+            before = None
+        except ValueError:
+            return aiohttp.web.Response(status=400)
+
+        character_id = session.character.id
+        expires = await self._sync_wallet_journal(session)
         now = datetime.datetime.now(datetime.UTC)
-        time_until_expiry = math.floor((journal.expires - now).total_seconds())
+        time_until_expiry = math.floor((expires - now).total_seconds())
         headers = {}
         if time_until_expiry > 0:
             headers["Cache-Control"] = f"private, max-age={time_until_expiry}"
 
-        journal = [j for j in journal if j["amount"]]  # skip 0 ISK "fees"
+        journal = await self.db.get_wallet_journal(
+            character_id, before, self.WALLET_PAGE_SIZE + 1
+        )
         if not len(journal):
-            return aiohttp.web.json_response((), dumps=dumps, headers=headers)
-
-        string_table = {}
-
-        def entry(the_str):
-            try:
-                return string_table[the_str]
-            except KeyError:
-                idx = len(string_table)
-                string_table[the_str] = idx
-                return idx
-
-        first_date_int = int(dateparse(journal[0]["date"]).timestamp())
-        etag = f'W/"{first_date_int}"'
-        headers["ETag"] = etag
-        if etag == request.headers.get("if-none-match"):
-            raise aiohttp.web.HTTPNotModified
-
-        reduced = [
-            (
-                first_date_int - int(dateparse(j["date"]).timestamp()),
-                j["amount"],
-                entry(j["description"]),
+            return encoded_response(request, (), headers)
+        more = len(journal) > self.WALLET_PAGE_SIZE
+        journal = journal[: self.WALLET_PAGE_SIZE]
+
+        headers["ETag"] = f'W/"{journal[0]["id"]}"'
+        if etag_matches(request, f'"{journal[0]["id"]}"'):
+            raise aiohttp.web.HTTPNotModified(headers=headers)
+
+        first_date, string_table, reduced = reduce_journal(
+            [j["date"] for j in journal],
+            [j["amount"] for j in journal],
+            [j["description"] for j in journal],
+        )
+        payload = [journal[0]["balance"], first_date, string_table, reduced]
+        if more:
+            payload.append(journal[-1]["id"])
+        return encoded_response(request, payload, headers)
+
+    # How many characters' journal expiry times are kept.
+    WALLET_JOURNAL_EXPIRY_SIZE = 4096
+
+    async def _sync_wallet_journal(self, session) -> datetime.datetime:
+        """
+        Stores the journal entries newer than the newest one we already have;
+        the first time, every page is fetched concurrently. Returns when
+        ESI's copy of the journal expires.
+        """
+        character_id = session.character.id
+        now = datetime.datetime.now(datetime.UTC)
+        expires = self._wallet_journal_expiry.get(character_id)
+        if expires is not None and expires > now:
+            return expires
+
+        def get_page(page):
+            return self._esi.get_wallet_journal(session, params={"page": str(page)})
+
+        high_water = await self.db.get_wallet_journal_high_water(character_id)
+        first_page = await get_page(1)
+        page_count = int(first_page.headers.get("X-Pages", "1"))
+        entries = list(first_page)
+        if high_water is None:
+            for page in await asyncio.gather(*map(get_page, range(2, page_count + 1))):
+                entries += page
+        else:
+            # Pages are newest first; stop once we reach what we already have.
+            page = first_page
+            page_number = 1
+            while (
+                page_number < page_count
+                and page
+                and min(j["id"] for j in page) > high_water
+            ):
+                page_number += 1
+                page = await get_page(page_number)
+                entries += page
+            entries = [j for j in entries if j["id"] > high_water]
+
+        if entries:
+            dates = timestamps.epochs([j["date"] for j in entries])
+            await self.db.add_wallet_journal(
+                character_id,
+                [
+                    (
+                        j["id"],
+                        int(date),
+                        j["ref_type"],
+                        j.get("amount"),
+                        j.get("balance"),
+                        j["description"],
+                    )
+                    for j, date in zip(entries, dates)
+                ],
             )
-            for j in journal
-        ]
+            logger.debug("stored %d journal entries for %d", len(entries), character_id)
+
+        self._wallet_journal_expiry[character_id] = first_page.expires
+        self._wallet_journal_expiry.move_to_end(character_id)
+        if len(self._wallet_journal_expiry) > self.WALLET_JOURNAL_EXPIRY_SIZE:
+            self._wallet_journal_expiry.popitem(last=False)
+        return first_page.expires
+
+    WALLET_ANALYTICS_BUCKETS = {"day": 86400, "week": 7 * 86400}
+
+    async def wallet_analytics(self, request):
+        """
+        Income and spending by ref_type for every character on the account,
+        totalled per ?period (day or week) over the last ?days days:
+        [first bucket start, bucket seconds, ref_types, income, spending],
+        where income and spending hold a list of per-bucket totals for each
+        ref_type. Spending totals are negative.
+        """
+        try:
+            bucket_seconds = self.WALLET_ANALYTICS_BUCKETS[
+                request.query.get("period", "day")
+            ]
+            days = int(request.query.get("days", "30"))
+        except (KeyError, ValueError):
+            return aiohttp.web.Response(status=400)
+        if not 0 < days <= 3650:
+            return aiohttp.web.Response(status=400)
 
-        return aiohttp.web.json_response(
-            [
-                journal[0]["balance"],
-                first_date_int,
-                tuple(string_table.keys()),
-                reduced,
-            ],
-            headers=headers,
-            dumps=dumps,
+        account_id, characters, validity = await self._characters(request)
+        character_ids = [c.id for valid, c in zip(validity, characters) if valid]
+        semaphore = asyncio.Semaphore(5)
+
+        async def sync(character_id):
+            async with semaphore:
+                try:
+                    session = await self.db.get_session(account_id, character_id)
+                    await self._sync_wallet_journal(session)
+                except CharacterNeedsUpdated:
+                    logger.info(
+                        "character %d needs refresh token updated", character_id
+                    )
+                except Exception:
+                    logger.exception("error synchronizing %d journal", character_id)
+
+        async with asyncio.TaskGroup() as tg:
+            for character_id in character_ids:
+                tg.create_task(sync(character_id), name=f"journal-{character_id}")
+
+        # Buckets are aligned to the epoch, so a day starts at 00:00 EVE time.
+        now = int(time.time())
+        start = now - days * 86400
+        start -= start % bucket_seconds
+        dates, ref_types, amounts = await self.db.get_wallet_journal_columns(
+            character_ids, datetime.datetime.fromtimestamp(start, datetime.UTC)
+        )
+        ref_types, income, spending = aggregate_journal(
+            dates, ref_types, amounts, start, now, bucket_seconds
+        )
+        return encoded_response(
+            request,
+            [start, bucket_seconds, ref_types, income, spending],
+            {"Cache-Control": "private, max-age=300"},
         )
 
     @sessionify
     async def skills(self, session, request):
-        await self._esi.ensure_session(session)
+        # Users reload this constantly; as long as nothing upstream can have
+        # changed, answer without contacting ESI or re-encoding anything.
+        encoder = negotiate(request)
+        character_id = session.character.id
+        account_id = await get_account_id(request)
+        self._prefetcher.touch(account_id)
+        cached = self._skills_cache.get((character_id, encoder.content_type))
+        if cached is None and encoder is JSON:
+            prefetch = self._prefetcher.claim(account_id, character_id)
+            if prefetch is not None:
+                # Unlike awaiting it, this won't cancel it if we're cancelled.
+                await asyncio.wait([prefetch])
+                cached = self._skills_cache.get((character_id, encoder.content_type))
+        if cached is None:
+            cached = await self._encode_skills(session, encoder)
+
+        headers = {"ETag": cached.etag, "Vary": "Accept"}
+        now = datetime.datetime.now(datetime.UTC)
+        time_until_expiry = math.floor((cached.expires - now).total_seconds())
+        if time_until_expiry > 0:
+            headers["Cache-Control"] = f"private, max-age={time_until_expiry}"
+        if cached.stale_date is not None:
+            # ESI is down, and this is how old what it last told us is.
+            age = max(0, math.floor((now - cached.stale_date).total_seconds()))
+            headers["Age"] = str(age)
+
+        if etag_matches(request, cached.etag):
+            raise aiohttp.web.HTTPNotModified(headers=headers)
+
+        # Clients may pass the version (ETag) they already have in order to
+        # only receive what changed since. If we've forgotten that version,
+        # they get everything.
+        try:
+            since = skills_version(request.query["since"])
+        except KeyError:
+            pass
+        else:
+            base = self._skills_history.get(character_id, since)
+            current = self._skills_history.get(
+                character_id, skills_version(cached.etag)
+            )
+            if base is not None and current is not None:
+                return encoded_response(
+                    request, skills_delta(base, current, since), headers
+                )
+
+        return aiohttp.web.Response(
+            body=cached.body, content_type=encoder.content_type, headers=headers
+        )
+
+    # How soon to try ESI again after answering with stale skills.
+    SKILLS_STALE_RETRY = 30
+
+    async def _encode_skills(self, session, encoder) -> CachedResponse:
+        responses = await self._get_skill_data(session)
         (
             skill_data,
             skill_queue,
             attributes,
             wallet_balance,
             implants,
-        ) = await asyncio.gather(
-            self._esi.get_skills(session),
-            self._esi.get_skill_queue(session),
-            self._esi.get_attributes(session),
-            self._esi.get_wallet_balance(session),
-            self._esi.get_implants(session),
-        )
-
-        earliest_expiry = min(
-            x.expires
-            for x in (skill_data, skill_queue, attributes, wallet_balance, implants)
-        )
+        ) = responses
+
+        earliest_expiry = min(x.expires for x in responses)
+        version = strong_etag(
+            str(session.character.id), *(x.headers["Last-Modified"] for x in responses)
+        ).strip('"')
+        # Each representation needs its own strong ETag.
+        if encoder is MSGPACK:
+            etag = f'"{version}+msgpack"'
+        else:
+            etag = f'"{version}"'
 
         wallet_balance = wallet_balance.result
 
@@ -308,83 +621,274 @@ class Server:
         skills = tuple(map(skill_reducer, skill_data["skills"]))
         skill_queue = tuple(map(skillqueue_reducer, skill_queue))
         attributes = attribute_reducer(attributes)
+        implant_bonuses, biology_implant = implant_reducer(implants)
 
-        table = implant_type_id_to_learning_bonus
-        implant_bonuses = [0, 0, 0, 0, 0]
-        for implant_type_id in implants:
-            try:
-                attribute_id, magnitude = table[implant_type_id]
-            except KeyError:
-                continue
-            # This is a slightly clever trick. we want to order attributes
-            # INT MEM PER WIL CHR, but their IDs are ordered
-            # CHR INT MEM PER WIL starting at 175. So, we subtract 176 so
-            # that charisma will be -1 and placed at the end of the array.
-            implant_bonuses[attribute_id - 176] += magnitude
-
-        biology_implant = 0
-        if ItemTypes.BY805.value in implants:
-            biology_implant = 1
-        elif ItemTypes.BY810.value in implants:
-            biology_implant = 2
+        payload = (
+            sp,
+            skill_queue,
+            skills,
+            attributes,
+            wallet_balance,
+            0,
+            0,
+            implant_bonuses,
+            unallocated_sp,
+            biology_implant,
+        )
+        self._skills_history.add(session.character.id, version, payload)
+        stale_dates = [x.date for x in responses if x.stale]
+        if stale_dates:
+            # Kept out of the cache, so that ESI is asked again next time.
+            expires = datetime.datetime.now(datetime.UTC) + datetime.timedelta(
+                seconds=self.SKILLS_STALE_RETRY
+            )
+            return CachedResponse(
+                encoder.encode(payload), etag, expires, min(stale_dates)
+            )
+        return self._skills_cache.put(
+            (session.character.id, encoder.content_type),
+            encoder.encode(payload),
+            etag,
+            earliest_expiry,
+        )
 
-        headers = {}
-        now = datetime.datetime.now().replace(tzinfo=datetime.UTC)
-        time_until_expiry = math.floor((earliest_expiry - now).total_seconds())
+    async def _prefetch_skills(self, account_id, character_id) -> datetime.datetime:
+        "Encodes a character's skills into _skills_cache for the Prefetcher."
+        cached = self._skills_cache.get((character_id, JSON.content_type))
+        if cached is None:
+            session = await self.db.get_session(account_id, character_id)
+            cached = await self._encode_skills(session, JSON)
+        return cached.expires
 
-        if time_until_expiry > 0:
-            headers["Cache-Control"] = f"private, max-age={time_until_expiry}"
+    async def _get_skill_data(self, session):
+        "The skills, skill queue, attributes, wallet balance and implants."
+        await self._esi.ensure_session(session)
+        return await asyncio.gather(
+            self._esi.get_skills(session),
+            self._esi.get_skill_queue(session),
+            self._esi.get_attributes(session),
+            self._esi.get_wallet_balance(session),
+            self._esi.get_implants(session),
+        )
 
-        return aiohttp.web.json_response(
-            (
-                sp,
-                skill_queue,
-                skills,
-                attributes,
-                wallet_balance,
-                0,
-                0,
-                implant_bonuses,
+    async def dashboard(self, request):
+        """
+        One JSON line per valid character, sent as soon as it is ready:
+        [id, sp, unallocated sp, current training or null, queue length,
+        wallet balance, implant bonuses, biology implant]. Characters which
+        could not be downloaded are sent as just [id].
+        """
+        account_id, characters, validity = await self._characters(request)
+        character_ids = [c.id for valid, c in zip(validity, characters) if valid]
+
+        async def get_character_summary(character_id):
+            try:
+                session = await self.db.get_session(account_id, character_id)
+                (
+                    skill_data,
+                    skill_queue,
+                    _,
+                    wallet_balance,
+                    implants,
+                ) = await self._get_skill_data(session)
+            except CharacterNeedsUpdated:  # soften this for reporting purposes
+                logger.info("character %d needs refresh token updated", character_id)
+                return f"[{character_id}]\n".encode()
+            except Exception:
+                logger.exception("error downloading %d summary", character_id)
+                return f"[{character_id}]\n".encode()
+
+            unallocated_sp = skill_data.get("unallocated_sp", 0)
+            implant_bonuses, biology_implant = implant_reducer(implants)
+            summary = (
+                character_id,
+                skill_data["total_sp"] + unallocated_sp,
                 unallocated_sp,
+                training_queue_head(skill_queue),
+                len(skill_queue),
+                wallet_balance.result,
+                implant_bonuses,
                 biology_implant,
-            ),
-            dumps=dumps,
-            headers=headers,
+            )
+            return dumpb(summary) + b"\n"
+
+        return await self._stream_lines(
+            request, character_ids, get_character_summary, "dashboard"
         )
 
+    # How often the market is scanned for skill trade prices.
+    SKILL_TRADE_INTERVAL = 30 * 60
+    # How often nodes which aren't scanning check for a newer scan, and
+    # whether the scanning node has gone away.
+    SKILL_TRADE_FOLLOWER_INTERVAL = 60
+
     async def _skill_trade_task(self):
-        while True:
-            try:
-                characters, validity = await self.db.get_characters(
-                    self._internal_account_id
-                )
-                if not characters:
-                    raise Exception("No internal account characters!")
-                character = characters[0]
-                session = await self.db.get_session(
-                    self._internal_account_id, character.id
-                )
-                data = await get_isk_for_sp_options(self._esi, session)
-                expires = time.monotonic() + 30 * 60
-                self._cached_skill_trades = expires, data
-            except Exception:
-                logging.exception("Error updating skill trade information")
+        """
+        Only the node holding the "skill_trades" advisory lock scans the
+        market. Its result is shared through the database; the other nodes
+        serve it from there, and take over scanning if the leader dies.
+        """
+        leadership = None
+        last_update_time = None
+        try:
+            while True:
+                sleep_length = self.SKILL_TRADE_FOLLOWER_INTERVAL
+                try:
+                    if leadership is not None and not await leadership.is_held():
+                        logger.warning("lost skill trade scanning leadership")
+                        await leadership.release()
+                        leadership = None
+                    if leadership is None:
+                        leadership = await self.db.try_acquire_leadership(
+                            "skill_trades"
+                        )
+                        if leadership is not None:
+                            logger.info("this node is now scanning skill trades")
+
+                    stored = await self.db.get_skill_trades()
+                    now = datetime.datetime.now(datetime.UTC)
+                    scan_time = None
+                    if leadership is not None:
+                        if stored is None or stored.expires <= now:
+                            data = dumps(await self._scan_skill_trades())
+                            # Snapshots are named after when the scan finished.
+                            scan_time = int(time.time())
+                            expires = now + datetime.timedelta(
+                                seconds=self.SKILL_TRADE_INTERVAL
+                            )
+                            update_time = await self.db.set_skill_trades(data, expires)
+                            stored = StoredSkillTrades(data, update_time, expires)
+                        sleep_length = max(1, (stored.expires - now).total_seconds())
+
+                    if stored is not None and stored.update_time != last_update_time:
+                        last_update_time = stored.update_time
+                        self._publish_skill_trades(stored, now)
+                    if scan_time is not None and self._snapshots is not None:
+                        await self._save_snapshot(scan_time)
+                except Exception:
+                    logging.exception("Error updating skill trade information")
+
+                await asyncio.sleep(sleep_length)
+        finally:
+            if leadership is not None:
+                await leadership.release()
+
+    def _publish_skill_trades(self, stored: StoredSkillTrades, now) -> None:
+        """
+        Encodes and compresses the skill trades once, for every request
+        until they next change, and wakes up any requests waiting for them.
+        The order books are kept back from the body, for ?quantity.
+        """
+        data = stored.data
+        scan = loads(data.encode() if isinstance(data, str) else dumpb(data))
+        prices = scan[:5]
+        books = {
+            type_id: [OrderBook(hub_prices, volumes) for hub_prices, volumes in hubs]
+            for type_id, hubs in (scan[5] if len(scan) > 5 else ())
+        }
+        time_until_expiry = (stored.expires - now).total_seconds()
+        expires = time.monotonic() + time_until_expiry
+        body = PrecompressedBody(dumpb(prices), JSON.content_type)
+        self._cached_skill_trades = expires, body, prices, books
+        self._skill_trades_ready.set()
+
+    async def _save_snapshot(self, scan_time: int) -> None:
+        "Keeps the orders from the scan; they're published whether it can or not."
+        try:
+            await asyncio.to_thread(
+                self._snapshots.add, scan_time, list(self._markets.values())
+            )
+        except Exception:
+            logger.exception("error saving market snapshot")
+
+    def _restore_markets(self) -> None:
+        "Picks up the market orders from the last scan, even another node's."
+        snapshot = self._snapshots.latest()
+        if snapshot is None:
+            return
+        for market in self._markets.values():
+            market.restore(snapshot.entries(market.region_id))
+        logger.info("restored %d market orders from %d", snapshot.rows, snapshot.time)
+
+    async def _scan_skill_trades(self):
+        characters, validity = await self.db.get_characters(self._internal_account_id)
+        if not characters:
+            raise Exception("No internal account characters!")
+        character = characters[0]
+        session = await self.db.get_session(self._internal_account_id, character.id)
+        return await get_isk_for_sp_options(self._esi, session, self._markets)
 
-            await asyncio.sleep(60 * 30)
+    # The most units ?quantity may ask for.
+    SKILL_TRADE_MAX_QUANTITY = 1_000_000
 
     async def skill_trades(self, request):
-        expires, data = self._cached_skill_trades
-        while not data:
-            await asyncio.sleep(1)
-            expires, data = self._cached_skill_trades
+        """
+        [hubs, large skill injector prices, small skill injector prices,
+        accelerators, as of] where each has a price for each hub. With
+        ?quantity, prices are the average unit price when buying that many
+        from the cheapest sellers up, or null if there aren't that many.
+        """
+        try:
+            quantity = int(request.query.get("quantity", "1"))
+        except ValueError:
+            return aiohttp.web.Response(status=400)
+        if not 0 < quantity <= self.SKILL_TRADE_MAX_QUANTITY:
+            return aiohttp.web.Response(status=400)
 
+        await self._skill_trades_ready.wait()
+        expires, body, prices, books = self._cached_skill_trades
         time_until_expiry = int(expires - time.monotonic())
-        return aiohttp.web.json_response(
-            data,
-            dumps=dumps,
-            headers={}
-            if time_until_expiry < 0
-            else {"Cache-Control": f"public, max-age={time_until_expiry}"},
+        headers = {}
+        if time_until_expiry >= 0:
+            headers["Cache-Control"] = f"public, max-age={time_until_expiry}"
+        if quantity == 1:
+            return body.respond(request, headers)
+
+        def unit_prices(type_id):
+            unit_prices = []
+            for book in books.get(type_id, ()):
+                cost = book.fill_cost(quantity)
+                unit_prices.append(None if cost is None else cost / quantity)
+            return unit_prices
+
+        hubs, lsi, ssi, accelerators, as_of = prices
+        return encoded_response(
+            request,
+            (
+                hubs,
+                unit_prices(ItemTypes.LargeSkillInjector.value),
+                unit_prices(ItemTypes.SmallSkillInjector.value),
+                [(a[0], unit_prices(a[0]), *a[2:]) for a in accelerators],
+                as_of,
+            ),
+            headers,
+        )
+
+    async def skill_trade_history(self, request):
+        """
+        The best sell and buy prices of a ?type_id in a ?hub at each scan
+        over the last ?days days, as [times, sell prices, buy prices].
+        """
+        if self._snapshots is None:
+            return aiohttp.web.Response(status=404)
+        try:
+            type_id = int(request.query["type_id"])
+            region_id = self._markets[request.query.get("hub", "Jita")].region_id
+            days = int(request.query.get("days", "7"))
+        except (KeyError, ValueError):
+            return aiohttp.web.Response(status=400)
+        if not 0 < days <= self._snapshots.RETENTION.days:
+            return aiohttp.web.Response(status=400)
+
+        since = int(time.time()) - days * 86400
+        await asyncio.to_thread(self._snapshots.discover)
+        points = await asyncio.to_thread(
+            self._snapshots.history, type_id, region_id, since
+        )
+        return encoded_response(
+            request,
+            [list(column) for column in zip(*points)] or [[], [], []],
+            {"Cache-Control": "public, max-age=300"},
         )
 
     async def _characters(self, request) -> tuple[int, list[Character], list[bool]]:
@@ -397,8 +901,51 @@ class Server:
             raise aiohttp.web.HTTPUnauthorized() from None
         return account_id, characters, validity
 
+    async def index(self, request):
+        """
+        index.html. For a logged in account, the character list (in the
+        /characters format) is embedded as window.bootstrap, so the page
+        doesn't need to fetch it before it can show anything. Training
+        progress then arrives over /characters/events.
+        """
+        head, rest = self._index_template
+        body = head + rest
+        session = await get_session(request)
+        account_id = session.get("account_id")
+        if account_id is not None:
+            characters, validity = await self.db.get_characters(account_id)
+            if characters:
+                self._prefetcher.touch(
+                    account_id,
+                    [c.id for valid, c in zip(validity, characters) if valid],
+                )
+                bootstrap = dumpb(
+                    {"characters": [(*c, v) for c, v in zip(characters, validity)]}
+                )
+                # Character names can't end the script element early.
+                bootstrap = bootstrap.replace(b"<", b"\\u003c")
+                body = b"".join(
+                    (
+                        head,
+                        b'<script id=bootstrap type="application/json">',
+                        bootstrap,
+                        b"</script>",
+                        rest,
+                    )
+                )
+        return aiohttp.web.Response(
+            body=body,
+            content_type="text/html",
+            charset="utf-8",
+            headers={"Cache-Control": "private, no-cache"},
+        )
+
     async def characters(self, request):
-        _, characters, validity = await self._characters(request)
+        account_id, characters, validity = await self._characters(request)
+        # The client is about to ask for each of these characters' skills.
+        self._prefetcher.touch(
+            account_id, [c.id for valid, c in zip(validity, characters) if valid]
+        )
         return aiohttp.web.json_response(
             [(*c, v) for c, v in zip(characters, validity)], dumps=dumps
         )
@@ -412,75 +959,77 @@ class Server:
         return aiohttp.web.Response(status=200)
 
     async def characters_training(self, request):
-        semaphore = asyncio.Semaphore(5)
         account_id, characters, validity = await self._characters(request)
         character_ids = [c.id for valid, c in zip(validity, characters) if valid]
+        self._prefetcher.touch(account_id, character_ids)
 
         async def get_character_training(character_id):
             try:
-                async with semaphore:
-                    result = await self._single_character_training(
-                        account_id, character_id
-                    )
+                result = await self._single_character_training(account_id, character_id)
             except CharacterNeedsUpdated:  # soften this for reporting purposes
                 logger.info("character %d needs refresh token updated", character_id)
                 result = None
-            except asyncio.CancelledError:  # soften this for reporting purposes
-                result = None
-            except BaseException:
+            except Exception:
                 logger.exception("error downloading %d skill queue", character_id)
                 result = None
-            results_to_transmit.append((character_id, result))
-            nonlocal completed_count
-            completed_count += 1
-            if completed_count == expected_count:
-                all_done_future.set_result(None)
+            if encoder is MSGPACK:
+                return encoder.encode((character_id, *(result or ())))
+            return self._character_training_result(character_id, result)
+
+        encoder = negotiate(request)
+        content_type = encoder.content_type if encoder is MSGPACK else "text/plain"
+        return await self._stream_lines(
+            request, character_ids, get_character_training, "training", content_type
+        )
+
+    @staticmethod
+    async def _stream_lines(
+        request, character_ids, produce, name, content_type="text/plain", concurrency=5
+    ):
+        """
+        Streams the line produce() returns for each character as soon as it
+        is ready. Lines which become ready at the same time are written
+        together. If the client goes away, the outstanding work is cancelled.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        finished: asyncio.Queue[bytes] = asyncio.Queue()
+
+        async def run(character_id):
+            async with semaphore:
+                line = await produce(character_id)
+            finished.put_nowait(line)
 
         response = aiohttp.web.StreamResponse(
-            status=200, headers={"Content-Type": "text/plain"}
+            status=200, headers={"Content-Type": content_type, "Vary": "Accept"}
         )
 
         await response.prepare(request)
 
         try:
             async with asyncio.TaskGroup() as tg:
-                expected_count = len(character_ids)
                 for character_id in character_ids:
-                    tg.create_task(
-                        get_character_training(character_id),
-                        name=f"training-{character_id}",
-                    )
-                completed_count = 0
-                transmitted_count = 0
-                results_to_transmit = []
-                all_done_future = asyncio.Future()
+                    tg.create_task(run(character_id), name=f"{name}-{character_id}")
 
+                expected_count = len(character_ids)
+                transmitted_count = 0
                 while transmitted_count != expected_count:
-                    await asyncio.wait(
-                        (asyncio.create_task(asyncio.sleep(0.2)), all_done_future),
-                        return_when=asyncio.FIRST_COMPLETED,
+                    lines = [await finished.get()]
+                    while not finished.empty():
+                        lines.append(finished.get_nowait())
+                    # Raises if the client went away, cancelling the rest.
+                    await response.write(b"".join(lines))
+                    transmitted_count += len(lines)
+                    logger.debug(
+                        "transmitted %d/%d characters",
+                        transmitted_count,
+                        expected_count,
                     )
-                    going_to_transmit_count = len(results_to_transmit)
-                    if going_to_transmit_count:
-                        response_segment = b""
-                        for character_id, result in results_to_transmit:
-                            response_segment += self._character_training_result(
-                                character_id, result
-                            )
-                        results_to_transmit = []
-                        await response.write(response_segment)
-                        transmitted_count += going_to_transmit_count
-                        logger.debug(
-                            "transmitted %d/%d characters",
-                            transmitted_count,
-                            expected_count,
-                        )
 
                 await response.write_eof()
         except* aiohttp.client_exceptions.ClientConnectionResetError:
-            logger.debug("client disconnected before all training requests completed")
+            logger.debug("client disconnected before all %s requests completed", name)
         except* ConnectionResetError:
-            logger.debug("client disconnected before all training requests completed")
+            logger.debug("client disconnected before all %s requests completed", name)
         return response
 
     async def _single_character_training(
@@ -489,25 +1038,7 @@ class Server:
         session = await self.db.get_session(account_id, character_id)
         queue = await self._esi.get_skill_queue(session)
         del session
-        if not queue:
-            return None
-        if "start_date" not in queue[0]:
-            return None
-        current_time = datetime.datetime.now(datetime.UTC)
-        for queue_item in queue:
-            finish_date = dateparse(queue_item["finish_date"])
-            if current_time < finish_date:
-                break
-        else:
-            return None
-
-        return (
-            queue_item["skill_id"],
-            queue_item["finished_level"],
-            queue_item["training_start_sp"],
-            int(dateparse(queue_item["start_date"]).timestamp()),
-            int(finish_date.timestamp()),
-        )
+        return training_queue_head(queue)
 
     @staticmethod
     def _character_training_result(character_id, result):
@@ -516,19 +1047,118 @@ class Server:
         skill_id, level, sp, started, ended = result
         return f"{character_id}:{skill_id}:{level}:{sp}:{started}:{ended}\n".encode()
 
+    # Seconds between comments sent to keep idle event streams open.
+    EVENT_KEEPALIVE = 25
+
+    async def training_events(self, request):
+        """
+        Server-sent events about the account's valid characters' training,
+        each with a line in the /characters/training format as its data. A
+        "training" event is sent for every character when the stream opens,
+        then a "completed" event whenever a skill finishes, so that clients
+        don't need to poll.
+        """
+        account_id, characters, validity = await self._characters(request)
+        character_ids = [c.id for valid, c in zip(validity, characters) if valid]
+        events: asyncio.Queue[bytes] = asyncio.Queue()
+        subscribers = self._training_subscribers.setdefault(account_id, set())
+        subscribers.add(events)
+
+        response = aiohttp.web.StreamResponse(
+            status=200,
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"},
+        )
+        await response.prepare(request)
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for character_id in character_ids:
+                    tg.create_task(
+                        self._refresh_training(account_id, character_id, events),
+                        name=f"training-events-{character_id}",
+                    )
+                while True:
+                    try:
+                        event = await asyncio.wait_for(
+                            events.get(), self.EVENT_KEEPALIVE
+                        )
+                    except TimeoutError:
+                        event = b":\n\n"
+                    # Raises once the client has gone away.
+                    await response.write(event)
+        except* aiohttp.client_exceptions.ClientConnectionResetError:
+            logger.debug("client disconnected from training events")
+        except* ConnectionResetError:
+            logger.debug("client disconnected from training events")
+        finally:
+            subscribers.discard(events)
+            if not subscribers:
+                del self._training_subscribers[account_id]
+                for character_id in character_ids:
+                    self._training_completions.cancel((account_id, character_id))
+        return response
+
+    async def _refresh_training(
+        self, account_id: int, character_id: int, events: asyncio.Queue | None = None
+    ) -> None:
+        """
+        Sends the character's queue head as a "training" event to events, or
+        as a "completed" event to all of the account's streams if events is
+        None, and schedules the next completion.
+        """
+        try:
+            result = await self._single_character_training(account_id, character_id)
+        except CharacterNeedsUpdated:
+            logger.info("character %d needs refresh token updated", character_id)
+            result = None
+        except Exception:
+            logger.exception("error downloading %d skill queue", character_id)
+            result = None
+
+        subscribers = self._training_subscribers.get(account_id)
+        if not subscribers:
+            return
+        if result is not None:
+            # A second late, so that the finished skill is certainly no longer
+            # the head of the queue by then.
+            finish = result[4] + 1
+            self._training_completions.schedule((account_id, character_id), finish)
+        line = self._character_training_result(character_id, result)
+        if events is None:
+            event = b"event: completed\ndata: " + line + b"\n"
+            for subscriber in subscribers:
+                subscriber.put_nowait(event)
+        else:
+            events.put_nowait(b"event: training\ndata: " + line + b"\n")
+
+    def _on_training_completed(self, key: tuple[int, int]) -> None:
+        account_id, character_id = key
+        task = asyncio.create_task(
+            self._refresh_training(account_id, character_id),
+            name=f"training-completed-{character_id}",
+        )
+        self._training_refreshes.add(task)
+        task.add_done_callback(self._training_refreshes.discard)
+
     async def run(self, listen_sock_path, dbargs, cookie_secret_key):
+        self._index_template = index_template("static/index.html")
         app = aiohttp.web.Application()
         app.add_routes(
             [
+                aiohttp.web.get("/", self.index),
                 aiohttp.web.post("/characters/ordering", self.change_ordering),
                 aiohttp.web.get("/auth", self.auth_redirect),
                 aiohttp.web.get("/callback", self.esi_callback),
                 aiohttp.web.get("/characters", self.characters),
                 aiohttp.web.get("/characters/training", self.characters_training),
+                aiohttp.web.get("/characters/dashboard", self.dashboard),
+                aiohttp.web.get("/characters/events", self.training_events),
                 aiohttp.web.get(r"/{char:\d+}/skills", self.skills),
                 aiohttp.web.get(r"/{char:\d+}/wallet", self.wallet),
+                aiohttp.web.get("/characters/wallet", self.wallet_analytics),
                 aiohttp.web.delete(r"/{char:\d+}", self.delete_character),
                 aiohttp.web.get("/skilltrades", self.skill_trades),
+                aiohttp.web.get("/skilltrades/history", self.skill_trade_history),
                 aiohttp.web.get("/logout", self.logout),
                 aiohttp.web.get("/cause_an_error", raiser),
                 aiohttp.web.static("/s", "static"),
@@ -543,6 +1173,13 @@ class Server:
             ),
         )
         async with Database(**dbargs) as self.db, self._esi:
+            esilimiter = await self._create_esilimiter()
+            if esilimiter is not None:
+                self._esi.use_esilimiter(esilimiter)
+            self._esi.use_forbidden_citadels(await self.db.forbidden_citadels())
+            self._esi.use_citadel_registry(await self.db.citadel_registry())
+            if self._snapshots is not None:
+                self._restore_markets()
             task = asyncio.get_event_loop().create_task(self._skill_trade_task())
             runner = aiohttp.web.AppRunner(
                 app, handle_signals=True, access_log_class=AccessLogger
@@ -556,6 +1193,28 @@ class Server:
                     await task
             finally:
                 await runner.cleanup()
+                self._prefetcher.close()
+                for refresh in self._training_refreshes:
+                    refresh.cancel()
+                if self._snapshots is not None:
+                    self._snapshots.close()
+                if esilimiter is not None:
+                    await esilimiter.close()
+
+    async def _create_esilimiter(self) -> ABCESILimiter | None:
+        """
+        When several app processes run at once, each one must not believe it
+        owns the whole ESI error budget. "shm" shares the budget between
+        processes on one host, "postgres" between every host.
+        """
+        backend = self._esilimiter_backend
+        if backend == "local":
+            return None
+        if backend == "shm":
+            return SharedMemoryESILimiter("capsuleerapp-esilimiter")
+        if backend == "postgres":
+            return await self.db.esi_limiter(f"{socket.gethostname()}:{os.getpid()}")
+        raise ValueError(f"unknown ESI limiter backend {backend!r}")
 
 
 async def raiser():
@@ -599,12 +1258,16 @@ async def amain():
     else:
         setup_sentry(sentry_dsn)
 
+    hubs = config.get("market", "hubs", fallback=",".join(TRADE_HUBS))
     server = Server(
         config["http"]["base_url"],
         config["esi"]["esi_url"],
         config["esi"]["client_id"],
         config["esi"]["client_secret_key"],
         int(config["esi"]["internal_account_id"]),
+        config["esi"].get("limiter", "local"),
+        [hub.strip() for hub in hubs.split(",")],
+        config.get("market", "snapshot_directory", fallback=None),
     )
     await server.run(
         config["http"]["listen_socket"],
@@ -0,0 +1,292 @@
+import gzip
+import asyncio
+import hashlib
+import logging
+import datetime
+import collections
+from typing import Any, NamedTuple
+from collections.abc import Callable, Hashable, Awaitable, Collection
+
+import aiohttp.web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    expires: datetime.datetime
+    # When the oldest of the data was current, if any of it is stale.
+    stale_date: datetime.datetime | None = None
+
+
+def strong_etag(*parts: str) -> str:
+    "A strong ETag (quoted) derived from the given validators."
+    digest = hashlib.blake2b("\0".join(parts).encode(), digest_size=12)
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(request: aiohttp.web.Request, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, per RFC 9110 13.1.2.
+    candidates = (c.strip().removeprefix("W/") for c in if_none_match.split(","))
+    return etag in candidates
+
+
+def _accepted_codings(request: aiohttp.web.BaseRequest) -> set[str]:
+    accepted = set()
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class PrecompressedBody:
+    """
+    A response body which is encoded and compressed once, when it changes,
+    rather than for every request. Compressed with gzip and, if the brotli
+    module is installed, brotli. ETags are derived from its content, with
+    the coding appended so that each representation has its own.
+    """
+
+    __slots__ = "content_type", "_codings"
+
+    def __init__(self, body: bytes, content_type: str) -> None:
+        self.content_type = content_type
+        version = hashlib.blake2b(body, digest_size=12).hexdigest()
+        # Coding: (ETag, body), best first.
+        self._codings: dict[str, tuple[str, bytes]] = {}
+        if brotli is not None:
+            self._codings["br"] = f'"{version}-br"', brotli.compress(body, quality=11)
+        self._codings["gzip"] = f'"{version}-gzip"', gzip.compress(body, 9, mtime=0)
+        self._codings["identity"] = f'"{version}"', body
+
+    def respond(
+        self, request: aiohttp.web.BaseRequest, headers: dict[str, str]
+    ) -> aiohttp.web.Response:
+        "The best representation the client accepts, or 304 Not Modified."
+        accepted = _accepted_codings(request)
+        for coding, (etag, body) in self._codings.items():
+            if coding in accepted or coding == "identity":
+                break
+        headers["ETag"] = etag
+        headers["Vary"] = "Accept-Encoding"
+        # The client has this version if it has any representation of it.
+        if any(etag_matches(request, e) for e, _ in self._codings.values()):
+            raise aiohttp.web.HTTPNotModified(headers=headers)
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return aiohttp.web.Response(
+            body=body, content_type=self.content_type, headers=headers
+        )
+
+
+class ResponseCache:
+    """
+    Encoded response bodies, each of which is dropped once it expires. Like
+    the session cache in Database, expiry is done with timers on the loop.
+    """
+
+    __slots__ = "_loop", "_entries", "_timerhandles"
+
+    def __init__(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._entries: dict[Hashable, CachedResponse] = {}
+        self._timerhandles: dict[Hashable, asyncio.TimerHandle] = {}
+
+    def get(self, key: Hashable) -> CachedResponse | None:
+        return self._entries.get(key)
+
+    def put(
+        self, key: Hashable, body: bytes, etag: str, expires: datetime.datetime
+    ) -> CachedResponse:
+        entry = CachedResponse(body, etag, expires)
+        now = datetime.datetime.now(datetime.UTC)
+        time_until_expiry = (expires - now).total_seconds()
+        if time_until_expiry <= 0:
+            return entry
+        self.discard(key)
+        self._entries[key] = entry
+        self._timerhandles[key] = self._loop.call_later(
+            time_until_expiry, self._expire, key
+        )
+        return entry
+
+    def _expire(self, key: Hashable) -> None:
+        del self._timerhandles[key]
+        del self._entries[key]
+
+    def discard(self, key: Hashable) -> None:
+        try:
+            self._timerhandles.pop(key).cancel()
+        except KeyError:
+            return
+        del self._entries[key]
+
+    def clear(self) -> None:
+        for timerhandle in self._timerhandles.values():
+            timerhandle.cancel()
+        self._timerhandles.clear()
+        self._entries.clear()
+
+
+class VersionHistory:
+    """
+    The last few versions of each key's payload, so that a client can be
+    sent only what changed since the version it already has. A key's
+    versions are forgotten once it hasn't been updated for IDLE_TIME.
+    """
+
+    DEPTH = 4
+    IDLE_TIME = 60 * 60
+
+    __slots__ = "_loop", "_versions", "_timerhandles"
+
+    def __init__(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._versions: dict[Hashable, collections.deque[tuple[str, Any]]] = {}
+        self._timerhandles: dict[Hashable, asyncio.TimerHandle] = {}
+
+    def add(self, key: Hashable, version: str, payload: Any) -> None:
+        try:
+            versions = self._versions[key]
+        except KeyError:
+            versions = self._versions[key] = collections.deque(maxlen=self.DEPTH)
+        else:
+            self._timerhandles.pop(key).cancel()
+        if not versions or versions[-1][0] != version:
+            versions.append((version, payload))
+        self._timerhandles[key] = self._loop.call_later(
+            self.IDLE_TIME, self._forget, key
+        )
+
+    def get(self, key: Hashable, version: str) -> Any | None:
+        for candidate, payload in self._versions.get(key, ()):
+            if candidate == version:
+                return payload
+        return None
+
+    def _forget(self, key: Hashable) -> None:
+        del self._timerhandles[key]
+        del self._versions[key]
+
+    def clear(self) -> None:
+        for timerhandle in self._timerhandles.values():
+            timerhandle.cancel()
+        self._timerhandles.clear()
+        self._versions.clear()
+
+
+class Prefetcher:
+    """
+    Fetches things clients are about to ask for before they do, and fetches
+    them again as soon as they expire for as long as whoever they belong to
+    (the group, e.g. an account) stays active.
+
+    fetch(group, key) must cache its result somewhere and return when that
+    expires. At most CONCURRENCY run at a time, so that prefetching can't
+    take more than a small share of the ESI error budget. They wait for the
+    ESI limiter like any other request.
+
+    Refreshing any earlier would be pointless: ESI serves the same response
+    until it expires.
+    """
+
+    CONCURRENCY = 2
+    ACTIVE_TIME = 10 * 60
+    REFRESH_DELAY = 1
+
+    __slots__ = (
+        "_loop",
+        "_fetch",
+        "_semaphore",
+        "_active",
+        "_tasks",
+        "_started",
+        "_timerhandles",
+    )
+
+    def __init__(
+        self, fetch: Callable[[Hashable, Hashable], Awaitable[datetime.datetime]]
+    ) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._fetch = fetch
+        self._semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        # When each group was last active, in loop time.
+        self._active: dict[Hashable, float] = {}
+        self._tasks: dict[tuple[Hashable, Hashable], asyncio.Task] = {}
+        # Those of _tasks which aren't waiting for the semaphore any more.
+        self._started: set[tuple[Hashable, Hashable]] = set()
+        self._timerhandles: dict[tuple[Hashable, Hashable], asyncio.TimerHandle] = {}
+
+    def touch(self, group: Hashable, keys: Collection[Hashable] = ()) -> None:
+        "Marks group as active and starts fetching any of keys not being kept."
+        self._active[group] = self._loop.time()
+        for key in keys:
+            kept = (group, key) in self._tasks or (group, key) in self._timerhandles
+            if not kept:
+                self._start(group, key)
+
+    def claim(self, group: Hashable, key: Hashable) -> asyncio.Task | None:
+        """
+        The fetch of key in progress, if any, so that it can be awaited.
+        One still waiting its turn could keep the caller waiting for every
+        other prefetch, so it is cancelled instead: the caller is to fetch
+        key itself.
+        """
+        task = self._tasks.get((group, key))
+        if task is None or (group, key) in self._started:
+            return task
+        task.cancel()
+        return None
+
+    def _start(self, group: Hashable, key: Hashable) -> None:
+        self._tasks[group, key] = self._loop.create_task(
+            self._run(group, key), name=f"prefetch-{group}-{key}"
+        )
+
+    async def _run(self, group: Hashable, key: Hashable) -> None:
+        try:
+            async with self._semaphore:
+                self._started.add((group, key))
+                expires = await self._fetch(group, key)
+        except Exception:
+            logger.warning("prefetching %r for %r failed", key, group, exc_info=True)
+            return
+        finally:
+            del self._tasks[group, key]
+            self._started.discard((group, key))
+        now = datetime.datetime.now(datetime.UTC)
+        delay = (expires - now).total_seconds() + self.REFRESH_DELAY
+        self._timerhandles[group, key] = self._loop.call_later(
+            max(delay, self.REFRESH_DELAY), self._refresh, group, key
+        )
+
+    def _refresh(self, group: Hashable, key: Hashable) -> None:
+        del self._timerhandles[group, key]
+        last_active = self._active.get(group)
+        if last_active is None:
+            return
+        if self._loop.time() - last_active < self.ACTIVE_TIME:
+            self._start(group, key)
+        else:
+            # Its other keys will find it inactive too.
+            del self._active[group]
+
+    def close(self) -> None:
+        for timerhandle in self._timerhandles.values():
+            timerhandle.cancel()
+        self._timerhandles.clear()
+        for task in self._tasks.values():
+            task.cancel()
+        self._active.clear()
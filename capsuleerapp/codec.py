@@ -0,0 +1,126 @@
+"""
+JSON and MessagePack encoding and decoding for everything capsuleerapp
+sends or receives.
+
+JSON goes through msgspec or orjson when one of them is installed, falling
+back to the standard library. With msgspec, ESI responses with a known
+schema (see the TypedDicts in types.py) are decoded and validated straight
+from bytes.
+
+Clients get JSON unless their Accept header explicitly asks for
+MessagePack, which is about half the size of our positional-tuple JSON and
+several times faster to encode. See offline/bench_codec.py for numbers.
+"""
+
+import json
+import logging
+import functools
+from typing import Any, NamedTuple
+from collections.abc import Callable
+
+import aiohttp.web
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_CONTENT_TYPE = "application/vnd.msgpack"
+
+
+def _orjson_default(obj: Any) -> Any:
+    # orjson refuses tuple subclasses, such as our NamedTuples.
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+if msgspec is not None:
+    JSON_BACKEND = "msgspec"
+    dumpb: Callable[[Any], bytes] = msgspec.json.Encoder().encode
+    _untyped_decoder = msgspec.json.Decoder()
+    _loads = _untyped_decoder.decode
+elif orjson is not None:
+    JSON_BACKEND = "orjson"
+    dumpb = functools.partial(orjson.dumps, default=_orjson_default)
+    _loads = orjson.loads
+else:
+    JSON_BACKEND = "json"
+    _dumps = functools.partial(json.dumps, separators=(",", ":"))
+
+    def dumpb(obj: Any) -> bytes:
+        return _dumps(obj).encode()
+
+    _loads = json.loads
+
+
+def dumps(obj: Any) -> str:
+    "Compact JSON, as a string."
+    return dumpb(obj).decode()
+
+
+@functools.cache
+def _typed_decoder(schema: Any):
+    return msgspec.json.Decoder(schema)
+
+
+def loads(data: bytes, schema: Any = None) -> Any:
+    """
+    Decode JSON. If msgspec is installed, data is validated against schema
+    (e.g. a TypedDict). Data which doesn't match it is still returned, but
+    decoded without validation, so an ESI schema change can't take us down.
+    """
+    if schema is None or msgspec is None:
+        return _loads(data)
+    try:
+        return _typed_decoder(schema).decode(data)
+    except msgspec.ValidationError as exc:
+        logger.warning("response doesn't match %r: %s", schema, exc)
+        return _loads(data)
+
+
+class Encoder(NamedTuple):
+    content_type: str
+    encode: Callable[[Any], bytes]
+
+
+JSON = Encoder("application/json", dumpb)
+# A pure-Python encoder would be several times slower than JSON, so
+# MessagePack is only offered when the msgpack module is installed.
+MSGPACK = None if msgpack is None else Encoder(MSGPACK_CONTENT_TYPE, msgpack.packb)
+
+
+def negotiate(request: aiohttp.web.BaseRequest) -> Encoder:
+    "MessagePack if the client explicitly accepts it, otherwise JSON."
+    if MSGPACK is not None:
+        accept = request.headers.get("Accept", "")
+        if MSGPACK_CONTENT_TYPE in accept:
+            return MSGPACK
+    return JSON
+
+
+def encoded_response(
+    request: aiohttp.web.BaseRequest,
+    payload: Any,
+    headers: dict[str, str] | None = None,
+) -> aiohttp.web.Response:
+    encoder = negotiate(request)
+    headers = {} if headers is None else headers
+    headers["Vary"] = "Accept"
+    return aiohttp.web.Response(
+        body=encoder.encode(payload),
+        content_type=encoder.content_type,
+        headers=headers,
+    )
@@ -1,352 +1,24 @@
-forge_npc_station_ids = frozenset(
+# These were forbidden the first time I looked up Jita prices. Until they
+# have been asked again, they are assumed to still be.
+known_forbidden_citadel_ids = frozenset(
     {
-        60000274,
-        60000277,
-        60000280,
-        60000283,
-        60000286,
-        60000289,
-        60000292,
-        60000295,
-        60000298,
-        60000301,
-        60000304,
-        60000307,
-        60000358,
-        60000361,
-        60000364,
-        60000367,
-        60000385,
-        60000388,
-        60000394,
-        60000397,
-        60000400,
-        60000403,
-        60000448,
-        60000451,
-        60000454,
-        60000457,
-        60000460,
-        60000463,
-        60000484,
-        60000493,
-        60000496,
-        60000499,
-        60000502,
-        60000505,
-        60000508,
-        60000511,
-        60000514,
-        60000517,
-        60000520,
-        60000523,
-        60000526,
-        60000529,
-        60000532,
-        60000535,
-        60000574,
-        60000577,
-        60000580,
-        60000589,
-        60000646,
-        60000649,
-        60000652,
-        60000655,
-        60000682,
-        60000685,
-        60000688,
-        60000691,
-        60000784,
-        60000787,
-        60000790,
-        60000868,
-        60000871,
-        60000874,
-        60000877,
-        60000904,
-        60000907,
-        60000910,
-        60000913,
-        60000916,
-        60000919,
-        60000922,
-        60000925,
-        60000964,
-        60000967,
-        60000973,
-        60001480,
-        60001483,
-        60001486,
-        60001537,
-        60001540,
-        60001543,
-        60001546,
-        60001585,
-        60001588,
-        60001591,
-        60001594,
-        60001621,
-        60001624,
-        60001627,
-        60001630,
-        60001633,
-        60001636,
-        60001639,
-        60001642,
-        60001645,
-        60001648,
-        60001651,
-        60001654,
-        60001783,
-        60001786,
-        60001795,
-        60001798,
-        60001801,
-        60001804,
-        60001807,
-        60001810,
-        60001825,
-        60001828,
-        60001831,
-        60001834,
-        60001873,
-        60001876,
-        60001879,
-        60001882,
-        60002047,
-        60002050,
-        60002059,
-        60002062,
-        60002233,
-        60002236,
-        60002239,
-        60002269,
-        60002272,
-        60002275,
-        60002278,
-        60002281,
-        60002284,
-        60002287,
-        60002290,
-        60002353,
-        60002356,
-        60002359,
-        60002362,
-        60002374,
-        60002377,
-        60002422,
-        60002425,
-        60002428,
-        60002431,
-        60002437,
-        60002440,
-        60002443,
-        60002734,
-        60002737,
-        60002740,
-        60002743,
-        60002746,
-        60002749,
-        60002806,
-        60002809,
-        60002812,
-        60002815,
-        60002818,
-        60002821,
-        60002842,
-        60002845,
-        60002848,
-        60002851,
-        60002854,
-        60002857,
-        60002950,
-        60002953,
-        60002956,
-        60002959,
-        60002998,
-        60003001,
-        60003004,
-        60003007,
-        60003040,
-        60003043,
-        60003046,
-        60003049,
-        60003052,
-        60003055,
-        60003058,
-        60003061,
-        60003064,
-        60003067,
-        60003070,
-        60003073,
-        60003076,
-        60003079,
-        60003082,
-        60003085,
-        60003106,
-        60003109,
-        60003112,
-        60003136,
-        60003139,
-        60003142,
-        60003145,
-        60003148,
-        60003151,
-        60003172,
-        60003175,
-        60003178,
-        60003181,
-        60003190,
-        60003193,
-        60003208,
-        60003211,
-        60003226,
-        60003229,
-        60003238,
-        60003241,
-        60003244,
-        60003247,
-        60003334,
-        60003337,
-        60003346,
-        60003349,
-        60003364,
-        60003367,
-        60003394,
-        60003397,
-        60003454,
-        60003457,
-        60003460,
-        60003463,
-        60003466,
-        60003469,
-        60003670,
-        60003673,
-        60003676,
-        60003679,
-        60003682,
-        60003685,
-        60003724,
-        60003730,
-        60003751,
-        60003754,
-        60003757,
-        60003760,
-        60003763,
-        60003766,
-        60003769,
-        60003934,
-        60003937,
-        60004048,
-        60004051,
-        60004054,
-        60004057,
-        60004060,
-        60004063,
-        60004066,
-        60004069,
-        60004072,
-        60004075,
-        60004078,
-        60004081,
-        60004210,
-        60004213,
-        60004216,
-        60004219,
-        60004222,
-        60004225,
-        60004228,
-        60004231,
-        60004234,
-        60004237,
-        60004240,
-        60004243,
-        60004360,
-        60004363,
-        60004366,
-        60004369,
-        60004372,
-        60004375,
-        60004378,
-        60004381,
-        60004423,
-        60004426,
-        60004435,
-        60004444,
-        60004459,
-        60004462,
-        60004465,
-        60004468,
-        60004474,
-        60005449,
-        60005452,
-        60005455,
-        60005458,
-        60005461,
-        60005464,
-        60005593,
-        60005596,
-        60005599,
-        60005602,
-        60005605,
-        60005608,
-        60006424,
-        60006427,
-        60006430,
-        60006433,
-        60006853,
-        60006856,
-        60006859,
-        60006880,
-        60006883,
-        60006886,
-        60007495,
-        60007498,
-        60007501,
-        60007504,
-        60007507,
-        60007510,
-        60007585,
-        60007588,
-        60007591,
-        60007594,
-        60010192,
-        60010195,
-        60010198,
-        60010201,
-        60010456,
-        60010459,
-        60010816,
-        60010819,
-        60010822,
-        60012310,
-        60012313,
-        60012316,
-        60012319,
-        60012322,
-        60012325,
-        60012667,
-        60012670,
-        60012673,
-        60012712,
-        60012715,
-        60012718,
-        60013042,
-        60013045,
-        60013048,
-        60013141,
-        60013144,
-        60013147,
-        60013150,
-        60013288,
-        60013291,
-        60014659,
-        60014686,
-        60014935,
-        60015002,
-        60015027,
-        60015157,
-        60015169,
+        1_029_949_899_294,
+        1_029_898_792_553,
+        1_026_199_596_235,
+        1_029_757_417_883,
+        1_029_792_736_908,
+        1_029_719_938_968,
+        1_022_179_194_562,
+        1_022_719_559_274,
+        1_026_221_929_523,
+        1_028_370_750_672,
+        1_028_858_195_912,
+        1_029_036_975_486,
+        1_029_209_158_478,
+        1_030_524_644_061,
+        1_032_792_278_341,
+        1_033_110_865_110,
+        1_041_701_800_198,
     }
 )
 
@@ -1,10 +1,23 @@
+import json
+import uuid
 import asyncio
 import logging
+import datetime
 import collections
 
 import asyncpg
 
-from .types import Character, ABCSession, AccessToken, NoSuchCharacter
+from .types import (
+    Character,
+    ABCSession,
+    AccessToken,
+    ABCESILimiter,
+    NoSuchCharacter,
+    CitadelRegistry,
+    ForbiddenCitadels,
+    StoredSkillTrades,
+    is_esi_server_error,
+)
 from typing import Any
 
 logger = logging.getLogger(__name__)
@@ -14,14 +27,18 @@ class DatabaseSession(ABCSession):
     __slots__ = (
         "_pool",
         "_conn",
+        "_node",
         "_account_id",
         "_character_id",
         "_character",
         "_access_token",
     )
 
-    def __init__(self, pool: asyncpg.Pool, account_id: int, character_id: int):
+    def __init__(
+        self, pool: asyncpg.Pool, node: str, account_id: int, character_id: int
+    ):
         self._pool = pool
+        self._node = node
         self._account_id = account_id
         self._character_id = character_id
 
@@ -54,7 +71,7 @@ class DatabaseSession(ABCSession):
         """
         Called with the result of attempting to use the refresh token.
         """
-        async with self._pool.acquire() as conn:
+        async with self._pool.acquire() as conn, conn.transaction():
             if new_token is None:
                 result = await conn.execute(
                     "UPDATE character SET "
@@ -74,6 +91,9 @@ class DatabaseSession(ABCSession):
                 )
             if result != "UPDATE 1":
                 raise Exception(result)
+            await _notify_session_change(
+                conn, self._node, self._account_id, self._character_id
+            )
         self._access_token = new_token
 
     @property
@@ -81,20 +101,282 @@ class DatabaseSession(ABCSession):
         return self._character
 
 
+# Every node publishes changes to characters' tokens on this channel, so that
+# the other nodes' session caches don't keep using stale tokens.
+SESSION_CHANNEL = "character_session"
+
+
+async def _notify_session_change(
+    conn: asyncpg.Connection, node: str, account_id: int | None, character_id: int
+) -> None:
+    """
+    Delivered to listeners when the surrounding transaction commits. An
+    account_id of None means the character was deleted. Tokens are never
+    sent, as anything connected to the database can listen; listeners
+    reload the character's row instead.
+    """
+    message = {"node": node, "account_id": account_id, "character_id": character_id}
+    payload = json.dumps(message, separators=(",", ":"))
+    await conn.execute("SELECT pg_notify($1, $2)", SESSION_CHANNEL, payload)
+
+
+class PostgresESILimiter(ABCESILimiter):
+    """
+    An ESILimiter whose budget lives in Postgres, so that app servers on
+    several hosts draw from one ESI error budget. Acquisitions are
+    serialized cluster-wide by an advisory lock taken inside
+    esi_limiter_acquire().
+
+    Nodes that stop heartbeating (e.g. because they crashed) no longer
+    count against the budget.
+    """
+
+    HEARTBEAT_INTERVAL = 10
+    # Releases made by other nodes don't wake our waiters, so they poll.
+    POLL_INTERVAL = 0.25
+
+    __slots__ = (
+        "_pool",
+        "_node",
+        "_loop",
+        "_waiters",
+        "_published",
+        "_tasks",
+        "_heartbeat_task",
+    )
+
+    def __init__(self, pool: asyncpg.Pool, node: str) -> None:
+        self._pool = pool
+        self._node = node
+        self._loop = asyncio.get_running_loop()
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._published: int | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._heartbeat_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO esi_error_budget DEFAULT VALUES ON CONFLICT DO NOTHING"
+            )
+            await conn.execute(
+                "INSERT INTO esi_limiter_node (node) VALUES ($1) "
+                "ON CONFLICT (node) DO UPDATE SET occupancy=0, heartbeat=now()",
+                self._node,
+            )
+        self._heartbeat_task = self._loop.create_task(self._heartbeat())
+
+    async def close(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        async with self._pool.acquire() as conn:
+            await conn.execute("DELETE FROM esi_limiter_node WHERE node=$1", self._node)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            try:
+                async with self._pool.acquire() as conn:
+                    await conn.execute(
+                        "UPDATE esi_limiter_node SET heartbeat=now() WHERE node=$1",
+                        self._node,
+                    )
+            except Exception:
+                logger.exception("ESI limiter heartbeat failed")
+
+    def _wake_waiters(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def __aenter__(self) -> None:
+        while True:
+            async with self._pool.acquire() as conn:
+                if await conn.fetchval("SELECT esi_limiter_acquire($1)", self._node):
+                    return
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                async with asyncio.timeout(self.POLL_INTERVAL):
+                    await waiter
+            except TimeoutError:
+                pass
+
+    async def acquire_nowait(self) -> bool:
+        if self._waiters:
+            return False
+        async with self._pool.acquire() as conn:
+            return await conn.fetchval("SELECT esi_limiter_acquire($1)", self._node)
+
+    async def _release(self, errored: bool) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "SELECT esi_limiter_release($1, $2)", self._node, errored
+            )
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        errored = is_esi_server_error(exc)
+        if errored:
+            logger.info("ESI ERROR LIMIT: decremented (from 5xx error)")
+        # A cancelled release would leak budget until our heartbeat stops.
+        await asyncio.shield(self._release(errored))
+        self._wake_waiters()
+
+    def set_remaining(
+        self,
+        response_dt: datetime.datetime,
+        remaining: int,
+        timeout: float | None = None,
+    ) -> None:
+        assert response_dt.tzinfo
+        # Avoid a database write for every single ESI response.
+        if remaining == self._published:
+            return
+        logger.info(
+            "ESI ERROR LIMIT: %r -> %d (from upstream)", self._published, remaining
+        )
+        self._published = remaining
+        task = self._loop.create_task(
+            self._set_remaining(response_dt, remaining, timeout)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _set_remaining(
+        self, response_dt: datetime.datetime, remaining: int, timeout: float | None
+    ) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE esi_error_budget SET "
+                "remaining=$1, response_time=$2, "
+                "reset_at=COALESCE(now() + make_interval(secs => $3), reset_at) "
+                "WHERE response_time <= $2",
+                remaining,
+                response_dt,
+                timeout,
+            )
+        self._wake_waiters()
+
+
+class PostgresForbiddenCitadels(ForbiddenCitadels):
+    "A ForbiddenCitadels registry kept in Postgres, so restarts are free."
+
+    __slots__ = ("_pool",)
+
+    def __init__(self, pool: asyncpg.Pool, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._pool = pool
+
+    async def _store(self, structure_id, failures, probe, next_probe) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO forbidden_citadel "
+                "(structure_id, failures, last_probe, next_probe) "
+                "VALUES ($1, $2, $3, $4) "
+                "ON CONFLICT (structure_id) DO UPDATE SET "
+                "failures=EXCLUDED.failures, last_probe=EXCLUDED.last_probe, "
+                "next_probe=EXCLUDED.next_probe",
+                structure_id,
+                failures,
+                probe,
+                next_probe,
+            )
+
+    async def _forget(self, structure_id) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM forbidden_citadel WHERE structure_id=$1", structure_id
+            )
+
+
+class PostgresCitadelRegistry(CitadelRegistry):
+    "A CitadelRegistry kept in Postgres, so restarts don't need a region scan."
+
+    __slots__ = ("_pool",)
+
+    def __init__(self, pool: asyncpg.Pool, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._pool = pool
+
+    async def _store(self, region_id, structure_ids, seen) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO market_citadel (structure_id, region_id, last_seen) "
+                "VALUES ($1, $2, $3) "
+                "ON CONFLICT (structure_id) DO UPDATE SET "
+                "region_id=EXCLUDED.region_id, last_seen=EXCLUDED.last_seen",
+                [(structure_id, region_id, seen) for structure_id in structure_ids],
+            )
+
+
+class Leadership:
+    """
+    A session-level advisory lock, held on a connection checked out of the
+    pool for as long as this node leads. If the node dies, Postgres drops
+    the connection and the lock with it, so another node can take over.
+    """
+
+    __slots__ = "_pool", "_conn", "_name"
+
+    def __init__(
+        self, pool: asyncpg.Pool, conn: asyncpg.pool.PoolConnectionProxy, name: str
+    ) -> None:
+        self._pool = pool
+        self._conn = conn
+        self._name = name
+
+    async def is_held(self) -> bool:
+        if self._conn.is_closed():
+            return False
+        try:
+            await self._conn.fetchval("SELECT 1")
+        except (asyncpg.PostgresError, OSError):
+            logger.warning("leadership connection for %r broke", self._name)
+            return False
+        return True
+
+    async def release(self) -> None:
+        # The pool's reset query unlocks every advisory lock on release.
+        await self._pool.release(self._conn)
+
+
 class Database:
     """
     If several requests come in simultaneously for the same user to the same
     app-server, we will reuse their session object instead of create a new one.
+
+    Token changes are published on SESSION_CHANNEL, and every other app-server
+    drops the character's cached sessions, so several of them can run at once
+    without using stale tokens.
     """
 
     # How long to wait before purging an unused session.
     SESSION_CACHE_TIME = 300
+    # How long to wait before reconnecting a broken notification listener.
+    LISTEN_RETRY_TIME = 5
 
-    __slots__ = "_connargs", "_cache", "_pool", "_loop", "_locks", "_timerhandles"
+    __slots__ = (
+        "_connargs",
+        "_cache",
+        "_pool",
+        "_loop",
+        "_locks",
+        "_timerhandles",
+        "_node",
+        "_listener",
+        "_listen_task",
+    )
 
     def __init__(self, **kwargs: Any) -> None:
         self._connargs = kwargs
         self._loop = asyncio.get_running_loop()
+        # Identifies our own notifications, so we don't apply them twice.
+        self._node = uuid.uuid4().hex
+        self._listener: asyncpg.pool.PoolConnectionProxy | None = None
+        self._listen_task: asyncio.Task | None = None
         # The locks protect multiple simultaneous accesses to the session cache.
         self._locks: collections.defaultdict[tuple[int, int], asyncio.Lock] = (
             collections.defaultdict(asyncio.Lock)
@@ -109,6 +391,11 @@ class Database:
         return self
 
     async def __aexit__(self, a, b, c):
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+        if self._listener is not None:
+            await self._pool.release(self._listener)
+            self._listener = None
         await self._pool.close()
         for timerhandle in self._timerhandles.values():
             timerhandle.cancel()
@@ -117,6 +404,58 @@ class Database:
 
     async def connect(self) -> None:
         self._pool = await asyncpg.create_pool(**self._connargs)
+        await self._listen()
+
+    async def _listen(self) -> None:
+        listener = await self._pool.acquire()
+        try:
+            await listener.add_listener(SESSION_CHANNEL, self._on_session_change)
+        except BaseException:
+            await self._pool.release(listener)
+            raise
+        listener.add_termination_listener(self._on_listener_terminated)
+        self._listener = listener
+
+    def _on_listener_terminated(self, conn: asyncpg.Connection) -> None:
+        # We can't know what we missed, so forget everything.
+        logger.warning("session notification listener disconnected")
+        for key in list(self._cache):
+            self._evict(key)
+        if self._listen_task is None:
+            self._listen_task = self._loop.create_task(self._relisten())
+
+    async def _relisten(self) -> None:
+        try:
+            if self._listener is not None:
+                listener, self._listener = self._listener, None
+                await self._pool.release(listener)
+            while True:
+                await asyncio.sleep(self.LISTEN_RETRY_TIME)
+                try:
+                    await self._listen()
+                except (asyncpg.PostgresError, OSError):
+                    logger.warning("session notification listener failed to connect")
+                else:
+                    logger.info("session notification listener reconnected")
+                    return
+        finally:
+            self._listen_task = None
+
+    def _on_session_change(
+        self, conn: asyncpg.Connection, pid: int, channel: str, payload: str
+    ) -> None:
+        message = json.loads(payload)
+        if message["node"] == self._node:
+            return
+        # The next request for the character reads its row again, whichever
+        # account it now belongs to, if any.
+        for key in [k for k in self._cache if k[1] == message["character_id"]]:
+            self._evict(key)
+
+    def _evict(self, key: tuple[int, int]) -> None:
+        logger.debug("evicting session: account=%d character=%d", *key)
+        self._timerhandles.pop(key).cancel()
+        del self._cache[key]
 
     def _clear(
         self,
@@ -152,10 +491,155 @@ class Database:
             return session
 
     async def _get_session(self, account_id: int, character_id: int) -> DatabaseSession:
-        new_session = DatabaseSession(self._pool, account_id, character_id)
+        new_session = DatabaseSession(self._pool, self._node, account_id, character_id)
         await new_session.initialize()
         return new_session
 
+    async def try_acquire_leadership(self, name: str) -> Leadership | None:
+        "Returns None if another node already leads."
+        conn = await self._pool.acquire()
+        try:
+            acquired = await conn.fetchval(
+                "SELECT pg_try_advisory_lock(hashtext($1))", name
+            )
+        except BaseException:
+            await self._pool.release(conn)
+            raise
+        if not acquired:
+            await self._pool.release(conn)
+            return None
+        return Leadership(self._pool, conn, name)
+
+    async def get_skill_trades(self) -> StoredSkillTrades | None:
+        async with self._pool.acquire() as conn:
+            record = await conn.fetchrow(
+                "SELECT data, update_time, expires FROM skill_trades"
+            )
+        if record is None:
+            return None
+        return StoredSkillTrades(*record)
+
+    async def set_skill_trades(
+        self, data: str, expires: datetime.datetime
+    ) -> datetime.datetime:
+        "Returns the update time of the stored skill trades."
+        async with self._pool.acquire() as conn:
+            return await conn.fetchval(
+                "INSERT INTO skill_trades (data, expires) VALUES ($1, $2) "
+                "ON CONFLICT (id) DO UPDATE SET "
+                "data=EXCLUDED.data, update_time=now(), expires=EXCLUDED.expires "
+                "RETURNING update_time",
+                data,
+                expires,
+            )
+
+    async def get_wallet_journal_high_water(self, character_id: int) -> int | None:
+        "The id of the newest stored journal entry."
+        async with self._pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT max(id) FROM wallet_journal WHERE character_id=$1",
+                character_id,
+            )
+
+    async def add_wallet_journal(
+        self,
+        character_id: int,
+        entries: list[tuple[int, int, str, float, float, str]],
+    ) -> None:
+        """
+        entries are (id, date, ref_type, amount, balance, description), with
+        dates in seconds since the epoch. They are COPYed in bulk; ones which
+        are already stored are ignored.
+        """
+        async with self._pool.acquire() as conn, conn.transaction():
+            await conn.execute(
+                "CREATE TEMPORARY TABLE wallet_journal_import "
+                "(LIKE wallet_journal) ON COMMIT DROP; "
+                "ALTER TABLE wallet_journal_import ALTER date TYPE bigint "
+                "USING 0"
+            )
+            await conn.copy_records_to_table(
+                "wallet_journal_import",
+                records=[(character_id, *entry) for entry in entries],
+                columns=(
+                    "character_id",
+                    "id",
+                    "date",
+                    "ref_type",
+                    "amount",
+                    "balance",
+                    "description",
+                ),
+            )
+            await conn.execute(
+                "INSERT INTO wallet_journal "
+                "SELECT character_id, id, to_timestamp(date), ref_type, amount, "
+                "balance, description FROM wallet_journal_import "
+                "ON CONFLICT DO NOTHING"
+            )
+
+    async def get_wallet_journal(
+        self, character_id: int, before: int | None, limit: int
+    ) -> list[asyncpg.Record]:
+        """
+        Non-zero journal entries older than before, newest first, with dates
+        in seconds since the epoch.
+        """
+        async with self._pool.acquire() as conn:
+            return await conn.fetch(
+                "SELECT id, extract(epoch FROM date)::bigint AS date, amount, "
+                "balance, description "
+                "FROM wallet_journal "
+                "WHERE character_id=$1 AND amount <> 0 "
+                "AND ($2::bigint IS NULL OR id < $2) "
+                "ORDER BY id DESC LIMIT $3",
+                character_id,
+                before,
+                limit,
+            )
+
+    async def get_wallet_journal_columns(
+        self, character_ids: list[int], since: datetime.datetime
+    ) -> tuple[list[int], list[str], list[float]]:
+        """
+        The dates (in seconds since the epoch), ref_types and amounts of the
+        characters' non-zero journal entries since the given time.
+        """
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT array_agg(extract(epoch FROM date)::bigint), "
+                "array_agg(ref_type), array_agg(amount) "
+                "FROM wallet_journal "
+                "WHERE character_id = any($1::bigint[]) AND date >= $2 "
+                "AND amount <> 0",
+                character_ids,
+                since,
+            )
+        return row[0] or [], row[1] or [], row[2] or []
+
+    async def forbidden_citadels(self) -> PostgresForbiddenCitadels:
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT structure_id, failures, next_probe FROM forbidden_citadel"
+            )
+        return PostgresForbiddenCitadels.seeded(self._pool, rows)
+
+    async def citadel_registry(self) -> PostgresCitadelRegistry:
+        "Citadels seen trading within CitadelRegistry.FORGET_AFTER."
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT structure_id, region_id, last_seen FROM market_citadel "
+                "WHERE last_seen > now() - $1::interval",
+                CitadelRegistry.FORGET_AFTER,
+            )
+        return PostgresCitadelRegistry(self._pool, rows)
+
+    async def esi_limiter(self, node: str) -> PostgresESILimiter:
+        "Returns an ESI limiter sharing its budget with every other node."
+        limiter = PostgresESILimiter(self._pool, node)
+        await limiter.start()
+        return limiter
+
     @staticmethod
     async def _insert_character(
         conn: asyncpg.Connection,
@@ -223,6 +707,11 @@ class Database:
                 )
                 if record != "DELETE 1":
                     raise Exception(record)
+                await _notify_session_change(conn, self._node, None, character_id)
+        try:
+            self._evict((account_id, character_id))
+        except KeyError:
+            pass
 
     async def character_authorized(
         self,
@@ -289,6 +778,7 @@ class Database:
                 )
                 if record != "UPDATE 1":
                     raise Exception(record)
+                await _notify_session_change(conn, self._node, account_id, character.id)
 
             try:
                 character_session = self._cache[(account_id, character.id)]
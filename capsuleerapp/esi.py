@@ -4,19 +4,33 @@ import random
 import asyncio
 import logging
 import datetime
-import functools
+import collections
+from typing import Any
+from collections.abc import Hashable
 
 import aiohttp
 
-from .data import forge_npc_station_ids
+from .codec import loads
 from .types import (
+    ESISkills,
     Response,
     Character,
     ABCSession,
     ESILimiter,
     AccessToken,
+    ESIAttributes,
+    ABCESILimiter,
+    ESIMarketOrder,
+    RouteLatency,
+    AcquiredBudget,
+    CircuitBreaker,
+    ESIUnavailable,
+    CitadelRegistry,
+    ForbiddenCitadels,
     RefreshTokenError,
+    ESISkillQueueItem,
     CharacterNeedsUpdated,
+    ESIWalletJournalEntry,
 )
 
 logger = logging.getLogger(__name__)
@@ -60,26 +74,38 @@ RETRY_ERROR_STATUSES = frozenset({502, 503, 504})
 
 
 async def request_with_retry(
-    esilimiter: ESILimiter,
+    esilimiter: ABCESILimiter,
     session: aiohttp.ClientSession,
     url: str,
     headers: dict[str, str],
     params: dict[str, str] | None,
+    schema: Any = None,
+    breaker: CircuitBreaker | None = None,
+    latency: RouteLatency | None = None,
 ) -> Response:
     """
     The ESI API will sometimes fail for no particular reason. When this
     happens, retry the request again. We wait before retrying in order
-    to avoid contributing to a flood situation.
+    to avoid contributing to a flood situation. If the route's breaker
+    opens, it's an outage rather than a blip, and we give up at once.
+
+    Given the route's latency, a request which hasn't been answered by the
+    time 95% of them are is hedged: it's sent again if the limiter has
+    budget to spare right now, and whichever answers first wins. Every ESI
+    request we make is a GET, so sending one twice is harmless.
     """
 
-    async def request():
-        async with esilimiter:
+    async def request(acquired=False):
+        "A request, within the budget, already taken from it if acquired."
+        async with AcquiredBudget(esilimiter) if acquired else esilimiter:
             async with session.get(url, headers=headers, params=params) as resp:
                 if resp.status in RETRY_ERROR_STATUSES:
                     resp.raise_for_status()
+                if resp.status == 304:
+                    return Response(None, resp)
 
                 try:
-                    res = await resp.json()
+                    res = loads(await resp.read(), schema)
                 except Exception:
                     # Attempt to raise a double-stacktrace.
                     resp.raise_for_status()
@@ -92,12 +118,68 @@ async def request_with_retry(
 
                 return Response(res, resp)
 
+    async def reported_request(acquired=False):
+        "A request which tells the breaker whether ESI answered it."
+        if breaker is None:
+            return await request(acquired)
+        try:
+            resp = await request(acquired)
+        except aiohttp.ClientResponseError as exc:
+            if exc.status in RETRY_ERROR_STATUSES:
+                breaker.failure()
+            else:
+                breaker.success()
+            raise
+        except (aiohttp.ClientConnectionError, TimeoutError):
+            breaker.failure()
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        breaker.success()
+        return resp
+
+    def tripped():
+        return breaker is not None and breaker.is_open
+
+    async def hedged_request():
+        if latency is None:
+            return await reported_request()
+        # From the first request's start until either answers, so that the
+        # slow requests which are hedged, and then given up on, still count.
+        start = time.monotonic()
+        resp = await race(None if tripped() else latency.p95())
+        latency.record(time.monotonic() - start)
+        return resp
+
+    async def race(hedge_after):
+        "A request, and another if it hasn't answered after hedge_after."
+        if hedge_after is None:
+            return await reported_request()
+        pending = {asyncio.create_task(reported_request())}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not done and await esilimiter.acquire_nowait():
+                logger.info("GET %s is taking over %.2fs, hedging", url, hedge_after)
+                pending.add(asyncio.create_task(reported_request(acquired=True)))
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                answered = [task for task in done if task.exception() is None]
+                if answered or not pending:
+                    # If neither answered, the last one's error is as good as any.
+                    return (answered or list(done))[0].result()
+        finally:
+            for task in pending:
+                task.cancel()
+
     for attempt in range(3):
         sleep_length = attempt + random.uniform(0.5, 1.5)
         try:
-            return await request()
+            return await hedged_request()
         except aiohttp.ClientResponseError as exc:
-            if exc.status not in RETRY_ERROR_STATUSES:
+            if exc.status not in RETRY_ERROR_STATUSES or tripped():
                 raise
             logger.warning(
                 "GET %s hit %d, sleeping for %d and trying again",
@@ -106,6 +188,8 @@ async def request_with_retry(
                 sleep_length,
             )
         except aiohttp.ServerDisconnectedError:
+            if tripped():
+                raise
             logger.warning(
                 "GET %s encountered server disconnect, sleeping for %d and trying again",
                 url,
@@ -115,7 +199,7 @@ async def request_with_retry(
         await asyncio.sleep(sleep_length)
 
     # For the last attempt, don't use try..except.
-    return await request()
+    return await hedged_request()
 
 
 def _esi(
@@ -124,7 +208,15 @@ def _esi(
     name: str,
     session_type: SessionType = SessionType.none,
     accepts_params: bool = False,
+    schema: Any = None,
+    hedge: bool = False,
+    stale: bool = False,
 ):
+    """
+    A binding of an ESI route. Routes which people are waiting on should
+    hedge; see request_with_retry. Routes with stale keep their last good
+    response to each request, to serve while their circuit breaker is open.
+    """
     if accepts_params is not True and accepts_params is not False:
         raise TypeError("accepts_params must be a boolean")
     if type(version) is not int:
@@ -137,7 +229,10 @@ def _esi(
         accepted_arg_count += 1  # takes a hidden session argument
 
     async def inner(
-        self: "PublicESISession", *args, params: dict[str, str] | None = None
+        self: "PublicESISession",
+        *args,
+        params: dict[str, str] | None = None,
+        etag: str | None = None,
     ) -> Response:
         if accepts_params is False and params is not None:
             raise ValueError(f"{name} does not accept parameters")
@@ -155,19 +250,61 @@ def _esi(
             if session_type is SessionType.character:
                 args = session.character.id, *args
 
+        if etag is not None:
+            # The response is a 304 with no result if it's unchanged.
+            headers["If-None-Match"] = etag
+
         url = self._esi_url + url_format_func(*args)
-        resp = await request_with_retry(
-            self._esilimiter, self._session, url, headers, params
-        )
-        try:
-            remaining = int(resp.headers["X-ESI-Error-Limit-Remain"])
-            timeout = int(resp.headers["X-ESI-Error-Limit-Reset"])
-            self._esilimiter.set_remaining(resp.date, remaining - 1, timeout + 0.5)
-        except Exception:
-            logger.warning(
-                "Ignoring error parsing X-ESI-Error-Limit-Remain", exc_info=True
+        key = url, None if params is None else tuple(sorted(params.items()))
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name)
+        latency = None
+        if hedge:
+            latency = self._latencies.get(name)
+            if latency is None:
+                latency = self._latencies[name] = RouteLatency()
+
+        async def request() -> Response:
+            resp = await request_with_retry(
+                self._esilimiter,
+                self._session,
+                url,
+                headers,
+                params,
+                schema,
+                breaker,
+                latency,
             )
-        return resp
+            try:
+                remaining = int(resp.headers["X-ESI-Error-Limit-Remain"])
+                timeout = int(resp.headers["X-ESI-Error-Limit-Reset"])
+                self._esilimiter.set_remaining(resp.date, remaining - 1, timeout + 0.5)
+            except Exception:
+                logger.warning(
+                    "Ignoring error parsing X-ESI-Error-Limit-Remain", exc_info=True
+                )
+            # Conditional requests are the caller's own cache; they have no
+            # use for ours.
+            if stale and etag is None:
+                self._remember(key, resp)
+            return resp
+
+        last_good = None
+        if stale and etag is None:
+            last_good = self._last_good.get(key)
+        if not breaker.allow():
+            if last_good is None:
+                raise ESIUnavailable(name, breaker.retry_after())
+            return last_good.as_stale()
+        if breaker.is_open and last_good is not None:
+            # This request is to find out whether the route has recovered.
+            # Nobody needs to wait for it to find out.
+            task = asyncio.create_task(request())
+            self._revalidations.add(task)
+            task.add_done_callback(self._revalidated)
+            return last_good.as_stale()
+        return await request()
 
     inner.__name__ = name
     if session_type is not SessionType.none:
@@ -179,8 +316,13 @@ class PublicESISession:
     __slots__ = (
         "_esi_url",
         "_session",
-        "_bad_citadels",
-        "_forge_citadel_cache",
+        "_forbidden_citadels",
+        "_citadel_registry",
+        "_citadel_scans",
+        "_breakers",
+        "_latencies",
+        "_last_good",
+        "_revalidations",
         "_esilimiter",
     )
 
@@ -201,85 +343,155 @@ class PublicESISession:
             self._esi_url = esi_url
             self._session = aiohttp.ClientSession(headers=headers)
 
-        self._bad_citadels = {
-            # These were forbidden the first time I looked up Jita prices.
-            1_029_949_899_294,
-            1_029_898_792_553,
-            1_026_199_596_235,
-            1_029_757_417_883,
-            1_029_792_736_908,
-            1_029_719_938_968,
-            1_022_179_194_562,
-            1_022_719_559_274,
-            1_026_221_929_523,
-            1_028_370_750_672,
-            1_028_858_195_912,
-            1_029_036_975_486,
-            1_029_209_158_478,
-            1_030_524_644_061,
-            1_032_792_278_341,
-            1_033_110_865_110,
-            1_041_701_800_198,
-        }
+        self._forbidden_citadels = ForbiddenCitadels.seeded()
+        self._citadel_registry = CitadelRegistry()
+        # Each route's circuit breaker, the last good response to each of
+        # the most recent requests to routes which serve stale, to serve
+        # while their route's is open, and the requests made to see if an
+        # open one's route is back.
+        self._breakers: dict[str, CircuitBreaker] = {}
+        # The latencies of the routes which hedge.
+        self._latencies: dict[str, RouteLatency] = {}
+        self._last_good: collections.OrderedDict[Hashable, Response] = (
+            collections.OrderedDict()
+        )
+        self._revalidations: set[asyncio.Task] = set()
+        # region ID: (when it was last scanned, {page: (ETag, citadel IDs)}).
+        self._citadel_scans: dict[
+            int, tuple[datetime.datetime, dict[int, tuple[str, set[int]]]]
+        ] = {}
 
     async def __aenter__(self):
         await self._session.__aenter__()
         return self
 
     async def __aexit__(self, a, b, c):
+        for task in self._revalidations:
+            task.cancel()
         return await self._session.__aexit__(a, b, c)
 
-    async def get_market_orders(
-        self, region_id: int, buy_sell: str, type_id: int | None = None
-    ):
-        page = 0
-        params = {"order_type": buy_sell}
-        if type_id is not None:
-            params["type_id"] = str(type_id)
+    def use_esilimiter(self, esilimiter: ABCESILimiter) -> None:
+        "Replace the process-local limiter, e.g. with one shared by other nodes."
+        self._esilimiter = esilimiter
 
-        while True:
-            page += 1
-            try:
-                orders = await self._get_region_orders(
-                    region_id, params={"page": str(page), **params}
-                )
-            except aiohttp.ClientResponseError as exc:
-                # Reading past the last page emits a 404 error.
-                # Treat this like an empty orders return value.
-                if page == 1 or exc.status != 404:
-                    raise
-                orders = ()
-
-            for item in orders:
-                yield item
-            if len(orders) < 1000:
-                logging.info(
-                    "get_market_orders(%r, %r, %r) made %d requests",
-                    region_id,
-                    buy_sell,
-                    type_id,
-                    page,
-                )
-                return
+    def use_forbidden_citadels(self, forbidden_citadels: ForbiddenCitadels) -> None:
+        "Replace the process-local registry, e.g. with one which is stored."
+        self._forbidden_citadels = forbidden_citadels
+
+    # How many responses are kept to serve stale.
+    LAST_GOOD_SIZE = 4096
+
+    def _remember(self, key: Hashable, resp: Response) -> None:
+        self._last_good[key] = resp
+        self._last_good.move_to_end(key)
+        if len(self._last_good) > self.LAST_GOOD_SIZE:
+            self._last_good.popitem(last=False)
+
+    def _revalidated(self, task: asyncio.Task) -> None:
+        self._revalidations.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.info("revalidation failed: %r", task.exception())
 
-    get_forge_orders = functools.partialmethod(get_market_orders, 10_000_002)
+    def use_citadel_registry(self, citadel_registry: CitadelRegistry) -> None:
+        "Replace the process-local registry, e.g. with one which is stored."
+        self._citadel_registry = citadel_registry
 
-    async def get_forge_market_citadel_ids(self):
+    async def get_all_pages(
+        self, binding, *args, params: dict[str, str] | None = None
+    ) -> tuple[list, datetime.datetime]:
         """
-        Retrieves the location IDs for citadels in The Forge with markets.
-        Done by scanning the Jita buy orders (expensive!)
+        Every page of a paginated route, and the earliest time any of them
+        expires. The first page says how many there are (X-Pages), so the
+        rest are fetched concurrently.
         """
+        params = params or {}
+        first = await binding(*args, params={**params, "page": "1"})
+        page_count = int(first.headers.get("X-Pages", "1"))
+        rest = await asyncio.gather(
+            *(
+                binding(*args, params={**params, "page": str(page)})
+                for page in range(2, page_count + 1)
+            )
+        )
+        result = list(first)
+        for page in rest:
+            result += page
+        return result, min(page.expires for page in (first, *rest))
+
+    async def get_region_type_orders(
+        self, region_id: int, type_id: int
+    ) -> tuple[list[ESIMarketOrder], datetime.datetime]:
+        "Buy and sell orders for a type in a region, and when they expire."
+        orders, expires = await self.get_all_pages(
+            self._get_region_orders,
+            region_id,
+            params={"order_type": "all", "type_id": str(type_id)},
+        )
+        await self._citadel_registry.observe(region_id, orders)
+        return orders, expires
+
+    # How often each region's orders are checked for new citadels.
+    CITADEL_SCAN_INTERVAL = datetime.timedelta(hours=12)
+
+    async def get_market_citadel_ids(self, region_id: int) -> set[int]:
+        """
+        The location IDs of citadels in a region with markets, from the
+        citadel registry. Every region order scan adds to it. When no
+        citadel in the region has been seen for CITADEL_SCAN_INTERVAL, nor
+        has it been scanned for them in that time, the region's buy orders
+        are scanned too, skipping the pages which haven't changed since the
+        last time.
+        """
+        registry = self._citadel_registry
         now = datetime.datetime.now(datetime.UTC)
-        try:
-            result, fetch_dt = self._forge_citadel_cache
-            if now - fetch_dt > datetime.timedelta(hours=12):
-                raise AttributeError
-            return result
-        except AttributeError:
-            pass
-        orders = self.get_forge_orders("buy")
-        result = {o["location_id"] async for o in orders} - forge_npc_station_ids
-        self._forge_citadel_cache = result, now
+        last_scan, scanned = self._citadel_scans.get(region_id, (None, {}))
+        # A stored registry's sightings also count after a restart.
+        checked = max(
+            (t for t in (last_scan, registry.last_seen(region_id)) if t is not None),
+            default=None,
+        )
+        if checked is None or now - checked > self.CITADEL_SCAN_INTERVAL:
+            scanned = await self._scan_region_citadels(region_id, scanned)
+            self._citadel_scans[region_id] = now, scanned
+        return registry.citadel_ids(region_id)
+
+    async def _scan_region_citadels(
+        self, region_id: int, scanned: dict[int, tuple[str, set[int]]]
+    ) -> dict[int, tuple[str, set[int]]]:
+        """
+        Observes the region's buy orders, returning each page's ETag and
+        citadels. The citadels on pages which haven't changed since the
+        last scan are taken from it.
+        """
+
+        async def get_page(page):
+            etag = scanned[page][0] if page in scanned else None
+            return await self._get_region_orders(
+                region_id, params={"order_type": "buy", "page": str(page)}, etag=etag
+            )
+
+        first = await get_page(1)
+        page_count = int(first.headers.get("X-Pages", "1"))
+        pages = [first, *await asyncio.gather(*map(get_page, range(2, page_count + 1)))]
+        result = {}
+        changed = 0
+        registry = self._citadel_registry
+        for number, page in enumerate(pages, 1):
+            if page.status == 304:
+                etag, citadel_ids = scanned[number]
+                await registry.seen(region_id, citadel_ids)
+            else:
+                changed += 1
+                etag = page.headers.get("ETag")
+                citadel_ids = await registry.observe(region_id, page)
+            if etag is not None:
+                result[number] = etag, citadel_ids
+        logger.info(
+            "scanned region %d for citadels: %d of %d pages changed",
+            region_id,
+            changed,
+            page_count,
+        )
         return result
 
     # fmt: off
@@ -289,7 +501,7 @@ class PublicESISession:
     get_system_information = _esi(4, "universe/systems/{}", "get_system_information")
     get_item_group_information = _esi(1, "universe/groups/{}", "get_item_group_information")
     get_item_category_information = _esi(1, "universe/categories/{}", "get_item_category_information")
-    _get_region_orders = _esi(1, "markets/{}/orders/", "_get_region_orders", accepts_params=True)
+    _get_region_orders = _esi(1, "markets/{}/orders/", "_get_region_orders", accepts_params=True, schema=list[ESIMarketOrder])
     get_market_group = _esi(1, "markets/groups/{}", "get_market_group")
     # fmt: on
 
@@ -316,7 +528,7 @@ class ESISession(PublicESISession):
 
     async def __aexit__(self, a, b, c):
         await self._login_session.__aexit__(a, b, c)  # TODO is thsi ok?
-        return await self._session.__aexit__(a, b, c)
+        return await super().__aexit__(a, b, c)
 
     async def get_access_token(self, authz_code) -> AccessToken:
         async with self._login_session.post(
@@ -423,69 +635,40 @@ class ESISession(PublicESISession):
         pass
 
     @_requires_session
-    async def get_structure_market_orders(self, session, structure_id: int):
-        params = {"page": 0}
-        if structure_id in self._bad_citadels:
+    async def get_structure_market(
+        self, session, structure_id: int
+    ) -> None | tuple[list[ESIMarketOrder], datetime.datetime]:
+        """
+        Every order in a structure's market, and when they expire. None if
+        we aren't allowed to see them.
+        """
+        forbidden_citadels = self._forbidden_citadels
+        if forbidden_citadels.is_forbidden(structure_id):
             logging.debug(
                 "citadel %d is still forbidden, ignoring some more.", structure_id
             )
-            return []
-
-        orders = []
-        while True:
-            params["page"] += 1
-            try:
-                page = await self._get_structure_market(
-                    session, structure_id, params=params
-                )
-            except aiohttp.ClientResponseError as e:
-                if e.status == 403:
-                    logging.info("citadel %d is forbidden to us", structure_id)
-                    self._bad_citadels.add(structure_id)
-                    return []
-                raise
-
-            orders += page
-            if len(page) < 1000:
-                logging.info(
-                    "get_structure_market_orders(%d) made %d requests",
-                    structure_id,
-                    params["page"],
-                )
-                return orders
-
-    @_requires_session
-    async def get_best_price(self, session, buy_sell, citadel_ids, region_id, type_id):
-        comparator = max if buy_sell == "buy" else min
-        orders = self.get_market_orders(region_id, buy_sell, type_id)
-        current_best = None
-        async for order in orders:
-            if current_best is None:
-                current_best = order["price"]
-            else:
-                current_best = comparator(current_best, order["price"])
-        is_buy_order = buy_sell == "buy"
-
-        for citadel_id in citadel_ids:
-            order_prices = [
-                o["price"]
-                for o in await self.get_structure_market_orders(session, citadel_id)
-                if o["is_buy_order"] == is_buy_order and o["type_id"] == type_id
-            ]
-            if order_prices and current_best is None:
-                current_best = order_prices[0]
-            current_best = comparator([current_best, *[p for p in order_prices]])
-
-        return current_best
+            return None
+        try:
+            market = await self.get_all_pages(
+                self._get_structure_market, session, structure_id
+            )
+        except aiohttp.ClientResponseError as e:
+            if e.status == 403:
+                logging.info("citadel %d is forbidden to us", structure_id)
+                await forbidden_citadels.forbidden(structure_id)
+                return None
+            raise
+        await forbidden_citadels.allowed(structure_id)
+        return market
 
     _STC = SessionType.character
     _STH = SessionType.headers
     # fmt: off
-    get_skills = _esi(4, "characters/{}/skills", "get_skills", _STC)
-    get_skill_queue = _esi(2, "characters/{}/skillqueue/", "get_skill_queue", _STC)
-    get_wallet_balance = _esi(1, "characters/{}/wallet", "get_wallet_balance", _STC)
-    get_wallet_journal = _esi(6, "characters/{}/wallet/journal/", "get_wallet_journal", _STC)
-    get_attributes = _esi(1, "characters/{}/attributes/", "get_attributes", _STC)
-    get_implants = _esi(1, "characters/{}/implants/", "get_implants", _STC)
-    _get_structure_market = _esi(1, "markets/structures/{}", "_get_structure_market", _STH, True)
+    get_skills = _esi(4, "characters/{}/skills", "get_skills", _STC, schema=ESISkills, hedge=True, stale=True)
+    get_skill_queue = _esi(2, "characters/{}/skillqueue/", "get_skill_queue", _STC, schema=list[ESISkillQueueItem], hedge=True, stale=True)
+    get_wallet_balance = _esi(1, "characters/{}/wallet", "get_wallet_balance", _STC, schema=float, hedge=True, stale=True)
+    get_wallet_journal = _esi(6, "characters/{}/wallet/journal/", "get_wallet_journal", _STC, True, schema=list[ESIWalletJournalEntry])
+    get_attributes = _esi(1, "characters/{}/attributes/", "get_attributes", _STC, schema=ESIAttributes, hedge=True, stale=True)
+    get_implants = _esi(1, "characters/{}/implants/", "get_implants", _STC, schema=list[int], hedge=True, stale=True)
+    _get_structure_market = _esi(1, "markets/structures/{}", "_get_structure_market", _STH, True, schema=list[ESIMarketOrder])
     # fmt: on
@@ -1,8 +1,10 @@
 import time
+import asyncio
 import logging
 import operator
 
 from .esi import ESISession
+from .market import MarketData
 from .types import ItemTypes, ABCSession, AcceleratorInfo
 
 logger = logging.getLogger(__name__)
@@ -10,87 +12,147 @@ logger = logging.getLogger(__name__)
 
 get_accel_magnitudes = operator.itemgetter(*range(175, 180))
 
+# How many type information lookups run at once.
+CONCURRENCY = 8
 
-async def get_isk_for_sp_options(
-    esi: ESISession, fs: ABCSession
-) -> tuple[float, float, list[AcceleratorInfo]]:
-    now = time.time()
-    citadel_ids = await esi.get_forge_market_citadel_ids()
-    lsi_price = await esi.get_best_price(
-        fs, "sell", citadel_ids, 10000002, ItemTypes.LargeSkillInjector.value
-    )
-    ssi_price = await esi.get_best_price(
-        fs, "sell", citadel_ids, 10000002, ItemTypes.SmallSkillInjector.value
-    )
 
-    accelerators = []
+def _accelerator_attributes(
+    item_type_id: int, res: dict, now: float
+) -> None | tuple[int, float]:
+    "The magnitude and duration of a usable accelerator, or None."
+    if res["published"] is not True:
+        logger.info("UNPUBLISHED Type ID %d => %s", item_type_id, res["name"])
+        return None
+    if "Expired" in res["name"]:
+        logger.info("EXPIRED Type ID %d => %s", item_type_id, res["name"])
+        return None
+    if res.get("market_group_id") != 2487:  # should be unreachable now...
+        logger.info(
+            "NOT IN MARKET 2487 (actually in %r) Type ID %d => %s",
+            res.get("market_group_id"),
+            item_type_id,
+            res["name"],
+        )
+        return None
+    if "dogma_attributes" not in res:
+        logger.info("NO DOGMA Type ID %d => %s", item_type_id, res["name"])
+        # I think this is caused by recent expiration?
+        return None
+    dogma = res["dogma_attributes"] = {
+        i["attribute_id"]: i["value"] for i in res["dogma_attributes"]
+    }
+    try:
+        magnitudes = get_accel_magnitudes(dogma)
+    except KeyError:
+        logger.info("NO MAGNITUDES Type ID %d => %s", item_type_id, res["name"])
+        return None
+    if magnitudes.count(magnitudes[0]) != len(magnitudes):
+        logger.info("INCORRECT MAGNITUDES Type ID %d => %s", item_type_id, res["name"])
+        return None
+    duration = dogma[330]
 
-    accel_type_ids = (await esi.get_market_group(2487))["types"]
-    logger.info("Cerebral Accelerator search yielded %d results", len(accel_type_ids))
-    for item_type_id in accel_type_ids:
-        res = await esi.get_type_information(item_type_id)
-        res = res.result
-        if res["published"] is not True:
-            logger.info("UNPUBLISHED Type ID %d => %s", item_type_id, res["name"])
-            continue
-        if "Expired" in res["name"]:
-            logger.info("EXPIRED Type ID %d => %s", item_type_id, res["name"])
-            continue
-        if res.get("market_group_id") != 2487:  # should be unreachable now...
-            logger.info(
-                "NOT IN MARKET 2487 (actually in %r) Type ID %d => %s",
-                res.get("market_group_id"),
-                item_type_id,
-                res["name"],
-            )
-            continue
-        if "dogma_attributes" not in res:
-            logger.info("NO DOGMA Type ID %d => %s", item_type_id, res["name"])
-            # I think this is caused by recent expiration?
-            continue
-        dogma = res["dogma_attributes"] = {
-            i["attribute_id"]: i["value"] for i in res["dogma_attributes"]
-        }
+    if item_type_id not in (ItemTypes.MasterAtArms.value, ItemTypes.Expert.value):
         try:
-            magnitudes = get_accel_magnitudes(dogma)
+            expiry = dogma[2422]
         except KeyError:
-            logger.info("NO MAGNITUDES Type ID %d => %s", item_type_id, res["name"])
-            continue
-        if magnitudes.count(magnitudes[0]) != len(magnitudes):
-            logger.info(
-                "INCORRECT MAGNITUDES Type ID %d => %s", item_type_id, res["name"]
-            )
-            continue
-        duration = dogma[330]
+            logger.info("NO EXPIRY Type ID %d => %s", item_type_id, res["name"])
+            return None  # expired
+
+        if now > expiry * (24 * 60 * 60):
+            logger.info("EXPIRED Type ID %d => %s", item_type_id, res["name"])
+            return None  # expired
 
-        if item_type_id not in (ItemTypes.MasterAtArms.value, ItemTypes.Expert.value):
-            try:
-                expiry = dogma[2422]
-            except KeyError:
-                logger.info("NO EXPIRY Type ID %d => %s", item_type_id, res["name"])
-                continue  # expired
+    return magnitudes[0], duration
 
-            if now > expiry * (24 * 60 * 60):
-                logger.info("EXPIRED Type ID %d => %s", item_type_id, res["name"])
-                continue  # expired
 
-        price = await esi.get_best_price(
-            fs, "sell", citadel_ids, 10000002, item_type_id
+async def get_isk_for_sp_options(
+    esi: ESISession, fs: ABCSession, markets: dict[str, MarketData]
+) -> tuple[
+    list[str],
+    list[float | None],
+    list[float | None],
+    list[AcceleratorInfo],
+    int,
+    list[tuple[int, list[tuple[list[float], list[int]]]]],
+]:
+    """
+    The trade hubs' names, their skill injector and accelerator prices,
+    when the oldest orders the prices came from were fetched, and the sell
+    order book of each type in each hub, as (type ID, [(prices, cumulative
+    volumes) for each hub]). Accelerators are looked up once, CONCURRENCY
+    at a time, and then every hub refreshes what has expired concurrently,
+    sharing CONCURRENCY between them.
+    """
+    now = time.time()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def get_accelerator(item_type_id) -> None | tuple[int, str, int, float]:
+        try:
+            async with semaphore:
+                res = (await esi.get_type_information(item_type_id)).result
+        except Exception:
+            logger.warning("failed to look up Type ID %d", item_type_id, exc_info=True)
+            return None
+        attributes = _accelerator_attributes(item_type_id, res, now)
+        if attributes is None:
+            return None
+        magnitude, duration = attributes
+        return item_type_id, res["name"], magnitude, duration
+
+    async with asyncio.TaskGroup() as tg:
+        citadel_ids = [
+            tg.create_task(esi.get_market_citadel_ids(market.region_id))
+            for market in markets.values()
+        ]
+        accel_type_ids = (await esi.get_market_group(2487))["types"]
+        logger.info(
+            "Cerebral Accelerator search yielded %d results", len(accel_type_ids)
         )
+        candidates = [
+            tg.create_task(get_accelerator(item_type_id))
+            for item_type_id in accel_type_ids
+        ]
+    candidates = [c.result() for c in candidates if c.result() is not None]
 
-        if price is None:
+    lsi = ItemTypes.LargeSkillInjector.value
+    ssi = ItemTypes.SmallSkillInjector.value
+    type_ids = [lsi, ssi, *(c[0] for c in candidates)]
+    async with asyncio.TaskGroup() as tg:
+        for market, citadels in zip(markets.values(), citadel_ids):
+            tg.create_task(market.refresh(fs, type_ids, citadels.result(), semaphore))
+
+    accelerators = []
+    for item_type_id, name, magnitude, duration in candidates:
+        prices = [market.best_price(item_type_id) for market in markets.values()]
+        if all(price is None for price in prices):
             # Not available
-            logger.info("NO PRICES Type ID %d => %s", item_type_id, res["name"])
+            logger.info("NO PRICES Type ID %d => %s", item_type_id, name)
             continue
-
-        accelerators.append(
-            AcceleratorInfo(
-                item_type_id, price, res["name"], magnitudes[0], duration / 1000
-            )
-        )
         logger.info(
-            "Found +%d x %dsec accelerator: %d %s for %.2f ISK"
-            % (magnitudes[0], duration / 1000, item_type_id, res["name"], price)
+            "Found +%d x %dsec accelerator: %d %s for %s ISK",
+            magnitude,
+            duration / 1000,
+            item_type_id,
+            name,
+            prices,
+        )
+        accelerators.append(
+            AcceleratorInfo(item_type_id, prices, name, magnitude, duration / 1000)
         )
 
-    return lsi_price, ssi_price, accelerators
+    books = []
+    for type_id in (lsi, ssi, *(a.id for a in accelerators)):
+        hub_books = [market.order_book(type_id) for market in markets.values()]
+        books.append((type_id, [(b.prices, b.volumes) for b in hub_books]))
+
+    oldest = min(
+        filter(None, (market.oldest() for market in markets.values())), default=None
+    )
+    return (
+        list(markets),
+        [market.best_price(lsi) for market in markets.values()],
+        [market.best_price(ssi) for market in markets.values()],
+        accelerators,
+        int(oldest.timestamp()) if oldest is not None else int(now),
+        books,
+    )
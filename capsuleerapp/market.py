@@ -0,0 +1,218 @@
+"""
+Market orders for the types whose prices we publish, from a region and
+from each of the citadels in it which have public markets. There is one
+MarketData for each of the trade hubs we publish prices for.
+
+Each type's region orders and each citadel's orders are kept separately
+with the time ESI says they expire, and only expired ones are fetched
+again. When fetching one fails, the previous copy is kept: a broken
+citadel only makes its own orders older, and prices are published along
+with the age of the oldest data they came from.
+"""
+
+import bisect
+import asyncio
+import logging
+import datetime
+import itertools
+from typing import NamedTuple
+from collections.abc import Iterable, Iterator, Collection
+
+from .esi import ESISession
+from .types import ABCSession, ESIMarketOrder
+
+logger = logging.getLogger(__name__)
+
+
+# The region each trade hub is in, by the name of the hub's system. Prices
+# are published for the whole region, its citadels included.
+TRADE_HUBS = {
+    "Jita": 10000002,
+    "Amarr": 10000043,
+    "Dodixie": 10000032,
+    "Rens": 10000030,
+    "Hek": 10000042,
+}
+
+
+class MarketEntry(NamedTuple):
+    orders: list[ESIMarketOrder]
+    fetched: datetime.datetime
+    expires: datetime.datetime
+
+
+class OrderBook:
+    """
+    One side of a type's orders, best price first, as the price of each
+    order and the volume of it and every better order. The cost of buying
+    (or selling) any quantity is a binary search away.
+    """
+
+    __slots__ = "prices", "volumes", "_costs"
+
+    def __init__(self, prices: list[float], volumes: list[int]) -> None:
+        "volumes are cumulative."
+        self.prices = prices
+        self.volumes = volumes
+        # The cost of filling every order up to and including each one.
+        self._costs = list(
+            itertools.accumulate(
+                price * (volume - previous)
+                for price, volume, previous in zip(prices, volumes, [0, *volumes])
+            )
+        )
+
+    @classmethod
+    def from_orders(
+        cls, orders: Iterable[ESIMarketOrder], is_buy_order: bool = False
+    ) -> "OrderBook":
+        orders = sorted(
+            (o for o in orders if o["is_buy_order"] == is_buy_order),
+            key=lambda o: o["price"],
+            reverse=is_buy_order,
+        )
+        return cls(
+            [o["price"] for o in orders],
+            list(itertools.accumulate(o["volume_remain"] for o in orders)),
+        )
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def depth(self) -> int:
+        "How many units there are in total."
+        return self.volumes[-1] if self.volumes else 0
+
+    def fill_cost(self, quantity: int) -> float | None:
+        "What quantity units cost, best first, or None if there aren't enough."
+        if quantity <= 0:
+            return 0.0
+        # The first order which, with the ones before it, has enough.
+        i = bisect.bisect_left(self.volumes, quantity)
+        if i == len(self.volumes):
+            return None
+        if i == 0:
+            return self.prices[0] * quantity
+        return self._costs[i - 1] + self.prices[i] * (quantity - self.volumes[i - 1])
+
+
+class MarketData:
+    # How many types or citadels are fetched at once.
+    CONCURRENCY = 8
+    # How long to leave a citadel we may not see before asking again.
+    FORBIDDEN_RETRY = datetime.timedelta(hours=1)
+
+    __slots__ = "_esi", "region_id", "_types", "_citadels"
+
+    def __init__(self, esi: ESISession, region_id: int = 10000002) -> None:
+        self._esi = esi
+        self.region_id = region_id
+        self._types: dict[int, MarketEntry] = {}
+        self._citadels: dict[int, MarketEntry] = {}
+
+    async def refresh(
+        self,
+        session: ABCSession,
+        type_ids: Collection[int],
+        citadel_ids: Collection[int],
+        semaphore: asyncio.Semaphore | None = None,
+    ) -> None:
+        """
+        Fetches the orders for type_ids which have expired, or are missing,
+        CONCURRENCY at a time unless a semaphore shared with other markets
+        is given.
+        """
+        type_ids = frozenset(type_ids)
+        for type_id in self._types.keys() - type_ids:
+            del self._types[type_id]
+        for citadel_id in self._citadels.keys() - set(citadel_ids):
+            del self._citadels[citadel_id]
+
+        now = datetime.datetime.now(datetime.UTC)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.CONCURRENCY)
+
+        def stale(entry):
+            return entry is None or entry.expires <= now
+
+        async def refresh_type(type_id):
+            async with semaphore:
+                try:
+                    orders, expires = await self._esi.get_region_type_orders(
+                        self.region_id, type_id
+                    )
+                except Exception:
+                    logger.warning("failed to refresh type %d", type_id, exc_info=True)
+                    return
+            self._types[type_id] = MarketEntry(orders, now, expires)
+
+        async def refresh_citadel(citadel_id):
+            async with semaphore:
+                try:
+                    market = await self._esi.get_structure_market(session, citadel_id)
+                except Exception:
+                    logger.warning(
+                        "failed to refresh citadel %d", citadel_id, exc_info=True
+                    )
+                    return
+            if market is None:
+                entry = MarketEntry([], now, now + self.FORBIDDEN_RETRY)
+            else:
+                orders, expires = market
+                # A citadel's whole market is big; we only need a few types.
+                orders = [o for o in orders if o["type_id"] in type_ids]
+                entry = MarketEntry(orders, now, expires)
+            self._citadels[citadel_id] = entry
+
+        async with asyncio.TaskGroup() as tg:
+            for type_id in type_ids:
+                if stale(self._types.get(type_id)):
+                    tg.create_task(refresh_type(type_id))
+            for citadel_id in citadel_ids:
+                if stale(self._citadels.get(citadel_id)):
+                    tg.create_task(refresh_citadel(citadel_id))
+
+    def entries(self) -> Iterator[tuple[bool, int, MarketEntry]]:
+        "(whether it's a citadel's, type or citadel ID, entry) for each entry."
+        for type_id, entry in self._types.items():
+            yield False, type_id, entry
+        for citadel_id, entry in self._citadels.items():
+            yield True, citadel_id, entry
+
+    def restore(self, entries: Iterable[tuple[bool, int, MarketEntry]]) -> None:
+        "Adds entries, as from entries(), for the types and citadels without one."
+        for is_citadel, key, entry in entries:
+            (self._citadels if is_citadel else self._types).setdefault(key, entry)
+
+    def orders(self, type_id: int):
+        "Every known order for a type, in the region or its citadels."
+        try:
+            region_orders = self._types[type_id].orders
+        except KeyError:
+            region_orders = ()
+        yield from region_orders
+        # Region orders include those in public citadels, which would
+        # otherwise be counted twice by an order book.
+        seen = {order["order_id"] for order in region_orders}
+        for entry in self._citadels.values():
+            for order in entry.orders:
+                if order["type_id"] == type_id and order["order_id"] not in seen:
+                    yield order
+
+    def best_price(self, type_id: int, buy_sell: str = "sell") -> float | None:
+        is_buy_order = buy_sell == "buy"
+        comparator = max if is_buy_order else min
+        prices = [
+            o["price"]
+            for o in self.orders(type_id)
+            if o["is_buy_order"] == is_buy_order
+        ]
+        return comparator(prices) if prices else None
+
+    def order_book(self, type_id: int, buy_sell: str = "sell") -> OrderBook:
+        return OrderBook.from_orders(self.orders(type_id), buy_sell == "buy")
+
+    def oldest(self) -> datetime.datetime | None:
+        "When the oldest of the orders were fetched."
+        entries = (*self._types.values(), *self._citadels.values())
+        return min((e.fetched for e in entries), default=None)
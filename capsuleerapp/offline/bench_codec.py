@@ -0,0 +1,135 @@
+"""
+Measures capsuleerapp.codec against the standard library json module.
+
+Encoding is measured on synthetic payloads shaped like our responses for a
+veteran character. Decoding is measured on recorded ESI responses: pass
+files containing the raw response bodies, named after the schema they
+should be decoded as, e.g. `skills.json`, `skillqueue.json` or
+`orders-1.json`. Without any, synthetic market orders are used.
+"""
+
+import sys
+import json
+import random
+import timeit
+import os.path
+
+from capsuleerapp import codec
+from capsuleerapp.types import (
+    ESISkills,
+    ESIAttributes,
+    ESIMarketOrder,
+    ESISkillQueueItem,
+    ESIWalletJournalEntry,
+)
+
+rng = random.Random(0)
+
+skills_payload = (
+    312_000_000,
+    tuple(
+        [rng.randrange(3300, 90000), rng.randrange(1, 6), 1700000000, 1700100000]
+        for _ in range(50)
+    ),
+    tuple(
+        (rng.randrange(3300, 90000), 5, 5, rng.randrange(0, 1_280_000))
+        for _ in range(450)
+    ),
+    (27, 21, 20, 20, 19),
+    12_345_678_901.23,
+    0,
+    0,
+    [5, 5, 5, 5, 5],
+    0,
+    2,
+)
+
+wallet_payload = [
+    9_876_543_210.5,
+    1700000000,
+    tuple(f"Market transaction {i}" for i in range(40)),
+    [
+        (rng.randrange(0, 30 * 86400), rng.uniform(-1e9, 1e9), rng.randrange(40))
+        for _ in range(2500)
+    ],
+]
+
+synthetic_orders = json.dumps(
+    [
+        {
+            "duration": 90,
+            "is_buy_order": rng.random() < 0.5,
+            "issued": "2024-10-01T12:34:56Z",
+            "location_id": 60003760,
+            "min_volume": 1,
+            "order_id": 6_000_000_000 + i,
+            "price": rng.uniform(1, 1e9),
+            "range": "region",
+            "system_id": 30000142,
+            "type_id": rng.randrange(18, 80000),
+            "volume_remain": rng.randrange(1, 1000),
+            "volume_total": 1000,
+        }
+        for i in range(1000)
+    ]
+).encode()
+
+schemas = {
+    "skills": ESISkills,
+    "skillqueue": list[ESISkillQueueItem],
+    "attributes": ESIAttributes,
+    "journal": list[ESIWalletJournalEntry],
+    "orders": list[ESIMarketOrder],
+    "implants": list[int],
+}
+
+
+def per_call_us(function):
+    count, total = timeit.Timer(function).autorange()
+    return total / count * 1e6
+
+
+def bench_encoding():
+    def stdlib_encode(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    encoders = [("stdlib json", stdlib_encode)]
+    encoders.append((f"{codec.JSON_BACKEND} json", codec.JSON.encode))
+    if codec.MSGPACK is not None:
+        encoders.append(("msgpack", codec.MSGPACK.encode))
+
+    for name, payload in (("skills", skills_payload), ("wallet", wallet_payload)):
+        print(f"encode {name}:")
+        for encoder_name, encode in encoders:
+            size = len(encode(payload))
+            us = per_call_us(lambda: encode(payload))
+            print(f"  {encoder_name:>16} {size:>8} bytes {us:>10.1f}us")
+
+
+def bench_decoding(recordings):
+    for name, data in recordings:
+        schema = schemas.get(name.split("-")[0].split(".")[0])
+        print(f"decode {name} ({len(data)} bytes):")
+        stdlib = per_call_us(lambda: json.loads(data))
+        print(f"  {'stdlib json':>24} {stdlib:>10.1f}us")
+        untyped = per_call_us(lambda: codec.loads(data))
+        print(f"  {codec.JSON_BACKEND + ' json':>24} {untyped:>10.1f}us")
+        if schema is not None and codec.msgspec is not None:
+            typed = per_call_us(lambda: codec.loads(data, schema))
+            print(f"  {'msgspec, validated':>24} {typed:>10.1f}us")
+
+
+def main():
+    print(f"JSON backend: {codec.JSON_BACKEND}")
+    bench_encoding()
+    recordings = []
+    for filename in sys.argv[1:]:
+        with open(filename, "rb") as f:
+            recordings.append((os.path.basename(filename), f.read()))
+    if not recordings:
+        recordings.append(("orders-synthetic", synthetic_orders))
+    bench_decoding(recordings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import time
+import asyncio
+import logging
+from collections.abc import Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionScheduler:
+    """
+    Calls callback(key) once the wall-clock time scheduled for each key has
+    passed. A key has at most one pending completion; scheduling it again
+    replaces it. Like ResponseCache, the timer heap is the event loop's own.
+    """
+
+    __slots__ = "_loop", "_callback", "_timerhandles"
+
+    def __init__(self, callback: Callable[[Hashable], None]) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._callback = callback
+        self._timerhandles: dict[Hashable, asyncio.TimerHandle] = {}
+
+    def schedule(self, key: Hashable, when: float) -> None:
+        "when is in seconds since the epoch, like time.time()."
+        self.cancel(key)
+        self._timerhandles[key] = self._loop.call_later(
+            max(0.0, when - time.time()), self._complete, key
+        )
+
+    def _complete(self, key: Hashable) -> None:
+        del self._timerhandles[key]
+        try:
+            self._callback(key)
+        except Exception:
+            logger.exception("completion callback for %r failed", key)
+
+    def cancel(self, key: Hashable) -> None:
+        try:
+            self._timerhandles.pop(key).cancel()
+        except KeyError:
+            pass
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timerhandles
+
+    def clear(self) -> None:
+        for timerhandle in self._timerhandles.values():
+            timerhandle.cancel()
+        self._timerhandles.clear()
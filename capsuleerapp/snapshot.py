@@ -0,0 +1,279 @@
+"""
+Snapshots of the market orders behind each skill trade scan, so the
+leader doesn't start from nothing after a restart, and so price history
+can be served.
+
+Each scan is saved as one file of columns, one value per order in each:
+a header, then each column's values packed end to end, widest first so
+that each column stays aligned. Files are memory mapped when read, and
+columns are read in place through memoryviews; rows are sorted by type,
+region, side and price, so a type's orders are found by bisecting the
+type column and a best price is the first (or last) of them.
+"""
+
+import os
+import mmap
+import array
+import bisect
+import struct
+import logging
+import datetime
+import threading
+from typing import NamedTuple
+from collections.abc import Iterator
+
+from .market import MarketData, MarketEntry
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CAPSNAP1"
+# Magic, when the scan finished (epoch seconds), row count.
+HEADER = struct.Struct("=8sqq")
+# Name and array typecode of each column, in the order they're written.
+COLUMNS = (
+    ("expires", "q"),
+    ("price", "d"),
+    ("volume", "q"),
+    ("location", "q"),
+    ("order_id", "q"),
+    ("type_id", "i"),
+    ("region_id", "i"),
+    ("is_buy", "B"),
+    # Whether the order came from a citadel's market rather than the region's.
+    ("from_citadel", "B"),
+)
+ROW_ORDER = (
+    "type_id",
+    "region_id",
+    "is_buy",
+    "price",
+    "expires",
+    "volume",
+    "location",
+    "order_id",
+    "from_citadel",
+)
+SUFFIX = ".snapshot"
+
+
+class HistoryPoint(NamedTuple):
+    time: int
+    sell: float | None
+    buy: float | None
+
+
+class Snapshot:
+    "A memory mapped snapshot file. Its columns are memoryviews into it."
+
+    __slots__ = ("time", "rows", "_mmap", "_columns")
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.time, self.rows = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a market snapshot")
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+        self._columns = {}
+        for name, typecode in COLUMNS:
+            size = self.rows * array.array(typecode).itemsize
+            self._columns[name] = view[offset : offset + size].cast(typecode)
+            offset += size
+        view.release()
+
+    def close(self) -> None:
+        for column in self._columns.values():
+            column.release()
+        self._mmap.close()
+
+    def _rows(self, type_id: int, region_id: int, is_buy: int) -> range:
+        type_ids = self._columns["type_id"]
+        start = bisect.bisect_left(type_ids, type_id)
+        end = bisect.bisect_right(type_ids, type_id, start)
+        # A type has few enough orders for the rest to be a linear search.
+        regions = self._columns["region_id"]
+        sides = self._columns["is_buy"]
+        rows = [
+            i
+            for i in range(start, end)
+            if regions[i] == region_id and sides[i] == is_buy
+        ]
+        return range(rows[0], rows[-1] + 1) if rows else range(0)
+
+    def best_price(
+        self, type_id: int, region_id: int, buy_sell: str = "sell"
+    ) -> float | None:
+        is_buy = buy_sell == "buy"
+        rows = self._rows(type_id, region_id, is_buy)
+        if not rows:
+            return None
+        return self._columns["price"][rows[-1] if is_buy else rows[0]]
+
+    def entries(self, region_id: int) -> Iterator[tuple[bool, int, MarketEntry]]:
+        "The region's market entries, as MarketData.restore() takes them."
+        fetched = datetime.datetime.fromtimestamp(self.time, datetime.UTC)
+        c = self._columns
+        entries = {}
+        for i in range(self.rows):
+            if c["region_id"][i] != region_id:
+                continue
+            from_citadel = bool(c["from_citadel"][i])
+            key = c["location"][i] if from_citadel else c["type_id"][i]
+            try:
+                orders = entries[from_citadel, key].orders
+            except KeyError:
+                expires = datetime.datetime.fromtimestamp(c["expires"][i], datetime.UTC)
+                orders = []
+                entries[from_citadel, key] = MarketEntry(orders, fetched, expires)
+            orders.append(
+                {
+                    "order_id": c["order_id"][i],
+                    "type_id": c["type_id"][i],
+                    "location_id": c["location"][i],
+                    "price": c["price"][i],
+                    "volume_remain": c["volume"][i],
+                    "is_buy_order": bool(c["is_buy"][i]),
+                }
+            )
+        for (from_citadel, key), entry in entries.items():
+            yield from_citadel, key, entry
+
+
+def write(path: str, scan_time: int, markets: list[MarketData]) -> None:
+    "Writes a snapshot of the markets' orders, replacing path atomically."
+    # Each row's values in ROW_ORDER, so they can be sorted by the first four.
+    rows = []
+    for market in markets:
+        for from_citadel, _, entry in market.entries():
+            expires = int(entry.expires.timestamp())
+            for o in entry.orders:
+                rows.append(
+                    (
+                        o["type_id"],
+                        market.region_id,
+                        o["is_buy_order"],
+                        o["price"],
+                        expires,
+                        o["volume_remain"],
+                        o["location_id"],
+                        o["order_id"],
+                        from_citadel,
+                    )
+                )
+    rows.sort(key=lambda row: row[:4])
+    values = dict(zip(ROW_ORDER, zip(*rows)))
+    columns = [
+        array.array(typecode, values.get(name, ())) for name, typecode in COLUMNS
+    ]
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, scan_time, len(rows)))
+        for column in columns:
+            column.tofile(f)
+    os.replace(temporary_path, path)
+
+
+class SnapshotArchive:
+    """
+    A directory of snapshots, one per scan, named after when the scan
+    finished. Snapshots older than RETENTION are deleted as new ones are
+    added. Snapshots are opened as they're first read and kept open.
+
+    Its file I/O blocks, so it's meant to be used from threads, any number
+    at once.
+    """
+
+    RETENTION = datetime.timedelta(days=14)
+
+    __slots__ = "_directory", "_snapshots", "_lock"
+
+    def __init__(self, directory: str) -> None:
+        self._directory = directory
+        # By time, oldest first; None until opened.
+        self._snapshots: dict[int, Snapshot | None] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.discover()
+
+    def discover(self) -> None:
+        """
+        Catches up with snapshots added or deleted by another process, for
+        when the directory is shared with the node which is scanning.
+        """
+        found = set()
+        for filename in os.listdir(self._directory):
+            name, suffix = os.path.splitext(filename)
+            if suffix == SUFFIX and name.isdigit():
+                found.add(int(name))
+        with self._lock:
+            for scan_time in self._snapshots.keys() - found:
+                snapshot = self._snapshots.pop(scan_time)
+                if snapshot is not None:
+                    snapshot.close()
+            snapshots = dict.fromkeys(sorted(found))
+            snapshots.update(self._snapshots)
+            self._snapshots = dict(sorted(snapshots.items()))
+
+    def _path(self, scan_time: int) -> str:
+        return os.path.join(self._directory, f"{scan_time}{SUFFIX}")
+
+    def _open(self, scan_time: int) -> Snapshot | None:
+        "Called with the lock held."
+        snapshot = self._snapshots[scan_time]
+        if snapshot is None:
+            try:
+                snapshot = self._snapshots[scan_time] = Snapshot(self._path(scan_time))
+            except (OSError, ValueError):
+                logger.warning("unreadable snapshot %d", scan_time, exc_info=True)
+        return snapshot
+
+    def close(self) -> None:
+        with self._lock:
+            for snapshot in self._snapshots.values():
+                if snapshot is not None:
+                    snapshot.close()
+            self._snapshots = dict.fromkeys(self._snapshots)
+
+    def add(self, scan_time: int, markets: list[MarketData]) -> None:
+        write(self._path(scan_time), scan_time, markets)
+        oldest = scan_time - self.RETENTION.total_seconds()
+        with self._lock:
+            self._snapshots[scan_time] = None
+            old_times = [t for t in self._snapshots if t < oldest]
+            for old_time in old_times:
+                snapshot = self._snapshots.pop(old_time)
+                if snapshot is not None:
+                    snapshot.close()
+        for old_time in old_times:
+            try:
+                os.unlink(self._path(old_time))
+            except FileNotFoundError:
+                pass
+
+    def latest(self) -> Snapshot | None:
+        with self._lock:
+            for scan_time in reversed(self._snapshots):
+                snapshot = self._open(scan_time)
+                if snapshot is not None:
+                    return snapshot
+        return None
+
+    def history(self, type_id: int, region_id: int, since: int) -> list[HistoryPoint]:
+        "The type's best prices in the region in each snapshot since then."
+        points = []
+        with self._lock:
+            for scan_time in [t for t in self._snapshots if t >= since]:
+                snapshot = self._open(scan_time)
+                if snapshot is None:
+                    continue
+                points.append(
+                    HistoryPoint(
+                        scan_time,
+                        snapshot.best_price(type_id, region_id, "sell"),
+                        snapshot.best_price(type_id, region_id, "buy"),
+                    )
+                )
+        return points
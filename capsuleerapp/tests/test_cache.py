@@ -0,0 +1,124 @@
+import gzip
+import asyncio
+import datetime
+import unittest
+
+import aiohttp.web
+from aiohttp.test_utils import make_mocked_request
+
+from capsuleerapp.cache import (
+    Prefetcher,
+    ResponseCache,
+    PrecompressedBody,
+    strong_etag,
+    etag_matches,
+)
+
+
+class TestResponseCache(unittest.IsolatedAsyncioTestCase):
+    async def test_expiry(self):
+        cache = ResponseCache()
+        now = datetime.datetime.now(datetime.UTC)
+        cache.put(1, b"[]", strong_etag("a"), now + datetime.timedelta(seconds=0.01))
+        self.assertEqual(cache.get(1).body, b"[]")
+        await asyncio.sleep(0.02)
+        self.assertIsNone(cache.get(1))
+
+    async def test_already_expired_is_not_stored(self):
+        cache = ResponseCache()
+        now = datetime.datetime.now(datetime.UTC)
+        entry = cache.put(1, b"[]", strong_etag("a"), now)
+        self.assertEqual(entry.body, b"[]")
+        self.assertIsNone(cache.get(1))
+
+
+class TestETag(unittest.TestCase):
+    def test_etag_depends_on_validators(self):
+        self.assertEqual(strong_etag("1", "x"), strong_etag("1", "x"))
+        self.assertNotEqual(strong_etag("1", "x"), strong_etag("1", "y"))
+        self.assertNotEqual(strong_etag("1x"), strong_etag("1", "x"))
+
+    def test_if_none_match(self):
+        etag = strong_etag("a")
+
+        def request(value):
+            return make_mocked_request("GET", "/", headers={"If-None-Match": value})
+
+        self.assertTrue(etag_matches(request(etag), etag))
+        self.assertTrue(etag_matches(request(f'"nope", W/{etag}'), etag))
+        self.assertTrue(etag_matches(request("*"), etag))
+        self.assertFalse(etag_matches(request('"nope"'), etag))
+        self.assertFalse(etag_matches(make_mocked_request("GET", "/"), etag))
+
+
+class TestPrecompressedBody(unittest.TestCase):
+    def test_respond(self):
+        body = PrecompressedBody(b'{"a":1}' * 100, "application/json")
+
+        def request(**headers):
+            return make_mocked_request("GET", "/", headers=headers)
+
+        plain = body.respond(request(), {})
+        self.assertEqual(plain.body, b'{"a":1}' * 100)
+        self.assertNotIn("Content-Encoding", plain.headers)
+
+        gzipped = body.respond(request(**{"Accept-Encoding": "gzip, br;q=0"}), {})
+        self.assertEqual(gzipped.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(gzipped.body), plain.body)
+        self.assertNotEqual(gzipped.headers["ETag"], plain.headers["ETag"])
+
+        with self.assertRaises(aiohttp.web.HTTPNotModified):
+            body.respond(request(**{"If-None-Match": gzipped.headers["ETag"]}), {})
+
+
+class TestPrefetcher(unittest.IsolatedAsyncioTestCase):
+    async def test_refreshes_while_active(self):
+        fetched = []
+
+        async def fetch(group, key):
+            fetched.append(key)
+            return datetime.datetime.now(datetime.UTC)
+
+        class QuickPrefetcher(Prefetcher):
+            __slots__ = ()
+            REFRESH_DELAY = 0.01
+
+        prefetcher = QuickPrefetcher(fetch)
+        prefetcher.touch("account", [1, 2])
+        prefetcher.touch("account", [1])
+        await asyncio.sleep(0.005)
+        self.assertEqual(fetched, [1, 2])
+        self.assertIsNone(prefetcher.claim("account", 1))
+
+        await asyncio.sleep(0.03)
+        self.assertGreater(fetched.count(1), 1)
+        self.assertGreater(fetched.count(2), 1)
+
+        QuickPrefetcher.ACTIVE_TIME = 0
+        await asyncio.sleep(0.03)
+        fetched_while_active = len(fetched)
+        await asyncio.sleep(0.03)
+        self.assertEqual(len(fetched), fetched_while_active)
+        prefetcher.close()
+
+    async def test_claiming_queued_fetch_cancels_it(self):
+        fetched = []
+        release = asyncio.Event()
+
+        async def fetch(group, key):
+            fetched.append(key)
+            await release.wait()
+            return datetime.datetime.now(datetime.UTC)
+
+        prefetcher = Prefetcher(fetch)
+        self.addCleanup(prefetcher.close)
+        prefetcher.touch("account", range(Prefetcher.CONCURRENCY + 1))
+        await asyncio.sleep(0)
+        queued = Prefetcher.CONCURRENCY
+        # The caller fetches it rather than waiting behind the others.
+        self.assertIsNotNone(prefetcher.claim("account", 0))
+        self.assertIsNone(prefetcher.claim("account", queued))
+        release.set()
+        await asyncio.sleep(0.005)
+        self.assertNotIn(queued, fetched)
+        self.assertIsNone(prefetcher.claim("account", queued))
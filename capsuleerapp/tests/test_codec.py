@@ -0,0 +1,35 @@
+import unittest
+import contextlib
+
+from capsuleerapp import codec
+from capsuleerapp.types import AcceleratorInfo, ESISkillQueueItem
+
+
+class TestCodec(unittest.TestCase):
+    def test_compact_roundtrip(self):
+        payload = (1, [2.5, None], (AcceleratorInfo(1, 2.5, "name", 3, 4.0),))
+        encoded = codec.dumpb(payload)
+        self.assertNotIn(b" ", encoded)
+        self.assertEqual(
+            codec.loads(encoded), [1, [2.5, None], [[1, 2.5, "name", 3, 4.0]]]
+        )
+        self.assertEqual(codec.dumps(payload), encoded.decode())
+
+    def test_schema(self):
+        data = (
+            b'[{"skill_id":3300,"finished_level":5,"queue_position":0,'
+            b'"finish_date":"2024-10-01T12:34:56Z","unknown":1}]'
+        )
+        result = codec.loads(data, list[ESISkillQueueItem])
+        self.assertEqual(result[0]["skill_id"], 3300)
+        self.assertEqual(result[0]["finish_date"], "2024-10-01T12:34:56Z")
+
+    def test_schema_mismatch_still_decodes(self):
+        data = b'[{"skill_id":"3300","finished_level":5}]'
+        if codec.msgspec is None:
+            validated = contextlib.nullcontext()
+        else:
+            validated = self.assertLogs("capsuleerapp.codec", "WARNING")
+        with validated:
+            result = codec.loads(data, list[ESISkillQueueItem])
+        self.assertEqual(result, [{"skill_id": "3300", "finished_level": 5}])
@@ -0,0 +1,312 @@
+import json
+import asyncio
+import datetime
+import unittest
+
+import aiohttp
+
+from capsuleerapp import db
+
+
+class FakeConnection:
+    def __init__(self):
+        self.listeners = []
+        self.termination_listeners = []
+        self.executed = []
+
+    async def add_listener(self, channel, callback):
+        self.listeners.append((channel, callback))
+
+    def add_termination_listener(self, callback):
+        self.termination_listeners.append(callback)
+
+    async def execute(self, query, *args):
+        self.executed.append((query, *args))
+
+
+class FakeAcquire:
+    "Like asyncpg's, it's either awaited or used with async with."
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    def __await__(self):
+        return self._pool._acquire().__await__()
+
+    async def __aenter__(self):
+        self._conn = await self._pool._acquire()
+        return self._conn
+
+    async def __aexit__(self, *exc_info):
+        await self._pool.release(self._conn)
+
+
+class FakePool:
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.connections = []
+        self.released = []
+        self.failures = 0
+
+    def acquire(self):
+        return FakeAcquire(self)
+
+    async def _acquire(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("connection refused")
+        if self.connection is not None:
+            return self.connection
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    async def release(self, conn):
+        self.released.append(conn)
+
+    async def close(self):
+        pass
+
+
+class FakeDatabase(db.Database):
+    "Records each session it loads instead of reading character rows."
+
+    __slots__ = ("loads",)
+    LISTEN_RETRY_TIME = 0
+
+    def __init__(self):
+        super().__init__()
+        self.loads = []
+
+    async def _get_session(self, account_id, character_id):
+        self.loads.append((account_id, character_id))
+        return object()
+
+
+class TestSessionNotifications(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = FakeDatabase()
+        self.db._pool = self.pool = FakePool()
+        await self.db._listen()
+        self.addAsyncCleanup(self.db.__aexit__, None, None, None)
+
+    def notify(self, node, account_id, character_id):
+        payload = json.dumps(
+            {"node": node, "account_id": account_id, "character_id": character_id}
+        )
+        self.db._on_session_change(None, 0, db.SESSION_CHANNEL, payload)
+
+    async def test_payload_has_no_tokens(self):
+        conn = FakeConnection()
+        await db._notify_session_change(conn, "node", 1, 10)
+        _, channel, payload = conn.executed[0]
+        self.assertEqual(channel, db.SESSION_CHANNEL)
+        self.assertEqual(
+            json.loads(payload), {"node": "node", "account_id": 1, "character_id": 10}
+        )
+
+    async def test_change_reloads_character(self):
+        await self.db.get_session(1, 10)
+        await self.db.get_session(2, 10)
+        await self.db.get_session(1, 11)
+
+        # Our own changes are already in our cache.
+        self.notify(self.db._node, 1, 10)
+        self.assertEqual(len(self.db._cache), 3)
+
+        # Another node's change drops the character from every account.
+        self.notify("other", 1, 10)
+        self.assertEqual(set(self.db._cache), {(1, 11)})
+        self.assertEqual(set(self.db._timerhandles), {(1, 11)})
+        await self.db.get_session(1, 10)
+        self.assertEqual(self.db.loads[-1], (1, 10))
+        self.assertEqual(len(self.db.loads), 4)
+
+    async def test_deletion_evicts(self):
+        await self.db.get_session(1, 10)
+        self.notify("other", None, 10)
+        self.assertEqual(self.db._cache, {})
+
+    async def test_relisten(self):
+        await self.db.get_session(1, 10)
+        listener = self.db._listener
+        self.pool.failures = 1
+
+        # Whatever was missed while disconnected, nothing cached is trusted.
+        listener.termination_listeners[0](listener)
+        self.assertEqual(self.db._cache, {})
+        task = self.db._listen_task
+        # A second termination doesn't start a second reconnection.
+        listener.termination_listeners[0](listener)
+        self.assertIs(self.db._listen_task, task)
+
+        await task
+        self.assertIsNone(self.db._listen_task)
+        self.assertIn(listener, self.pool.released)
+        self.assertIsNot(self.db._listener, listener)
+        self.assertEqual(self.db._listener.listeners[0][0], db.SESSION_CHANNEL)
+
+    async def test_relisten_is_cancelled_on_exit(self):
+        listener = self.db._listener
+        self.pool.failures = 3
+        listener.termination_listeners[0](listener)
+        task = self.db._listen_task
+        await asyncio.sleep(0)
+        await self.db.__aexit__(None, None, None)
+        await asyncio.sleep(0)
+        self.assertTrue(task.cancelled())
+
+
+class FakeBudget:
+    """
+    The esi_error_budget and esi_limiter_node tables, and what the queries
+    PostgresESILimiter makes do to them, with reset_at left out.
+    """
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.response_time = None
+        self.budget_writes = 0
+        self.occupancy = {}
+        self.heartbeats = 0
+        # Releases wait for this, once it's cleared.
+        self.releasing = asyncio.Event()
+        self.releasing.set()
+
+    async def fetchval(self, query, node):
+        assert query == "SELECT esi_limiter_acquire($1)"
+        if node not in self.occupancy or sum(self.occupancy.values()) >= self.remaining:
+            return False
+        self.occupancy[node] += 1
+        return True
+
+    async def execute(self, query, *args):
+        if query.startswith("SELECT esi_limiter_release("):
+            await self.releasing.wait()
+            node, errored = args
+            self.occupancy[node] = max(self.occupancy[node] - 1, 0)
+            if errored:
+                self.remaining -= 1
+        elif query.startswith("INSERT INTO esi_limiter_node "):
+            self.occupancy[args[0]] = 0
+        elif query.startswith("UPDATE esi_limiter_node SET heartbeat"):
+            self.heartbeats += 1
+        elif query.startswith("UPDATE esi_error_budget SET remaining"):
+            remaining, response_time, _ = args
+            self.budget_writes += 1
+            if self.response_time is None or self.response_time <= response_time:
+                self.remaining, self.response_time = remaining, response_time
+        elif query.startswith("DELETE FROM esi_limiter_node "):
+            del self.occupancy[args[0]]
+
+
+class QuickPostgresESILimiter(db.PostgresESILimiter):
+    __slots__ = ()
+    HEARTBEAT_INTERVAL = 0.01
+    # Long enough that waiters are only ever woken, not polling.
+    POLL_INTERVAL = 10
+
+
+class TestPostgresESILimiter(unittest.IsolatedAsyncioTestCase):
+    async def limiter(self, node):
+        limiter = QuickPostgresESILimiter(self.pool, node)
+        await limiter.start()
+        self.addAsyncCleanup(limiter.close)
+        return limiter
+
+    async def asyncSetUp(self):
+        self.budget = FakeBudget(2)
+        self.pool = FakePool(self.budget)
+
+    async def test_nodes_share_budget(self):
+        a = await self.limiter("a")
+        b = await self.limiter("b")
+        async with a:
+            self.assertTrue(await b.acquire_nowait())
+            self.assertFalse(await a.acquire_nowait())
+            self.assertEqual(self.budget.occupancy, {"a": 1, "b": 1})
+            await b.__aexit__(None, None, None)
+            self.assertEqual(self.budget.occupancy, {"a": 1, "b": 0})
+        self.assertEqual(self.budget.occupancy, {"a": 0, "b": 0})
+
+    async def test_errored_release_lowers_budget(self):
+        limiter = await self.limiter("a")
+        with self.assertRaises(aiohttp.ClientResponseError):
+            async with limiter:
+                raise aiohttp.ClientResponseError(None, (), status=503)
+        # A 4xx isn't ESI's fault.
+        with self.assertRaises(aiohttp.ClientResponseError):
+            async with limiter:
+                raise aiohttp.ClientResponseError(None, (), status=404)
+        self.assertEqual(self.budget.remaining, 1)
+        self.assertEqual(self.budget.occupancy, {"a": 0})
+
+    async def test_release_wakes_waiters(self):
+        self.budget.remaining = 1
+        limiter = await self.limiter("a")
+        order = []
+
+        async def request(name, hold):
+            async with limiter:
+                order.append(name)
+                await hold.wait()
+
+        first_done = asyncio.Event()
+        first = asyncio.create_task(request("first", first_done))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(request("second", asyncio.Event()))
+        await asyncio.sleep(0.01)
+        self.assertEqual(order, ["first"])
+        # Hedges don't jump the queue.
+        self.assertFalse(await limiter.acquire_nowait())
+
+        first_done.set()
+        await first
+        await asyncio.sleep(0.01)
+        self.assertEqual(order, ["first", "second"])
+        second.cancel()
+
+    async def test_set_remaining_wakes_waiters(self):
+        self.budget.remaining = 0
+        limiter = await self.limiter("a")
+        acquired = asyncio.create_task(limiter.__aenter__())
+        await asyncio.sleep(0.01)
+        self.assertFalse(acquired.done())
+
+        now = datetime.datetime.now(datetime.UTC)
+        limiter.set_remaining(now, 1)
+        # The same budget again isn't written again.
+        limiter.set_remaining(now, 1)
+        await asyncio.wait_for(acquired, 1)
+        self.assertEqual(self.budget.budget_writes, 1)
+        await limiter.__aexit__(None, None, None)
+
+    async def test_cancelled_release_completes(self):
+        limiter = await self.limiter("a")
+        self.budget.releasing.clear()
+
+        async def request():
+            async with limiter:
+                pass
+
+        task = asyncio.create_task(request())
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.budget.occupancy, {"a": 1})
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.budget.releasing.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.budget.occupancy, {"a": 0})
+
+    async def test_heartbeat(self):
+        limiter = QuickPostgresESILimiter(self.pool, "a")
+        await limiter.start()
+        await asyncio.sleep(0.05)
+        self.assertGreater(self.budget.heartbeats, 0)
+        await limiter.close()
+        self.assertEqual(self.budget.occupancy, {})
+        heartbeats = self.budget.heartbeats
+        await asyncio.sleep(0.03)
+        self.assertEqual(self.budget.heartbeats, heartbeats)
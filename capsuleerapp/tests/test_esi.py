@@ -0,0 +1,194 @@
+import asyncio
+import datetime
+import aiohttp
+import unittest
+import unittest.mock
+
+from capsuleerapp import esi
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from capsuleerapp.types import (
+    Response,
+    ESILimiter,
+    RouteLatency,
+    CircuitBreaker,
+    ESIUnavailable,
+)
+
+
+class QuickCircuitBreaker(CircuitBreaker):
+    __slots__ = ()
+    FAILURES = 2
+    OPEN_TIME = 0.02
+
+
+class StaleESISession(esi.PublicESISession):
+    __slots__ = ()
+    get_type_information = esi._esi(
+        3, "universe/types/{}", "get_type_information", stale=True
+    )
+
+
+class FakeAnswer:
+    status = 200
+    headers = {"Date": "Mon, 01 Jan 2024 00:00:00 GMT"}
+
+
+class TestCircuitBreaker(unittest.IsolatedAsyncioTestCase):
+    async def test_trips_and_recovers(self):
+        breaker = QuickCircuitBreaker("route")
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+        # Only one request probes, and when it fails it stays open longer.
+        await asyncio.sleep(0.03)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        await asyncio.sleep(0.03)
+        self.assertFalse(breaker.allow())
+        await asyncio.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+
+class TestStaleResponses(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = StaleESISession("http://esi.invalid")
+        await self.session.__aenter__()
+        self.addAsyncCleanup(self.session.__aexit__, None, None, None)
+        self.down = False
+        self.requests = 0
+
+        async def request_with_retry(*args):
+            breaker = args[6]
+            self.requests += 1
+            if self.down:
+                breaker.failure()
+                raise aiohttp.ClientResponseError(None, (), status=503)
+            breaker.success()
+            return Response({"requests": self.requests}, FakeAnswer)
+
+        for patch in (
+            unittest.mock.patch.object(esi, "request_with_retry", request_with_retry),
+            unittest.mock.patch.object(esi, "CircuitBreaker", QuickCircuitBreaker),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def test_stale_while_revalidate(self):
+        fresh = await self.session.get_type_information(1)
+        self.assertFalse(fresh.stale)
+
+        self.down = True
+        for _ in range(QuickCircuitBreaker.FAILURES):
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await self.session.get_type_information(1)
+        # The breaker is open: no request is made.
+        stale = await self.session.get_type_information(1)
+        self.assertTrue(stale.stale)
+        self.assertEqual(stale.result, fresh.result)
+        self.assertEqual(self.requests, 3)
+        # Nothing to serve for a request which never succeeded.
+        with self.assertRaises(ESIUnavailable):
+            await self.session.get_type_information(2)
+
+        # Once it may probe, the caller still isn't kept waiting for it.
+        self.down = False
+        await asyncio.sleep(0.03)
+        stale = await self.session.get_type_information(1)
+        self.assertTrue(stale.stale)
+        await asyncio.sleep(0)
+        fresh = await self.session.get_type_information(1)
+        self.assertFalse(fresh.stale)
+        self.assertEqual(fresh.result, {"requests": 5})
+
+    async def test_market_pages_are_not_kept(self):
+        page = {"page": "1"}
+        await self.session._get_region_orders(10000002, params=page)
+        self.assertEqual(len(self.session._last_good), 0)
+
+        self.down = True
+        for _ in range(QuickCircuitBreaker.FAILURES):
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await self.session._get_region_orders(10000002, params=page)
+        with self.assertRaises(ESIUnavailable):
+            await self.session._get_region_orders(10000002, params=page)
+
+
+class TestHedging(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_request_is_hedged(self):
+        calls = []
+
+        async def handler(request):
+            calls.append(request.path)
+            if len(calls) == 1:
+                await asyncio.sleep(0.3)
+            return web.json_response(len(calls))
+
+        app = web.Application()
+        app.router.add_get("/", handler)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+
+        latency = RouteLatency()
+        for _ in range(RouteLatency.MIN_SAMPLES):
+            latency.record(0.01)
+        limiter = ESILimiter()
+        limiter.set_remaining(datetime.datetime.now(datetime.UTC), 2)
+        async with aiohttp.ClientSession() as session:
+            url = str(server.make_url("/"))
+            resp = await esi.request_with_retry(
+                limiter, session, url, {}, None, latency=latency
+            )
+            # The second request answered; the first was given up on.
+            self.assertEqual(resp.result, 2)
+            self.assertEqual(len(calls), 2)
+
+            # Without budget to spare, there's no second request.
+            calls.clear()
+            limiter.set_remaining(datetime.datetime.now(datetime.UTC), 1)
+            resp = await esi.request_with_retry(
+                limiter, session, url, {}, None, latency=latency
+            )
+            self.assertEqual((resp.result, len(calls)), (1, 1))
+
+    async def test_hedging_does_not_lower_p95(self):
+        calls = []
+
+        async def handler(request):
+            calls.append(request.path)
+            # Every first request is slow; every hedge is quick.
+            if len(calls) % 2:
+                await asyncio.sleep(0.3)
+            return web.json_response(len(calls))
+
+        app = web.Application()
+        app.router.add_get("/", handler)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+
+        class QuickLatency(RouteLatency):
+            __slots__ = ()
+            SAMPLES = RouteLatency.MIN_SAMPLES
+
+        latency = QuickLatency()
+        for _ in range(latency.SAMPLES):
+            latency.record(0.02)
+        limiter = ESILimiter()
+        limiter.set_remaining(datetime.datetime.now(datetime.UTC), 100)
+        async with aiohttp.ClientSession() as session:
+            url = str(server.make_url("/"))
+            for _ in range(latency.SAMPLES):
+                await esi.request_with_retry(
+                    limiter, session, url, {}, None, latency=latency
+                )
+        self.assertEqual(len(calls), 2 * latency.SAMPLES)
+        self.assertGreaterEqual(latency.p95(), 0.02)
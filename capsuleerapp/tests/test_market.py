@@ -0,0 +1,280 @@
+import datetime
+import itertools
+import unittest
+import unittest.mock
+
+from capsuleerapp.esi import PublicESISession
+from capsuleerapp.types import ItemTypes, Response, CitadelRegistry, ForbiddenCitadels
+from capsuleerapp.market import OrderBook, MarketData
+from capsuleerapp.isk_for_sp import get_isk_for_sp_options
+
+
+order_ids = itertools.count()
+
+
+def order(type_id, price, is_buy_order=False, volume=1, order_id=None):
+    return {
+        "order_id": next(order_ids) if order_id is None else order_id,
+        "type_id": type_id,
+        "price": price,
+        "is_buy_order": is_buy_order,
+        "volume_remain": volume,
+    }
+
+
+class FakeESI:
+    def __init__(self):
+        self.requests = []
+        self.broken = set()
+        self.lifetime = datetime.timedelta(minutes=5)
+
+    def _answer(self, key, orders):
+        self.requests.append(key)
+        if key in self.broken:
+            raise RuntimeError(key)
+        return orders, datetime.datetime.now(datetime.UTC) + self.lifetime
+
+    async def get_region_type_orders(self, region_id, type_id):
+        return self._answer(type_id, [order(type_id, 10.0), order(type_id, 1.0, True)])
+
+    async def get_structure_market(self, session, structure_id):
+        if structure_id == 1_001:
+            return None
+        return self._answer(structure_id, [order(1, 9.0), order(2, 5.0), order(3, 1.0)])
+
+
+class TestMarketData(unittest.IsolatedAsyncioTestCase):
+    async def test_refresh(self):
+        esi = FakeESI()
+        market = MarketData(esi)
+        await market.refresh(None, [1, 2], [1_000, 1_001])
+        self.assertEqual(sorted(esi.requests), [1, 2, 1_000])
+        self.assertEqual(market.best_price(1), 9.0)
+        self.assertEqual(market.best_price(2), 5.0)
+        self.assertEqual(market.best_price(2, "buy"), 1.0)
+        self.assertIsNone(market.best_price(3))
+
+        # Nothing has expired yet.
+        esi.requests.clear()
+        await market.refresh(None, [1, 2], [1_000, 1_001])
+        self.assertEqual(esi.requests, [])
+
+        # Only what's new is fetched.
+        await market.refresh(None, [1, 2, 4], [1_000])
+        self.assertEqual(esi.requests, [4])
+
+    async def test_citadel_orders_counted_once(self):
+        esi = FakeESI()
+        market = MarketData(esi)
+        await market.refresh(None, [1], [1_000])
+        # The region's orders include the citadel's.
+        citadel_order = market._citadels[1_000].orders[0]
+        market._types[1].orders.append(citadel_order)
+        self.assertEqual(market.order_book(1).prices, [9.0, 10.0])
+
+    async def test_failure_keeps_old_orders(self):
+        esi = FakeESI()
+        esi.lifetime = datetime.timedelta(0)
+        market = MarketData(esi)
+        await market.refresh(None, [1], [1_000])
+        esi.broken.add(1_000)
+        esi.requests.clear()
+        await market.refresh(None, [1], [1_000])
+        self.assertEqual(sorted(esi.requests), [1, 1_000])
+        self.assertEqual(market.best_price(1), 9.0)
+
+
+class TestOrderBook(unittest.TestCase):
+    def test_fill_cost(self):
+        orders = [
+            order(1, 12.0, volume=5),
+            order(1, 10.0, volume=2),
+            order(1, 9.0, True),
+        ]
+        book = OrderBook.from_orders(orders)
+        self.assertEqual(book.prices, [10.0, 12.0])
+        self.assertEqual(book.volumes, [2, 7])
+        self.assertEqual(book.fill_cost(1), 10.0)
+        self.assertEqual(book.fill_cost(2), 20.0)
+        self.assertEqual(book.fill_cost(4), 44.0)
+        self.assertEqual(book.fill_cost(7), 80.0)
+        self.assertIsNone(book.fill_cost(8))
+        self.assertEqual(OrderBook.from_orders(orders, True).fill_cost(1), 9.0)
+        self.assertIsNone(OrderBook([], []).fill_cost(1))
+
+
+class FakeHubESI(FakeESI):
+    "Sells each type in region 1 only, and nothing in any citadel."
+
+    async def get_region_type_orders(self, region_id, type_id):
+        orders = [order(type_id, float(type_id))] if region_id == 1 else []
+        return self._answer((region_id, type_id), orders)
+
+    async def get_market_citadel_ids(self, region_id):
+        return set()
+
+    async def get_market_group(self, market_group_id):
+        return {"types": [ItemTypes.MasterAtArms.value]}
+
+    async def get_type_information(self, type_id):
+        attributes = {330: 86_400_000, **{i: 10 for i in range(175, 180)}}
+        result = {
+            "name": "Master-at-Arms Cerebral Accelerator",
+            "published": True,
+            "market_group_id": 2487,
+            "dogma_attributes": [
+                {"attribute_id": k, "value": v} for k, v in attributes.items()
+            ],
+        }
+        return unittest.mock.Mock(result=result)
+
+
+class TestTradeHubs(unittest.IsolatedAsyncioTestCase):
+    async def test_prices_per_hub(self):
+        esi = FakeHubESI()
+        markets = {"A": MarketData(esi, 1), "B": MarketData(esi, 2)}
+        hubs, lsi, ssi, accelerators, as_of, books = await get_isk_for_sp_options(
+            esi, None, markets
+        )
+        self.assertEqual(hubs, ["A", "B"])
+        lsi_type_id = ItemTypes.LargeSkillInjector.value
+        self.assertEqual(lsi, [float(lsi_type_id), None])
+        [accelerator] = accelerators
+        self.assertEqual(accelerator.prices, [float(accelerator.id), None])
+        self.assertEqual(len(esi.requests), 6)
+        self.assertEqual(
+            books[0], (lsi_type_id, [([float(lsi_type_id)], [1]), ([], [])])
+        )
+
+
+class TestForbiddenCitadels(unittest.IsolatedAsyncioTestCase):
+    async def test_backoff(self):
+        stored = []
+
+        class Registry(ForbiddenCitadels):
+            __slots__ = ()
+
+            async def _store(self, structure_id, failures, probe, next_probe):
+                stored.append((structure_id, failures, next_probe - probe))
+
+            async def _forget(self, structure_id):
+                stored.append((structure_id, None, None))
+
+        past = datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=1)
+        registry = Registry([(1, 3, past)])
+        self.assertFalse(registry.is_forbidden(1))
+        await registry.forbidden(1)
+        self.assertTrue(registry.is_forbidden(1))
+        await registry.forbidden(2)
+        await registry.allowed(2)
+        await registry.allowed(3)
+        hour = datetime.timedelta(hours=1)
+        self.assertEqual(stored, [(1, 4, 8 * hour), (2, 1, hour), (2, None, None)])
+        self.assertFalse(registry.is_forbidden(2))
+
+
+class TestCitadelRegistry(unittest.IsolatedAsyncioTestCase):
+    async def test_observe(self):
+        stored = []
+
+        class Registry(CitadelRegistry):
+            __slots__ = ()
+
+            async def _store(self, region_id, structure_ids, seen):
+                stored.append((region_id, sorted(structure_ids)))
+
+        long_ago = datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=8)
+        recently = datetime.datetime.now(datetime.UTC) - datetime.timedelta(hours=1)
+        citadel = 1_035_466_617_946
+        registry = Registry([(citadel, 1, long_ago), (citadel + 1, 1, recently)])
+        self.assertEqual(registry.citadel_ids(1), {citadel + 1})
+
+        orders = [{"location_id": 60003760}, {"location_id": citadel}]
+        self.assertEqual(await registry.observe(1, orders), {citadel})
+        await registry.seen(1, [citadel + 1])
+        self.assertEqual(registry.citadel_ids(1), {citadel, citadel + 1})
+        self.assertEqual(registry.citadel_ids(2), set())
+        # The recent sighting isn't stored again until STORE_INTERVAL passes.
+        self.assertEqual(stored, [(1, [citadel])])
+        self.assertGreater(registry.last_seen(1), recently)
+
+
+class FakeAnswer:
+    def __init__(self, status, etag):
+        self.status = status
+        self.headers = {
+            "Date": "Mon, 01 Jan 2024 00:00:00 GMT",
+            "X-Pages": "2",
+            "ETag": etag,
+        }
+
+
+class PagedESISession(PublicESISession):
+    "Answers with the buy order pages in region 1, by ETag."
+
+    __slots__ = ("pages", "requests")
+
+    def __init__(self):
+        super().__init__("http://esi.invalid")
+        self.pages = {}
+        self.requests = 0
+
+    async def _get_region_orders(self, region_id, params, etag=None):
+        self.requests += 1
+        current_etag, orders = self.pages[int(params["page"])]
+        if etag == current_etag:
+            return Response(None, FakeAnswer(304, current_etag))
+        return Response(orders, FakeAnswer(200, current_etag))
+
+
+class TestCitadelScan(unittest.IsolatedAsyncioTestCase):
+    citadel = 1_035_466_617_946
+
+    def citadel_order(self, citadel):
+        return {**order(1, 5.0, is_buy_order=True), "location_id": citadel}
+
+    async def test_unchanged_pages_carry_over(self):
+        async with PagedESISession() as session:
+            session.pages = {
+                1: ('"1"', [self.citadel_order(self.citadel)]),
+                2: ('"2"', [self.citadel_order(self.citadel + 1)]),
+            }
+            scanned = await session._scan_region_citadels(1, {})
+            self.assertEqual(
+                scanned,
+                {1: ('"1"', {self.citadel}), 2: ('"2"', {self.citadel + 1})},
+            )
+
+            # Page 1 is a 304 now, with no orders to observe; page 2 changed.
+            registry = CitadelRegistry()
+            session.use_citadel_registry(registry)
+            session.pages[2] = '"2b"', [self.citadel_order(60003760)]
+            scanned = await session._scan_region_citadels(1, scanned)
+            self.assertEqual(scanned, {1: ('"1"', {self.citadel}), 2: ('"2b"', set())})
+            self.assertEqual(registry.citadel_ids(1), {self.citadel})
+
+    async def test_scans_when_nothing_seen(self):
+        now = datetime.datetime.now(datetime.UTC)
+        async with PagedESISession() as session:
+            session.pages = {
+                1: ('"1"', [self.citadel_order(self.citadel)]),
+                2: ('"2"', []),
+            }
+            # A citadel was seen recently, so there's no need to look.
+            session.use_citadel_registry(CitadelRegistry([(self.citadel, 1, now)]))
+            self.assertEqual(await session.get_market_citadel_ids(1), {self.citadel})
+            self.assertEqual(session.requests, 0)
+
+            long_ago = now - session.CITADEL_SCAN_INTERVAL * 2
+            registry = CitadelRegistry([(self.citadel + 1, 1, long_ago)])
+            session.use_citadel_registry(registry)
+            self.assertEqual(
+                await session.get_market_citadel_ids(1),
+                {self.citadel, self.citadel + 1},
+            )
+            self.assertEqual(session.requests, 2)
+            # Nor is there once it has just looked, even if it found nothing.
+            session.pages[1] = '"1b"', []
+            self.assertEqual(await session.get_market_citadel_ids(2), set())
+            self.assertEqual(await session.get_market_citadel_ids(2), set())
+            self.assertEqual(session.requests, 4)
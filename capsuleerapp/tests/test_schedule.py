@@ -0,0 +1,22 @@
+import time
+import asyncio
+import unittest
+
+from capsuleerapp.schedule import CompletionScheduler
+
+
+class TestCompletionScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_schedule(self):
+        completed = []
+        scheduler = CompletionScheduler(completed.append)
+        now = time.time()
+        scheduler.schedule("later", now + 0.02)
+        scheduler.schedule("sooner", now + 0.01)
+        scheduler.schedule("cancelled", now)
+        scheduler.schedule("replaced", now + 60)
+        scheduler.schedule("replaced", now)
+        scheduler.cancel("cancelled")
+        self.assertIn("later", scheduler)
+        await asyncio.sleep(0.05)
+        self.assertEqual(completed, ["replaced", "sooner", "later"])
+        self.assertNotIn("later", scheduler)
@@ -0,0 +1,75 @@
+import datetime
+import tempfile
+import unittest
+
+from capsuleerapp.market import MarketData, MarketEntry
+from capsuleerapp.snapshot import SnapshotArchive
+
+
+def order(order_id, type_id, price, is_buy_order=False, location_id=60003760):
+    return {
+        "order_id": order_id,
+        "type_id": type_id,
+        "location_id": location_id,
+        "price": price,
+        "volume_remain": 3,
+        "is_buy_order": is_buy_order,
+    }
+
+
+class TestSnapshotArchive(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.archive = SnapshotArchive(directory.name)
+        self.addCleanup(self.archive.close)
+        self.directory = directory.name
+
+    def market(self, region_id, price):
+        now = datetime.datetime.now(datetime.UTC).replace(microsecond=0)
+        market = MarketData(None, region_id)
+        region_orders = [order(1, 1, price), order(2, 1, price / 2, True)]
+        citadel_orders = [order(3, 1, price - 1, location_id=1_000_000_000_001)]
+        market.restore(
+            [
+                (False, 1, MarketEntry(region_orders, now, now)),
+                (True, 1_000_000_000_001, MarketEntry(citadel_orders, now, now)),
+            ]
+        )
+        return market
+
+    def test_round_trip(self):
+        markets = [self.market(10, 100.0), self.market(20, 50.0)]
+        self.archive.add(1_000, markets)
+        snapshot = self.archive.latest()
+        self.assertEqual((snapshot.time, snapshot.rows), (1_000, 6))
+        self.assertEqual(snapshot.best_price(1, 10), 99.0)
+        self.assertEqual(snapshot.best_price(1, 20, "buy"), 25.0)
+        self.assertIsNone(snapshot.best_price(2, 10))
+
+        restored = MarketData(None, 20)
+        restored.restore(snapshot.entries(20))
+        self.assertEqual(
+            sorted(o["order_id"] for o in restored.orders(1)),
+            sorted(o["order_id"] for o in markets[1].orders(1)),
+        )
+        self.assertEqual(restored.best_price(1), 49.0)
+        self.assertEqual(restored.oldest().timestamp(), 1_000)
+
+    def test_history(self):
+        retention = int(SnapshotArchive.RETENTION.total_seconds())
+        self.archive.add(1_000, [self.market(10, 100.0)])
+        self.archive.add(2_000, [self.market(10, 80.0)])
+        self.assertEqual(
+            self.archive.history(1, 10, 0), [(1_000, 99.0, 50.0), (2_000, 79.0, 40.0)]
+        )
+        self.assertEqual(self.archive.history(1, 10, 1_500), [(2_000, 79.0, 40.0)])
+
+        # Another process sees what was added, and old snapshots are deleted.
+        other = SnapshotArchive(self.directory)
+        self.addCleanup(other.close)
+        self.archive.add(1_500 + retention, [self.market(10, 60.0)])
+        other.discover()
+        self.assertEqual(
+            [p.time for p in other.history(1, 10, 0)], [2_000, 1_500 + retention]
+        )
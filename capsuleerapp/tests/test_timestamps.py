@@ -0,0 +1,21 @@
+import datetime
+import unittest
+from unittest import mock
+
+from capsuleerapp import timestamps
+
+
+class TestTimestamps(unittest.TestCase):
+    stamps = ["2024-10-01T12:34:56Z", "1999-12-31T23:59:59Z"]
+    expected = [1727786096, 946684799]
+
+    def test_parse(self):
+        parsed = timestamps.parse(self.stamps[0])
+        self.assertEqual(parsed.utcoffset(), datetime.timedelta(0))
+        self.assertEqual(parsed.timestamp(), self.expected[0])
+
+    def test_epochs(self):
+        self.assertEqual(timestamps.epoch(self.stamps[1]), self.expected[1])
+        self.assertEqual(list(timestamps.epochs(self.stamps)), self.expected)
+        with mock.patch.object(timestamps, "numpy", None):
+            self.assertEqual(timestamps.epochs(self.stamps), self.expected)
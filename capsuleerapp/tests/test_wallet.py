@@ -0,0 +1,38 @@
+import unittest
+from unittest import mock
+
+from capsuleerapp import wallet
+
+
+class TestWallet(unittest.TestCase):
+    def test_reduce_journal(self):
+        first_date, string_table, reduced = wallet.reduce_journal(
+            [1000, 900, 400], [5.0, -2.0, 1.5], ["b", "a", "b"]
+        )
+        self.assertEqual(first_date, 1000)
+        self.assertEqual(string_table, ("b", "a"))
+        self.assertEqual(reduced, [(0, 5.0, 0), (100, -2.0, 1), (600, 1.5, 0)])
+
+    def test_aggregate_journal(self):
+        dates = [1250, 1100, 1050, 1000, 900]
+        ref_types = ["bounty_prizes", "market_escrow", "bounty_prizes", "tax", "tax"]
+        amounts = [10.0, -4.0, 5.0, -1.0, -100.0]
+        # Nothing happened in the last two buckets, up to now (1450).
+        expected = (
+            ("bounty_prizes", "market_escrow", "tax"),
+            [[5.0, 0.0, 10.0, 0.0, 0.0], [0.0] * 5, [0.0] * 5],
+            [[0.0] * 5, [0.0, -4.0, 0.0, 0.0, 0.0], [-1.0, 0.0, 0.0, 0.0, 0.0]],
+        )
+        args = dates, ref_types, amounts, 1000, 1450, 100
+        self.assertEqual(wallet.aggregate_journal(*args), expected)
+        with mock.patch.object(wallet, "numpy", None):
+            self.assertEqual(wallet.aggregate_journal(*args), expected)
+
+    def test_aggregate_empty_journal(self):
+        expected = ((), [], [])
+        self.assertEqual(
+            wallet.aggregate_journal([], [], [], 1000, 1250, 100), expected
+        )
+        with mock.patch.object(wallet, "numpy", None):
+            result = wallet.aggregate_journal([], [], [], 1000, 1250, 100)
+        self.assertEqual(result, expected)
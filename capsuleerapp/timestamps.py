@@ -0,0 +1,39 @@
+"""
+Decoding of ESI timestamps, which are always UTC and always formatted as
+"YYYY-MM-DDTHH:MM:SSZ".
+
+datetime.fromisoformat() is around ten times faster than strptime() for
+these. When there is a whole column of them, such as the dates of a wallet
+journal page, epochs() converts them at once with NumPy if it is installed,
+which is another five times faster.
+"""
+
+import datetime
+from collections.abc import Sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def parse(timestamp: str) -> datetime.datetime:
+    "An ESI timestamp as an aware datetime."
+    return datetime.datetime.fromisoformat(timestamp)
+
+
+def epoch(timestamp: str) -> int:
+    "An ESI timestamp as seconds since the Unix epoch."
+    return int(datetime.datetime.fromisoformat(timestamp).timestamp())
+
+
+def epochs(timestamps: Sequence[str]) -> Sequence[int]:
+    """
+    ESI timestamps as seconds since the Unix epoch: an int64 array if NumPy
+    is installed, otherwise a list.
+    """
+    if numpy is None:
+        return [epoch(timestamp) for timestamp in timestamps]
+    # NumPy warns about time zone designators, so drop the Z; it's all UTC.
+    naive = numpy.array([timestamp[:-1] for timestamp in timestamps], "datetime64[s]")
+    return naive.astype(numpy.int64)
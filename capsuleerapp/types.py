@@ -1,16 +1,27 @@
+import os
 import abc
+import copy
+import sys
 import enum
 import json
+import time
+import fcntl
+import struct
 import aiohttp
+import tempfile
+import contextlib
 from types import TracebackType
 import asyncio
 import logging
 import datetime
-from typing import NamedTuple
-from collections.abc import Awaitable
+from typing import TypedDict, NamedTuple, NotRequired
+from collections.abc import Iterable, Iterator, Awaitable
 from operator import attrgetter
 from collections import deque
 from email.utils import parsedate_to_datetime
+from multiprocessing import shared_memory, resource_tracker
+
+from .data import known_forbidden_citadel_ids
 
 logger = logging.getLogger(__name__)
 
@@ -28,12 +39,89 @@ class Character(NamedTuple):
 
 class AcceleratorInfo(NamedTuple):
     id: int
-    price: float
+    # In each trade hub, or None where there are none for sale.
+    prices: list[float | None]
     name: str
     magnitude: int
     duration: float
 
 
+class StoredSkillTrades(NamedTuple):
+    data: object
+    update_time: datetime.datetime
+    expires: datetime.datetime
+
+
+# Schemas of ESI responses, as far as we use them. With msgspec installed,
+# responses are validated against these while being decoded.
+
+
+class ESISkill(TypedDict):
+    skill_id: int
+    trained_skill_level: int
+    active_skill_level: int
+    skillpoints_in_skill: int
+
+
+class ESISkills(TypedDict):
+    skills: list[ESISkill]
+    total_sp: int
+    unallocated_sp: NotRequired[int]
+
+
+class ESISkillQueueItem(TypedDict):
+    skill_id: int
+    finished_level: int
+    queue_position: int
+    start_date: NotRequired[str]
+    finish_date: NotRequired[str]
+    training_start_sp: NotRequired[int]
+    level_start_sp: NotRequired[int]
+    level_end_sp: NotRequired[int]
+
+
+class ESIAttributes(TypedDict):
+    intelligence: int
+    memory: int
+    perception: int
+    willpower: int
+    charisma: int
+    bonus_remaps: NotRequired[int]
+    last_remap_date: NotRequired[str]
+    accrued_remap_cooldown_date: NotRequired[str]
+
+
+class ESIWalletJournalEntry(TypedDict):
+    id: int
+    date: str
+    ref_type: str
+    description: str
+    amount: NotRequired[float]
+    balance: NotRequired[float]
+    first_party_id: NotRequired[int]
+    second_party_id: NotRequired[int]
+    reason: NotRequired[str]
+    context_id: NotRequired[int]
+    context_id_type: NotRequired[str]
+    tax: NotRequired[float]
+    tax_receiver_id: NotRequired[int]
+
+
+class ESIMarketOrder(TypedDict):
+    order_id: int
+    type_id: int
+    location_id: int
+    price: float
+    volume_remain: int
+    volume_total: int
+    is_buy_order: bool
+    duration: int
+    issued: str
+    min_volume: int
+    range: str
+    system_id: NotRequired[int]
+
+
 class ItemTypes(enum.Enum):
     MasterAtArms = 48582
     Expert = 55826
@@ -59,6 +147,14 @@ class NoSuchCharacter(Exception):
     pass
 
 
+class ESIUnavailable(Exception):
+    "An ESI route's circuit breaker is open, and there's nothing stale to serve."
+
+    def __init__(self, route: str, retry_after: float) -> None:
+        super().__init__(f"{route} is unavailable for {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
 class JSONDict:
     __slots__ = "_data", "_filename", "_file"
 
@@ -118,7 +214,15 @@ class ABCSession(metaclass=abc.ABCMeta):
 
 
 class Response:
-    __slots__ = "_result", "_expires", "_last_modified", "headers", "_date"
+    __slots__ = (
+        "_result",
+        "_expires",
+        "_last_modified",
+        "headers",
+        "_date",
+        "status",
+        "stale",
+    )
 
     __getitem__ = property(attrgetter("_result.__getitem__"))
     __len__ = property(attrgetter("_result.__len__"))
@@ -127,15 +231,25 @@ class Response:
     get = property(attrgetter("_result.get"))
 
     def __init__(self, json_body, response_object):
-        self._expires = response_object.headers["Expires"]
+        # A 304 Not Modified (with a json_body of None) may lack these.
+        self._expires = response_object.headers.get("Expires")
         self._date = response_object.headers["Date"]
-        self._last_modified = response_object.headers["Last-Modified"]
+        self._last_modified = response_object.headers.get("Last-Modified")
         self.headers = response_object.headers
+        self.status = response_object.status
         self._result = json_body
+        # Whether this was served in place of a request ESI couldn't answer.
+        self.stale = False
 
     def __repr__(self):
         return f"Response({self._result!r})"
 
+    def as_stale(self) -> "Response":
+        "A copy marked stale."
+        stale = copy.copy(self)
+        stale.stale = True
+        return stale
+
     @property
     def date(self):
         date = self._date
@@ -167,7 +281,169 @@ class Response:
         return last_modified
 
 
-class ESILimiter:
+class CircuitBreaker:
+    """
+    Stops calling an ESI route which keeps failing. After FAILURES failed
+    attempts in a row it opens, and calls fail immediately. Once it has
+    been open for a while, one call is let through to see whether the route
+    has recovered: if it has, the breaker closes; if not, it stays open for
+    twice as long as before, up to OPEN_TIME_MAX.
+
+    Whoever is let through by allow() must report how it went with
+    success(), failure() or, if it never found out, abandon().
+    """
+
+    FAILURES = 5
+    OPEN_TIME = 10.0
+    OPEN_TIME_MAX = 300.0
+
+    __slots__ = "_route", "_failures", "_open_until", "_open_time", "_probing"
+
+    def __init__(self, route: str) -> None:
+        self._route = route
+        self._failures = 0
+        self._open_until: float | None = None
+        self._open_time = self.OPEN_TIME
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._open_until is not None
+
+    def retry_after(self) -> float:
+        "How long until a call will be let through again."
+        if self._open_until is None:
+            return 0.0
+        return max(0.0, self._open_until - time.monotonic())
+
+    def allow(self) -> bool:
+        if self._open_until is None:
+            return True
+        if self._probing or time.monotonic() < self._open_until:
+            return False
+        self._probing = True
+        return True
+
+    def success(self) -> None:
+        if self._open_until is not None:
+            logger.info("%s circuit breaker closed", self._route)
+        self._failures = 0
+        self._open_until = None
+        self._open_time = self.OPEN_TIME
+        self._probing = False
+
+    def failure(self) -> None:
+        self._failures += 1
+        if self._probing:
+            self._probing = False
+            self._open_time = min(self._open_time * 2, self.OPEN_TIME_MAX)
+        elif self._open_until is not None or self._failures < self.FAILURES:
+            return
+        logger.warning(
+            "%s circuit breaker open for %.0fs", self._route, self._open_time
+        )
+        self._open_until = time.monotonic() + self._open_time
+
+    def abandon(self) -> None:
+        self._probing = False
+
+
+class RouteLatency:
+    """
+    How long an ESI route's most recent SAMPLES requests took to answer,
+    for deciding when one has taken unusually long.
+    """
+
+    SAMPLES = 200
+    # Fewer than this, and the percentile means nothing.
+    MIN_SAMPLES = 20
+
+    __slots__ = "_samples", "_p95"
+
+    def __init__(self) -> None:
+        self._samples: deque[float] = deque(maxlen=self.SAMPLES)
+        self._p95: float | None = None
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._p95 = None
+
+    def p95(self) -> float | None:
+        if self._p95 is None and len(self._samples) >= self.MIN_SAMPLES:
+            samples = sorted(self._samples)
+            self._p95 = samples[int(len(samples) * 0.95)]
+        return self._p95
+
+
+def is_esi_server_error(exc: BaseException | None) -> bool:
+    "5xx responses count against the ESI error budget."
+    return isinstance(exc, aiohttp.ClientResponseError) and exc.status >= 500
+
+
+class ABCESILimiter(metaclass=abc.ABCMeta):
+    """
+    Bounds the number of in-flight ESI requests by the remaining ESI error
+    budget (X-ESI-Error-Limit-Remain). Used as an async context manager
+    around each request.
+    """
+
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def __aenter__(self) -> Awaitable[None]:
+        pass
+
+    @abc.abstractmethod
+    def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> Awaitable[None]:
+        pass
+
+    @abc.abstractmethod
+    def set_remaining(
+        self,
+        response_dt: datetime.datetime,
+        remaining: int,
+        timeout: float | None = None,
+    ) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def acquire_nowait(self) -> bool:
+        """
+        Takes some of the budget only if it's free right now, for requests
+        which are worth making only if nobody has to wait for them. If it
+        returns True, the budget is given back with __aexit__().
+        """
+        return False
+
+
+class AcquiredBudget:
+    "An async context manager giving back budget from acquire_nowait()."
+
+    __slots__ = ("_esilimiter",)
+
+    def __init__(self, esilimiter: ABCESILimiter) -> None:
+        self._esilimiter = esilimiter
+
+    async def __aenter__(self) -> None:
+        pass
+
+    def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> Awaitable[None]:
+        return self._esilimiter.__aexit__(exc_type, exc, tb)
+
+
+class ESILimiter(ABCESILimiter):
     def __init__(self) -> None:
         self._limit: int = 1
         self._occupancy = 0
@@ -207,6 +483,12 @@ class ESILimiter:
         # We don't increment occupancy; the resolver of the waiter
         # future does this for us.
 
+    async def acquire_nowait(self) -> bool:
+        if self._waiters or self._occupancy >= self._limit:
+            return False
+        self._occupancy += 1
+        return True
+
     def _unblock_waiters(self) -> None:
         while self._waiters and self._occupancy < self._limit:
             wait_fut = self._waiters.popleft()
@@ -220,11 +502,7 @@ class ESILimiter:
         exc: BaseException | None,
         tb: TracebackType | None,
     ) -> Awaitable[None]:
-        if (
-            exc is not None
-            and isinstance(exc, aiohttp.ClientResponseError)
-            and exc.status >= 500
-        ):
+        if is_esi_server_error(exc):
             previous_limit = self._limit
             self._limit = previous_limit - 1
             logger.info(
@@ -273,3 +551,364 @@ class ESILimiter:
             self._limit = 1
             logger.info("ESI ERROR LIMIT: reset timeout reached, increasing limit to 1")
             self._unblock_waiters()
+
+
+def _open_shared_memory(name: str, create: bool, size: int):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create, size, track=False)
+    shm = shared_memory.SharedMemory(name, create, size)
+    # Without this, the first process to exit would unlink the segment out
+    # from under everyone else.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedMemoryESILimiter(ABCESILimiter):
+    """
+    An ESILimiter whose budget lives in shared memory, so that several app
+    processes on the same host draw from one ESI error budget instead of
+    each believing it owns all of it.
+
+    Every process owns a slot recording its own occupancy. Slots of
+    processes that have died are reclaimed, so a crash can't leak budget.
+    """
+
+    SLOT_COUNT = 64
+    # Releases made by other processes can't resolve our futures, so
+    # waiters have to poll.
+    POLL_INTERVAL = 0.05
+
+    # limit, previous response timestamp, reset deadline (0 if none)
+    _HEADER = struct.Struct("<qdd")
+    # pid, occupancy
+    _SLOT = struct.Struct("<qq")
+
+    __slots__ = (
+        "_loop",
+        "_waiters",
+        "_done_fut",
+        "_poll_timer",
+        "_lock_fd",
+        "_shm",
+        "_slot_offset",
+    )
+
+    def __init__(self, name: str) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._waiters: deque[asyncio.Future] = deque()
+        self._done_fut = self._loop.create_future()
+        self._done_fut.set_result(None)
+        self._poll_timer: asyncio.TimerHandle | None = None
+        self._lock_fd = os.open(
+            os.path.join(tempfile.gettempdir(), f"{name}.lock"),
+            os.O_RDWR | os.O_CREAT,
+            0o600,
+        )
+        size = self._HEADER.size + self.SLOT_COUNT * self._SLOT.size
+        with self._locked():
+            try:
+                self._shm = _open_shared_memory(name, True, size)
+            except FileExistsError:
+                self._shm = _open_shared_memory(name, False, size)
+            else:
+                self._HEADER.pack_into(self._shm.buf, 0, 1, 0.0, 0.0)
+            self._slot_offset = self._claim_slot()
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _slot_offsets(self) -> range:
+        start = self._HEADER.size
+        stop = start + self.SLOT_COUNT * self._SLOT.size
+        return range(start, stop, self._SLOT.size)
+
+    def _claim_slot(self) -> int:
+        buf = self._shm.buf
+        for offset in self._slot_offsets():
+            pid, _ = self._SLOT.unpack_from(buf, offset)
+            if pid == 0 or not _pid_alive(pid):
+                self._SLOT.pack_into(buf, offset, os.getpid(), 0)
+                return offset
+        raise RuntimeError("No free shared ESI limiter slots")
+
+    def _total_occupancy(self, reap: bool = False) -> int:
+        buf = self._shm.buf
+        total = 0
+        for offset in self._slot_offsets():
+            pid, occupancy = self._SLOT.unpack_from(buf, offset)
+            if pid == 0:
+                continue
+            if reap and not _pid_alive(pid):
+                logger.info("reclaiming ESI limiter slot of dead process %d", pid)
+                self._SLOT.pack_into(buf, offset, 0, 0)
+                continue
+            total += occupancy
+        return total
+
+    def _add_occupancy(self, delta: int) -> None:
+        buf = self._shm.buf
+        pid, occupancy = self._SLOT.unpack_from(buf, self._slot_offset)
+        self._SLOT.pack_into(buf, self._slot_offset, pid, occupancy + delta)
+
+    def _effective_limit(self) -> int:
+        limit, previous_ts, deadline = self._HEADER.unpack_from(self._shm.buf, 0)
+        if deadline and time.time() >= deadline:
+            if limit < 1:
+                limit = 1
+                logger.info(
+                    "ESI ERROR LIMIT: reset timeout reached, increasing limit to 1"
+                )
+            self._HEADER.pack_into(self._shm.buf, 0, limit, previous_ts, 0.0)
+        return limit
+
+    def _try_acquire(self) -> bool:
+        with self._locked():
+            limit = self._effective_limit()
+            if self._total_occupancy() >= limit:
+                # Maybe a process died while holding some of the budget.
+                if self._total_occupancy(reap=True) >= limit:
+                    return False
+            self._add_occupancy(1)
+            return True
+
+    def _unblock_waiters(self) -> None:
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+                continue
+            if not self._try_acquire():
+                break
+            self._waiters.popleft()
+            waiter.set_result(None)
+
+        if self._waiters and self._poll_timer is None:
+            self._poll_timer = self._loop.call_later(self.POLL_INTERVAL, self._on_poll)
+
+    def _on_poll(self) -> None:
+        self._poll_timer = None
+        self._unblock_waiters()
+
+    def __aenter__(self) -> Awaitable[None]:
+        if not self._waiters and self._try_acquire():
+            return self._done_fut
+
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        self._unblock_waiters()
+        return waiter
+
+    async def acquire_nowait(self) -> bool:
+        return not self._waiters and self._try_acquire()
+
+    def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> Awaitable[None]:
+        with self._locked():
+            self._add_occupancy(-1)
+            if is_esi_server_error(exc):
+                buf = self._shm.buf
+                limit, previous_ts, deadline = self._HEADER.unpack_from(buf, 0)
+                if not deadline:
+                    deadline = time.time() + 30.0
+                self._HEADER.pack_into(buf, 0, limit - 1, previous_ts, deadline)
+                logger.info(
+                    "ESI ERROR LIMIT: %d -> %d (from 5xx error)", limit, limit - 1
+                )
+        self._unblock_waiters()
+        return self._done_fut
+
+    def set_remaining(
+        self,
+        response_dt: datetime.datetime,
+        remaining: int,
+        timeout: float | None = None,
+    ) -> None:
+        assert response_dt.tzinfo
+        response_ts = response_dt.timestamp()
+        with self._locked():
+            buf = self._shm.buf
+            previous_limit, previous_ts, deadline = self._HEADER.unpack_from(buf, 0)
+            if response_ts < previous_ts:
+                return
+            if previous_limit != remaining:
+                logger.info(
+                    "ESI ERROR LIMIT: %d -> %d (from upstream)",
+                    previous_limit,
+                    remaining,
+                )
+                if timeout is not None:
+                    deadline = time.time() + timeout
+            self._HEADER.pack_into(buf, 0, remaining, response_ts, deadline)
+        self._unblock_waiters()
+
+    async def close(self) -> None:
+        if self._poll_timer is not None:
+            self._poll_timer.cancel()
+            self._poll_timer = None
+        with self._locked():
+            self._SLOT.pack_into(self._shm.buf, self._slot_offset, 0, 0)
+        self._shm.close()
+        os.close(self._lock_fd)
+
+
+# Structures' IDs are far above those of NPC stations, which are all below
+# 100 million.
+STRUCTURE_ID_MIN = 1_000_000_000_000
+
+
+class CitadelRegistry:
+    """
+    The citadels with public markets in each region, learned from the
+    locations of the orders seen by any region order scan. One which
+    hasn't been seen for FORGET_AFTER is assumed to be gone.
+
+    This one only remembers for the life of the process; subclasses may
+    store sightings with _store(), which is only called for a citadel when
+    it is new or its stored sighting is older than STORE_INTERVAL.
+    """
+
+    FORGET_AFTER = datetime.timedelta(days=7)
+    STORE_INTERVAL = datetime.timedelta(days=1)
+
+    __slots__ = "_citadels", "_stored"
+
+    def __init__(
+        self, entries: Iterable[tuple[int, int, datetime.datetime]] = ()
+    ) -> None:
+        "entries are (structure id, region id, last seen)."
+        self._citadels = {s: (r, last_seen) for s, r, last_seen in entries}
+        # When each citadel's sighting was last stored.
+        self._stored = {s: last_seen for s, (_, last_seen) in self._citadels.items()}
+
+    async def observe(
+        self, region_id: int, orders: Iterable[ESIMarketOrder]
+    ) -> set[int]:
+        "Records the citadels the orders are in, returning their IDs."
+        seen = {
+            o["location_id"] for o in orders if o["location_id"] >= STRUCTURE_ID_MIN
+        }
+        await self.seen(region_id, seen)
+        return seen
+
+    async def seen(self, region_id: int, seen: Iterable[int]) -> None:
+        "Records that the citadels are still trading in the region."
+        now = datetime.datetime.now(datetime.UTC)
+        to_store = []
+        for structure_id in seen:
+            self._citadels[structure_id] = region_id, now
+            stored = self._stored.get(structure_id)
+            if stored is None or now - stored > self.STORE_INTERVAL:
+                self._stored[structure_id] = now
+                to_store.append(structure_id)
+        if to_store:
+            await self._store(region_id, to_store, now)
+
+    def citadel_ids(self, region_id: int) -> set[int]:
+        oldest = datetime.datetime.now(datetime.UTC) - self.FORGET_AFTER
+        return {
+            structure_id
+            for structure_id, (r, last_seen) in self._citadels.items()
+            if r == region_id and last_seen > oldest
+        }
+
+    def last_seen(self, region_id: int) -> datetime.datetime | None:
+        "The last time a citadel in the region was seen."
+        return max(
+            (last_seen for r, last_seen in self._citadels.values() if r == region_id),
+            default=None,
+        )
+
+    async def _store(
+        self, region_id: int, structure_ids: list[int], seen: datetime.datetime
+    ) -> None:
+        pass
+
+
+class ForbiddenCitadels:
+    """
+    Citadels whose markets we aren't allowed to see. Every 403 costs a unit
+    of the ESI error budget, so a citadel is only asked again after a wait
+    which doubles with each refusal, from RETRY_MIN up to RETRY_MAX. One
+    which lets us in again is forgotten.
+
+    This one only remembers for the life of the process; subclasses may
+    store the registry with _store() and _forget().
+    """
+
+    RETRY_MIN = datetime.timedelta(hours=1)
+    RETRY_MAX = datetime.timedelta(days=7)
+
+    __slots__ = "_entries"
+
+    def __init__(
+        self, entries: Iterable[tuple[int, int, datetime.datetime]] = ()
+    ) -> None:
+        "entries are (structure id, refusals, time to ask again)."
+        self._entries = {
+            structure_id: (failures, next_probe)
+            for structure_id, failures, next_probe in entries
+        }
+
+    @classmethod
+    def seeded(cls, *args, **kwargs) -> "ForbiddenCitadels":
+        """
+        A registry which, until they've been asked again, assumes that the
+        citadels known to have been forbidden still are.
+        """
+        registry = cls(*args, **kwargs)
+        next_probe = datetime.datetime.now(datetime.UTC) + cls.RETRY_MIN
+        for structure_id in known_forbidden_citadel_ids:
+            registry._entries.setdefault(structure_id, (1, next_probe))
+        return registry
+
+    def is_forbidden(self, structure_id: int) -> bool:
+        "Whether to skip asking for the structure's market for now."
+        try:
+            _, next_probe = self._entries[structure_id]
+        except KeyError:
+            return False
+        return datetime.datetime.now(datetime.UTC) < next_probe
+
+    async def forbidden(self, structure_id: int) -> None:
+        "Records that the structure refused us."
+        failures = self._entries.get(structure_id, (0, None))[0] + 1
+        now = datetime.datetime.now(datetime.UTC)
+        wait = min(self.RETRY_MIN * 2 ** (failures - 1), self.RETRY_MAX)
+        self._entries[structure_id] = failures, now + wait
+        await self._store(structure_id, failures, now, now + wait)
+
+    async def allowed(self, structure_id: int) -> None:
+        "Records that the structure let us in."
+        if self._entries.pop(structure_id, None) is not None:
+            await self._forget(structure_id)
+
+    async def _store(
+        self,
+        structure_id: int,
+        failures: int,
+        probe: datetime.datetime,
+        next_probe: datetime.datetime,
+    ) -> None:
+        pass
+
+    async def _forget(self, structure_id: int) -> None:
+        pass
@@ -0,0 +1,89 @@
+"""
+Reduction of wallet journals into the compact form the front end expects.
+"""
+
+from collections.abc import Sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def reduce_journal(
+    dates: Sequence[int], amounts: Sequence[float], descriptions: Sequence[str]
+) -> tuple[int, tuple[str, ...], list[tuple[int, float, int]]]:
+    """
+    Columns of journal entries, newest first, with dates in seconds since
+    the epoch, reduced to the newest date, a table of the distinct
+    descriptions and an (age in seconds, amount, description index) row
+    for each entry.
+    """
+    if not len(dates):
+        return 0, (), []
+    first_date = int(dates[0])
+    if numpy is not None:
+        ages = (first_date - numpy.asarray(dates, numpy.int64)).tolist()
+    else:
+        ages = [first_date - date for date in dates]
+
+    # A dict beats numpy.unique here: it doesn't need to sort the strings,
+    # and it numbers them in order of appearance.
+    string_table: dict[str, int] = {}
+    indexes = [string_table.setdefault(d, len(string_table)) for d in descriptions]
+    return first_date, tuple(string_table), list(zip(ages, amounts, indexes))
+
+
+def aggregate_journal(
+    dates: Sequence[int],
+    ref_types: Sequence[str],
+    amounts: Sequence[float],
+    start: int,
+    end: int,
+    bucket_seconds: int,
+) -> tuple[tuple[str, ...], list[list[float]], list[list[float]]]:
+    """
+    Totals journal amounts by ref_type and by bucket_seconds-long bucket
+    from start up to the bucket end is in, so that quiet periods total
+    zero. Returns the ref_types seen, and for each of them a list of
+    per-bucket income (positive amounts) and one of per-bucket spending
+    (negative amounts, so negative totals). Dates outside the buckets are
+    ignored.
+    """
+    index: dict[str, int] = {}
+    kinds = [index.setdefault(ref_type, len(index)) for ref_type in ref_types]
+    bucket_count = max((end - start) // bucket_seconds + 1, 0)
+    if numpy is not None:
+        return tuple(index), *_aggregate_numpy(
+            dates, kinds, amounts, start, bucket_seconds, bucket_count, len(index)
+        )
+
+    income = [[0.0] * bucket_count for _ in index]
+    spending = [[0.0] * bucket_count for _ in index]
+    for date, kind, amount in zip(dates, kinds, amounts):
+        bucket = (date - start) // bucket_seconds
+        if not 0 <= bucket < bucket_count or not amount:
+            continue
+        if amount > 0:
+            income[kind][bucket] += amount
+        else:
+            spending[kind][bucket] += amount
+    return tuple(index), income, spending
+
+
+def _aggregate_numpy(
+    dates, kinds, amounts, start, bucket_seconds, bucket_count, kind_count
+):
+    buckets = (numpy.asarray(dates, numpy.int64) - start) // bucket_seconds
+    kinds = numpy.asarray(kinds, numpy.int64)
+    amounts = numpy.asarray(amounts, numpy.float64)
+    in_range = (buckets >= 0) & (buckets < bucket_count)
+    buckets, kinds, amounts = buckets[in_range], kinds[in_range], amounts[in_range]
+
+    # Group by (kind, bucket) by flattening it into one index for bincount.
+    cells = kinds * bucket_count + buckets
+    shape = kind_count, bucket_count
+    size = kind_count * bucket_count
+    income = numpy.bincount(cells, numpy.maximum(amounts, 0), size).reshape(shape)
+    spending = numpy.bincount(cells, numpy.minimum(amounts, 0), size).reshape(shape)
+    return income.tolist(), spending.tolist()
@@ -41,6 +41,55 @@ END;
 $$;
 
 
+--
+-- Name: esi_limiter_acquire(text); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.esi_limiter_acquire(acquiring_node text) RETURNS boolean
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  budget integer;
+  in_flight integer;
+BEGIN
+  -- Serializes acquisitions across every node until the transaction ends.
+  PERFORM pg_advisory_xact_lock(hashtext('esi_limiter'));
+  SELECT CASE WHEN reset_at <= now() THEN GREATEST(remaining, 1) ELSE remaining END
+    INTO budget
+    FROM public.esi_error_budget;
+  SELECT COALESCE(SUM(occupancy), 0)
+    INTO in_flight
+    FROM public.esi_limiter_node
+    WHERE heartbeat > now() - interval '30 seconds';
+  IF in_flight >= budget THEN
+    RETURN false;
+  END IF;
+  UPDATE public.esi_limiter_node
+    SET occupancy = occupancy + 1, heartbeat = now()
+    WHERE node = acquiring_node;
+  RETURN FOUND;
+END;
+$$;
+
+
+--
+-- Name: esi_limiter_release(text, boolean); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.esi_limiter_release(releasing_node text, errored boolean) RETURNS void
+    LANGUAGE sql
+    AS $$
+  UPDATE public.esi_limiter_node
+    SET occupancy = GREATEST(occupancy - 1, 0), heartbeat = now()
+    WHERE node = releasing_node;
+  UPDATE public.esi_error_budget
+    SET remaining = (CASE WHEN reset_at <= now() THEN GREATEST(remaining, 1) ELSE remaining END) - 1,
+        reset_at = CASE WHEN reset_at IS NULL OR reset_at <= now()
+                   THEN now() + interval '30 seconds' ELSE reset_at END
+    WHERE errored;
+$$;
+
+
 --
 -- Name: account_id_seq; Type: SEQUENCE; Schema: public; Owner: -
 --
@@ -93,6 +142,123 @@ CREATE TABLE public."character" (
 );
 
 
+--
+-- Name: esi_error_budget; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.esi_error_budget (
+    id integer DEFAULT 1 NOT NULL,
+    remaining integer DEFAULT 1 NOT NULL,
+    response_time timestamp with time zone DEFAULT '2019-01-01 00:00:00+00'::timestamp with time zone NOT NULL,
+    reset_at timestamp with time zone,
+    CONSTRAINT esi_error_budget_single_row CHECK ((id = 1))
+);
+
+
+--
+-- Name: TABLE esi_error_budget; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.esi_error_budget IS 'The ESI error budget (X-ESI-Error-Limit-Remain) shared by every app server node. Only used when esi.conf sets limiter = postgres.';
+
+
+--
+-- Name: esi_limiter_node; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.esi_limiter_node (
+    node text NOT NULL,
+    occupancy integer DEFAULT 0 NOT NULL,
+    heartbeat timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+--
+-- Name: TABLE esi_limiter_node; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.esi_limiter_node IS 'In-flight ESI requests per app server node. Nodes which stop heartbeating no longer count against the shared ESI error budget.';
+
+
+--
+-- Name: skill_trades; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.skill_trades (
+    id integer DEFAULT 1 NOT NULL,
+    data json NOT NULL,
+    update_time timestamp with time zone DEFAULT now() NOT NULL,
+    expires timestamp with time zone NOT NULL,
+    CONSTRAINT skill_trades_single_row CHECK ((id = 1))
+);
+
+
+--
+-- Name: TABLE skill_trades; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.skill_trades IS 'The most recent /skilltrades market scan. Only the app server node holding the skill_trades advisory lock scans the market; the others serve the scan from here.';
+
+
+--
+-- Name: forbidden_citadel; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.forbidden_citadel (
+    structure_id bigint NOT NULL,
+    failures integer NOT NULL,
+    last_probe timestamp with time zone NOT NULL,
+    next_probe timestamp with time zone NOT NULL
+);
+
+
+--
+-- Name: TABLE forbidden_citadel; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.forbidden_citadel IS 'Citadels whose markets refused us (403), and when to ask again. Each refusal doubles the wait.';
+
+
+--
+-- Name: market_citadel; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.market_citadel (
+    structure_id bigint NOT NULL,
+    region_id integer NOT NULL,
+    last_seen timestamp with time zone NOT NULL
+);
+
+
+--
+-- Name: TABLE market_citadel; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.market_citadel IS 'Citadels with public markets, and when orders were last seen in them. Updated by every region order scan.';
+
+
+--
+-- Name: wallet_journal; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.wallet_journal (
+    character_id bigint NOT NULL,
+    id bigint NOT NULL,
+    date timestamp with time zone NOT NULL,
+    ref_type text NOT NULL,
+    amount double precision,
+    balance double precision,
+    description text NOT NULL
+);
+
+
+--
+-- Name: TABLE wallet_journal; Type: COMMENT; Schema: public; Owner: -
+--
+
+COMMENT ON TABLE public.wallet_journal IS 'Every wallet journal entry seen for a character. ESI only keeps 30 days of journal; we keep them for as long as the character stays.';
+
+
 --
 -- Name: account account_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -109,6 +275,54 @@ ALTER TABLE ONLY public."character"
     ADD CONSTRAINT character_pkey PRIMARY KEY (character_id);
 
 
+--
+-- Name: esi_error_budget esi_error_budget_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.esi_error_budget
+    ADD CONSTRAINT esi_error_budget_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: esi_limiter_node esi_limiter_node_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.esi_limiter_node
+    ADD CONSTRAINT esi_limiter_node_pkey PRIMARY KEY (node);
+
+
+--
+-- Name: skill_trades skill_trades_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.skill_trades
+    ADD CONSTRAINT skill_trades_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: forbidden_citadel forbidden_citadel_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.forbidden_citadel
+    ADD CONSTRAINT forbidden_citadel_pkey PRIMARY KEY (structure_id);
+
+
+--
+-- Name: market_citadel market_citadel_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.market_citadel
+    ADD CONSTRAINT market_citadel_pkey PRIMARY KEY (structure_id);
+
+
+--
+-- Name: wallet_journal wallet_journal_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.wallet_journal
+    ADD CONSTRAINT wallet_journal_pkey PRIMARY KEY (character_id, id);
+
+
 --
 -- Name: character set_default_display_order; Type: TRIGGER; Schema: public; Owner: -
 --
@@ -124,6 +338,14 @@ ALTER TABLE ONLY public."character"
     ADD CONSTRAINT character_account_id_fkey FOREIGN KEY (account_id) REFERENCES public.account(id);
 
 
+--
+-- Name: wallet_journal wallet_journal_character_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.wallet_journal
+    ADD CONSTRAINT wallet_journal_character_id_fkey FOREIGN KEY (character_id) REFERENCES public."character"(character_id) ON DELETE CASCADE;
+
+
 --
 -- PostgreSQL database dump complete
 --
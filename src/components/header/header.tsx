@@ -5,6 +5,8 @@ import {
     CharacterTrainingProgress,
     CharacterNameAndId,
     download_character_training_progress,
+    subscribe_character_training,
+    is_bootstrapped,
 } from "../../server";
 import {Settings} from "../md";
 
@@ -24,6 +26,7 @@ export default class Header extends React.PureComponent<HeaderProps, HeaderState
     earliest_end_date: Date | undefined;
     timeout: TimeoutHandle | undefined;
     hovered: boolean;
+    unsubscribe: (() => void) | undefined;
 
     constructor(props) {
         super(props);
@@ -46,7 +49,26 @@ export default class Header extends React.PureComponent<HeaderProps, HeaderState
     }
 
     async componentDidMount() {
-        await this.update_training_data();
+        // When the page was bootstrapped, nothing was downloaded early; the
+        // event stream starts with everybody's training progress anyway.
+        if (!is_bootstrapped()) {
+            await this.update_training_data();
+        }
+        // From now on, the server tells us when skills finish.
+        this.unsubscribe = subscribe_character_training((progress) => {
+            const training_data = {...this.state.training_data};
+            training_data[progress.character_id] = progress;
+            this.setState({training_data, current_time: new Date()});
+        });
+    }
+
+    componentWillUnmount() {
+        if (this.unsubscribe !== undefined) {
+            this.unsubscribe();
+        }
+        if (this.timeout !== undefined) {
+            this.timeout.cancel();
+        }
     }
 
     async update_training_data() {
@@ -81,7 +103,7 @@ export default class Header extends React.PureComponent<HeaderProps, HeaderState
         }
         const now = +new Date();
         let delay = this.hovered ? 1000 : 10000;
-        if (this.earliest_end_date !== undefined) {
+        if (this.earliest_end_date !== undefined && this.unsubscribe === undefined) {
             const earliest = +this.earliest_end_date;
             if (now >= earliest) {
                 this.update_training_data();
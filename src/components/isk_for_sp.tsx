@@ -43,7 +43,8 @@ interface ISKForSPPanelProps {
 
 interface ISKForSPPanelAccelerator {
     type_id: number;
-    price: number;
+    // In each hub, or null where there are none for sale.
+    prices: (number | null)[];
     name: string;
     magnitude: number;
     duration: number;
@@ -52,9 +53,16 @@ interface ISKForSPPanelAccelerator {
 interface ISKForSPPanelState {
     fake_biology_5: boolean;
     fake_implant: boolean;
-    lsi_price: number | null;
-    ssi_price: number | null;
+    hubs: string[];
+    // The index of the hub whose prices are shown.
+    hub: number;
+    // How many of each item are being bought; prices are the average paid.
+    quantity: number;
+    lsi_prices: (number | null)[];
+    ssi_prices: (number | null)[];
     accelerators: ISKForSPPanelAccelerator[];
+    // When the oldest of the orders the prices came from were fetched.
+    as_of: Date | null;
 }
 
 interface ISKForSPItemData {
@@ -78,34 +86,45 @@ export default class ISKForSPPanel extends React.PureComponent<
         super(props);
         this._timeoutHandle = null;
         this.state = {
-            lsi_price: null,
-            ssi_price: null,
+            hubs: [],
+            hub: 0,
+            quantity: 1,
+            lsi_prices: [],
+            ssi_prices: [],
             fake_biology_5: false,
             fake_implant: false,
             accelerators: [],
+            as_of: null,
         };
         this.on_fake_implant = this.on_fake_implant.bind(this);
         this.on_fake_bio5 = this.on_fake_bio5.bind(this);
+        this.on_hub_change = this.on_hub_change.bind(this);
+        this.on_quantity_change = this.on_quantity_change.bind(this);
     }
 
     async refreshPricingData() {
+        const quantity = this.state.quantity;
+        const url = quantity > 1 ? `/skilltrades?quantity=${quantity}` : "/skilltrades";
         const data = await (
-            await fetch("/skilltrades", {
+            await fetch(url, {
                 credentials: "same-origin",
                 redirect: "manual",
             })
         ).json();
 
         this.setState({
-            lsi_price: data[0],
-            ssi_price: data[1],
-            accelerators: data[2].map((d) => ({
+            hubs: data[0],
+            hub: Math.max(0, Math.min(this.state.hub, data[0].length - 1)),
+            lsi_prices: data[1],
+            ssi_prices: data[2],
+            accelerators: data[3].map((d) => ({
                 type_id: d[0],
-                price: d[1],
+                prices: d[1],
                 name: d[2],
                 magnitude: d[3],
                 duration: d[4],
             })),
+            as_of: data[4] ? new Date(data[4] * 1000) : null,
         });
     }
 
@@ -131,7 +150,9 @@ export default class ISKForSPPanel extends React.PureComponent<
     get_injector_isk_sp(): ISKForSPItemData[] {
         const props = this.props;
         const state = this.state;
-        if (state.lsi_price == null || state.ssi_price == null) {
+        const lsi_price = state.lsi_prices[state.hub];
+        const ssi_price = state.ssi_prices[state.hub];
+        if (lsi_price == null || ssi_price == null) {
             return [];
         }
         const result: ISKForSPItemData[] = [
@@ -139,7 +160,7 @@ export default class ISKForSPPanel extends React.PureComponent<
                 type_id: 40520,
                 image_type_id: 40520,
                 name: "Large Skill Injector",
-                price: state.lsi_price,
+                price: lsi_price,
                 sp: null,
                 isk_sp: null,
                 sp_day: Infinity,
@@ -148,7 +169,7 @@ export default class ISKForSPPanel extends React.PureComponent<
                 type_id: 45635,
                 image_type_id: 45635,
                 name: "Small Skill Injector",
-                price: state.ssi_price,
+                price: ssi_price,
                 sp: null,
                 isk_sp: null,
                 sp_day: Infinity,
@@ -166,8 +187,8 @@ export default class ISKForSPPanel extends React.PureComponent<
             }
             result[0].sp = 500000 * si_effectiveness;
             result[1].sp = 100000 * si_effectiveness;
-            result[0].isk_sp = state.lsi_price / result[0].sp;
-            result[1].isk_sp = state.ssi_price / result[1].sp;
+            result[0].isk_sp = lsi_price / result[0].sp;
+            result[1].isk_sp = ssi_price / result[1].sp;
         }
 
         return result;
@@ -176,9 +197,13 @@ export default class ISKForSPPanel extends React.PureComponent<
     get_accelerator_isk_sp(): ISKForSPItemData[] {
         const props = this.props;
         const state = this.state;
+        // Accelerators which aren't for sale in this hub aren't shown.
+        const accelerators = state.accelerators
+            .filter((accel) => accel.prices[state.hub] != null)
+            .map((accel) => ({...accel, price: accel.prices[state.hub] as number}));
 
         if (props.biology_skill_level == null || props.biology_implant_multiplier == null) {
-            return state.accelerators.map((accel) => ({
+            return accelerators.map((accel) => ({
                 type_id: accel.type_id,
                 image_type_id: 48582,
                 name: accel.name.replace(" Cerebral Accelerator", ""),
@@ -195,7 +220,7 @@ export default class ISKForSPPanel extends React.PureComponent<
         const duration_mult = implant * (1 + 0.2 * level);
         const all_mults = duration_mult / 40;
 
-        return state.accelerators.map((accel) => {
+        return accelerators.map((accel) => {
             const sp = all_mults * accel.duration * accel.magnitude;
             return {
                 type_id: accel.type_id,
@@ -217,10 +242,19 @@ export default class ISKForSPPanel extends React.PureComponent<
         this.setState({fake_implant: e.target.checked});
     }
 
+    on_hub_change(e) {
+        this.setState({hub: Number(e.target.value)});
+    }
+
+    on_quantity_change(e) {
+        const quantity = Math.max(1, Math.floor(Number(e.target.value)) || 1);
+        this.setState({quantity}, () => this.refreshPricingData());
+    }
+
     render() {
         const props = this.props;
         const state = this.state;
-        if (state.lsi_price == null || state.ssi_price == null) {
+        if (!state.hubs.length) {
             return <div className="isk_sp loading" />;
         }
 
@@ -239,6 +273,28 @@ export default class ISKForSPPanel extends React.PureComponent<
         ));
 
         const extra_controls: React.JSX.Element[] = [];
+        if (state.hubs.length > 1) {
+            extra_controls.push(
+                <select key="h" value={state.hub} onChange={this.on_hub_change}>
+                    {state.hubs.map((hub, i) => (
+                        <option key={hub} value={i}>
+                            {hub}
+                        </option>
+                    ))}
+                </select>,
+            );
+        }
+        extra_controls.push(
+            <label key="q" title="Price each item as the average paid when buying this many.">
+                Quantity:
+                <input
+                    type="number"
+                    min={1}
+                    onChange={this.on_quantity_change}
+                    value={state.quantity}
+                />
+            </label>,
+        );
         if (this.props.millions_of_sp != null && state.accelerators.length) {
             if (this.props.biology_implant_multiplier != 1.1) {
                 extra_controls.push(
@@ -273,6 +329,9 @@ export default class ISKForSPPanel extends React.PureComponent<
             }
         }
 
+        const price_kind =
+            state.quantity > 1 ? `average prices for ${state.quantity} units` : "sell prices";
+
         return (
             <div className="isk_sp">
                 {extra_controls}
@@ -289,7 +348,8 @@ export default class ISKForSPPanel extends React.PureComponent<
                     <tbody>{elements}</tbody>
                 </table>
                 <div className="isk_sp_explanation">
-                    Using sell prices from Jita and nearby public Citadels.
+                    Using {price_kind} from {state.hubs[state.hub]} and nearby public Citadels
+                    {state.as_of ? `, as of ${state.as_of.toLocaleTimeString()}` : ""}.
                 </div>
             </div>
         );
@@ -12,6 +12,9 @@ declare global {
     interface Window {
         early_download_characters: undefined | ReturnType<typeof fetch>;
         early_download_character_training_progress: undefined | ReturnType<typeof fetch>;
+        // Embedded in the page by the server when we're logged in, instead
+        // of the early downloads.
+        bootstrap: undefined | {characters: [number, string, boolean][]};
         show_login: () => void; // FIXME this is a HACK!
     }
 }
@@ -19,9 +22,21 @@ declare global {
 export class NeedsLoginError extends Error {}
 export class CharacterNeedsUpdated extends Error {}
 
+let bootstrapped = false;
+
+// Whether the character list came embedded in the page.
+export function is_bootstrapped(): boolean {
+    return bootstrapped;
+}
+
 export async function download_characters(): Promise<CharacterNameAndId[]> {
     let response;
-    if (typeof window != "undefined" && window.early_download_characters) {
+    if (typeof window != "undefined" && window.bootstrap) {
+        const characters = window.bootstrap.characters;
+        window.bootstrap = undefined;
+        bootstrapped = true;
+        return characters.map((c) => ({id: c[0], name: c[1], valid: c[2]}));
+    } else if (typeof window != "undefined" && window.early_download_characters) {
         const early_fetch = window.early_download_characters;
         window.early_download_characters = undefined;
         response = await early_fetch;
@@ -40,8 +55,16 @@ export async function download_characters(): Promise<CharacterNameAndId[]> {
     }));
 }
 
+// The last skills payload of each character, and its version (ETag). Sent
+// back to the server so that it only needs to send what changed.
+const character_skill_payloads = new Map<number, {version: string; payload: any[]}>();
+
 export async function download_character_skills(character_id: number): Promise<CharacterSkills> {
-    const response = await fetch(`${character_id}/skills`, {credentials: "same-origin"});
+    const previous = character_skill_payloads.get(character_id);
+    const url = previous
+        ? `${character_id}/skills?since=${encodeURIComponent(previous.version)}`
+        : `${character_id}/skills`;
+    const response = await fetch(url, {credentials: "same-origin"});
 
     if (response.status == 401) {
         throw new NeedsLoginError();
@@ -51,7 +74,27 @@ export async function download_character_skills(character_id: number): Promise<C
         throw new CharacterNeedsUpdated();
     }
 
-    return new CharacterSkills(await response.json());
+    let payload = await response.json();
+    if (payload.length > 10) {
+        // A delta against the version we sent.
+        if (previous === undefined || payload[10] !== previous.version) {
+            character_skill_payloads.delete(character_id);
+            return await download_character_skills(character_id);
+        }
+        const skills = new Map(previous.payload[2].map((s) => [s[0], s]));
+        for (const skill of payload[2]) {
+            skills.set(skill[0], skill);
+        }
+        payload = payload.slice(0, 10);
+        payload[1] = payload[1] === null ? previous.payload[1] : payload[1];
+        payload[2] = Array.from(skills.values());
+    }
+
+    const etag = response.headers.get("ETag");
+    if (etag) {
+        character_skill_payloads.set(character_id, {version: etag.replace(/"/g, ""), payload});
+    }
+    return new CharacterSkills(payload);
 }
 
 export interface WalletEntry {
@@ -91,6 +134,31 @@ export async function download_wallet(character_id: number): Promise<WalletEntry
     });
 }
 
+export interface WalletAnalytics {
+    start: Date;
+    bucket_seconds: number;
+    ref_types: string[];
+    // For each ref_type, the total of each bucket. Spending is negative.
+    income: number[][];
+    spending: number[][];
+}
+
+export async function download_wallet_analytics(
+    period: "day" | "week",
+    days: number,
+): Promise<WalletAnalytics> {
+    const response = await fetch(`characters/wallet?period=${period}&days=${days}`, {
+        credentials: "same-origin",
+    });
+
+    if (response.status == 401) {
+        throw new NeedsLoginError();
+    }
+
+    const [start, bucket_seconds, ref_types, income, spending] = await response.json();
+    return {start: new Date(start * 1000), bucket_seconds, ref_types, income, spending};
+}
+
 export async function delete_character(character_id: number): Promise<void> {
     const response = await fetch("/" + character_id, {
         method: "DELETE",
@@ -119,15 +187,71 @@ export async function* download_character_training_progress() {
         the_fetch = fetch("/characters/training", {credentials: "same-origin"});
     }
     for await (const line of makeTextFileLineIterator(the_fetch)) {
-        const [character_id, skill_id, level, sp, start_date, end_date] = line.split(":");
+        yield parse_training_progress(line);
+    }
+}
+
+function parse_training_progress(line: string): CharacterTrainingProgress {
+    const [character_id, skill_id, level, sp, start_date, end_date] = line.split(":");
+    return {
+        character_id: +character_id,
+        skill_id: skill_id === undefined ? undefined : +skill_id,
+        level: +level,
+        sp: +sp,
+        start_date: start_date ? new Date(+start_date * 1000) : undefined,
+        end_date: end_date ? new Date(+end_date * 1000) : undefined,
+    } as CharacterTrainingProgress;
+}
+
+// Calls on_progress with each character's training progress, and again
+// whenever one of their skills finishes. Returns a function which stops.
+export function subscribe_character_training(
+    on_progress: (progress: CharacterTrainingProgress) => void,
+): () => void {
+    const source = new EventSource("/characters/events", {withCredentials: true});
+    const listener = (event: MessageEvent) => on_progress(parse_training_progress(event.data));
+    source.addEventListener("training", listener);
+    source.addEventListener("completed", listener);
+    return () => source.close();
+}
+
+export interface CharacterSummary {
+    character_id: number;
+    // undefined if the character's data could not be downloaded.
+    sp: number | undefined;
+    unallocated_sp: number | undefined;
+    training: CharacterTrainingProgress | undefined;
+    queue_length: number | undefined;
+    wallet_balance: number | undefined;
+    implant_bonuses: number[] | undefined;
+    biology_implant: number | undefined;
+}
+
+// Every character's summary in one request, yielded as each one is ready.
+export async function* download_dashboard() {
+    const the_fetch = fetch("/characters/dashboard", {credentials: "same-origin"});
+    for await (const line of makeTextFileLineIterator(the_fetch)) {
+        const [character_id, sp, unallocated_sp, training, queue_length, wallet_balance, implant_bonuses, biology_implant] =
+            JSON.parse(line);
         yield {
-            character_id: +character_id,
-            skill_id: skill_id === undefined ? undefined : +skill_id,
-            level: +level,
-            sp: +sp,
-            start_date: start_date ? new Date(start_date * 1000) : undefined,
-            end_date: end_date ? new Date(end_date * 1000) : undefined,
-        } as CharacterTrainingProgress;
+            character_id,
+            sp,
+            unallocated_sp,
+            training: training
+                ? {
+                      character_id,
+                      skill_id: training[0],
+                      level: training[1],
+                      sp: training[2],
+                      start_date: new Date(training[3] * 1000),
+                      end_date: new Date(training[4] * 1000),
+                  }
+                : undefined,
+            queue_length,
+            wallet_balance,
+            implant_bonuses,
+            biology_implant,
+        } as CharacterSummary;
     }
 }
 